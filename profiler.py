@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# @file   profiler.py
+# @author Albert Puig (albert.puig@epfl.ch)
+# @date   19.10.2026
+
+"""Account for the time, SSH round-trips and bytes of a deploy.
+
+The Fabric operations are wrapped here, so they must be imported from this
+module instead of fabric.api. Every remote command is charged to the
+innermost task being timed.
+
+"""
+
+import os
+import json
+import time
+from functools import wraps
+from contextlib import contextmanager
+
+from fabric import api
+
+_FIELDS = ('calls', 'time', 'round_trips', 'bytes')
+_profile = {'tasks': {}, 'commands': {}}
+_task_stack = []
+
+def reset():
+    _profile['tasks'].clear()
+    _profile['commands'].clear()
+
+def snapshot():
+    """Copy of the profile, for example to send it back from a parallel task."""
+    return json.loads(json.dumps(_profile))
+
+def _charge(kind, name, elapsed, round_trips=0, transferred=0, calls=1):
+    entry = _profile[kind].setdefault(name, dict.fromkeys(_FIELDS, 0))
+    entry['calls'] += calls
+    entry['time'] += elapsed
+    entry['round_trips'] += round_trips
+    entry['bytes'] += transferred
+
+@contextmanager
+def timing(name):
+    """Time a block as the task name."""
+    _task_stack.append(name)
+    start = time.time()
+    try:
+        yield
+    finally:
+        _task_stack.pop()
+        _charge('tasks', name, time.time() - start)
+
+def timed(func):
+    """Time each call of func as a task."""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with timing(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+def _operation(operation, size):
+    """Wrap a Fabric operation to account for it.
+
+    @arg  operation: Fabric operation
+    @arg  size: function of (arguments, result) giving the bytes transferred
+
+    """
+    @wraps(operation)
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        result = operation(*args, **kwargs)
+        elapsed = time.time() - start
+        round_trips = 0 if operation is api.local else 1
+        transferred = size(args, kwargs, result)
+        command = '%s %s' % (operation.__name__, str(args[0] if args else '')[:80])
+        _charge('commands', command, elapsed, round_trips, transferred)
+        if _task_stack:
+            _charge('tasks', _task_stack[-1], 0.0, round_trips, transferred, calls=0)
+        return result
+    return wrapper
+
+def _command_size(args, kwargs, result):
+    # Command sent and output received
+    return len(str(args[0] if args else '')) + len(result or '')
+
+def _put_size(args, kwargs, result):
+    local_path = args[0] if args else kwargs.get('local_path')
+    if isinstance(local_path, basestring) and os.path.isfile(local_path):
+        return os.path.getsize(local_path)
+    return 0
+
+def _get_size(args, kwargs, result):
+    return sum(os.path.getsize(path) for path in result or [] if os.path.isfile(path))
+
+run = _operation(api.run, _command_size)
+sudo = _operation(api.sudo, _command_size)
+local = _operation(api.local, lambda args, kwargs, result: 0)
+put = _operation(api.put, _put_size)
+get = _operation(api.get, _get_size)
+
+def merge(profiles):
+    """Add up several profiles."""
+    merged = {'tasks': {}, 'commands': {}}
+    for profile in profiles:
+        for kind in merged:
+            for name, entry in profile[kind].items():
+                total = merged[kind].setdefault(name, dict.fromkeys(_FIELDS, 0))
+                for field in _FIELDS:
+                    total[field] += entry[field]
+    return merged
+
+def report(profile, max_commands=15, output=None):
+    """Print the profile, slowest first, and optionally save it as JSON.
+
+    @arg  profile: profile, or dict of host -> profile
+    @arg  max_commands: number of slowest commands to show
+    @arg  output: JSON file to write the profile to
+
+    """
+    if output:
+        with open(output, 'w') as json_file:
+            json.dump(profile, json_file, indent=2, sort_keys=True)
+    if 'tasks' not in profile:
+        for host in sorted(profile):
+            commands = profile[host]['commands'].values()
+            print "%-30s %4s round-trips, %9s bytes, %7.1fs in commands" % (
+                host, sum(entry['round_trips'] for entry in commands),
+                sum(entry['bytes'] for entry in commands),
+                sum(entry['time'] for entry in commands))
+        profile = merge(profile.values())
+    print
+    print "%-40s %6s %9s %12s %12s" % ('Task', 'calls', 'time (s)', 'round-trips', 'bytes')
+    for name, entry in sorted(profile['tasks'].items(), key=lambda item: -item[1]['time']):
+        print "%-40s %6s %9.1f %12s %12s" % (name, entry['calls'], entry['time'],
+                                             entry['round_trips'], entry['bytes'])
+    print
+    print "%-60s %6s %9s %12s" % ('Slowest commands', 'calls', 'time (s)', 'bytes')
+    commands = sorted(profile['commands'].items(), key=lambda item: -item[1]['time'])
+    for name, entry in commands[:max_commands]:
+        print "%-60s %6s %9.1f %12s" % (name[:60], entry['calls'], entry['time'], entry['bytes'])
+
+# EOF
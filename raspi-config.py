@@ -4,18 +4,30 @@
 # @date   17.03.2013
 
 import os
+import re
+import sys
+import fcntl
+import shutil
+import tarfile
+import tempfile
 
 # Fabric stuff
-from fabric.api import task, local, env, run, sudo, settings#, abort
+from fabric.api import task, env, settings, execute, parallel, serial, runs_once, abort
 from fabric.context_managers import hide, cd
 
 # My stuff
-from utils import dir_exists, file_exists, to_boolean
+import profiler
+from profiler import local, run, sudo, put, get, timed
+from utils import dir_exists, file_exists, to_boolean, gather_facts, forget_facts, service_state, \
+                  package_version, sync_files
 
 ############################################################
 # Configuration
 ############################################################
 env.hosts = ['pi@192.168.1.120']
+# Hosts deployed at the same time, unless given with -z
+if not env.pool_size:
+    env.pool_size = 4
 
 simple_install = True
 
@@ -40,8 +52,9 @@ packages_to_install = ['git',
                        'libssl-dev',
                        'build-essential',
                        'libffi6',
-                       'libffi-dev'
                       ]
+# Package lists older than this (in hours) are updated before installing
+apt_lists_max_age   = 24
 # For psutil
 # http://raspberrypi.stackexchange.com/questions/8566/peerguardian-moblock-installation-on-raspbmc
 easy_install_list   = ['-e "git+git://github.com/seatgeek/fuzzywuzzy.git#egg=fuzzywuzzy"',
@@ -53,11 +66,42 @@ easy_install_list   = ['-e "git+git://github.com/seatgeek/fuzzywuzzy.git#egg=fuz
                        '"git+git://github.com/apuignav/pibullet.git"',
                        #"psutil",
                        ]
+# Configuration files: (source, destination on the host, handlers to run when it changes).
+# Sources are relative to this folder, or on the host if they start with 'remote:'
+config_files        = {'deluge': [('deluge/deluge.conf', '/etc/init/deluge.conf',
+                                   ['daemon-reload', 'restart deluge']),
+                                  ('deluge/deluge-webui.conf', '/etc/init/deluge-webui.conf',
+                                   ['daemon-reload', 'restart deluge-webui']),
+                                  ('deluge/logrotate.d_deluge', '/etc/logrotate.d/deluge', []),
+                                  ('deluge/deluge-throttle.service',
+                                   '/lib/systemd/system/deluge-throttle.service',
+                                   ['daemon-reload', 'enable deluge-throttle', 'restart deluge-throttle'])],
+                       'crontab': [('config/crontab.pi', '~/runtime/crontab.pi', ['crontab'])],
+                       'expensebot': [('remote:$HOME/src/expense-bot/service/expensebot.service',
+                                       '/lib/systemd/system/expensebot.service',
+                                       ['daemon-reload', 'restart expensebot'])],
+                       'samba': [('config/smb-shares.conf', '/etc/samba/smb-shares.conf',
+                                  ['restart samba'])]}
+# (name, command, use sudo?), in the order they must run
+config_handlers     = [('daemon-reload', 'systemctl daemon-reload', True),
+                       ('restart deluge', 'systemctl restart deluge', True),
+                       ('restart deluge-webui', 'systemctl restart deluge-webui', True),
+                       ('enable deluge-throttle', 'systemctl enable deluge-throttle', True),
+                       ('restart deluge-throttle', 'systemctl restart deluge-throttle', True),
+                       ('restart expensebot', 'systemctl restart expensebot', True),
+                       ('restart samba', 'systemctl restart samba', True),
+                       ('crontab', 'crontab ~/runtime/crontab.pi', False)]
+# Wheels are kept per architecture, since those built on the workstation don't work on the Pi
+wheelhouse_cache    = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wheelhouse')
+remote_wheelhouse   = '/tmp/wheelhouse'
 git_repositories    = [#'https://github.com/MilhouseVH/bcmstat.git',
                        #'https://github.com/pilluli/service.xbmc.callbacks.git',
                        #'https://github.com/amet/script.xbmc.subtitles.git',
                        'https://github.com/apuignav/raspi-config.git',
                        'https://github.com/apuignav/expense-bot.git']
+# New clones: history depth (0 for all) and partial clone filter (None for full)
+git_clone_depth     = 1
+git_clone_filter    = 'blob:none'
 if not simple_install:
     apt_repos           = ['ppa:keithw/mosh']
 
@@ -74,16 +118,44 @@ if not simple_install:
 ############################################################
 # Tasks
 ############################################################
+def repo_dir(repo):
+    return '~/src/%s' % os.path.splitext(os.path.split(repo)[1])[0]
+
+deluge_backup = '/media/RaspiHD/backup/backup.deluge.tar.gz'
+deluge_config_dir = '~/.config/deluge'
+
+@task
+def gather_host_facts():
+    """Check everything the deploy needs to know in one go."""
+    gather_facts(paths=['~/.ssh', deluge_backup, deluge_config_dir] + dirs_to_make +
+                       [repo_dir(repo) for repo in git_repositories],
+                 packages=packages_to_install,
+                 services=['deluge', 'expensebot', 'samba'],
+                 checksums=[path.replace('remote:', '') for files in config_files.values()
+                            for source, destination, _ in files
+                            for path in (source, destination) if path.startswith('remote:')] +
+                           [destination for files in config_files.values()
+                            for _, destination, _ in files])
+
 @task
+@serial
 def deploy_ssh(remove_banner=True):
+    """Add our public keys to the host, asking for its password.
+
+    It's interactive, so it runs one host at a time, before the parallel steps.
+
+    """
     with settings(warn_only=True):
         # Remove annoying Debian banner
         if remove_banner:
             run('touch $HOME/.hushlogin')
         # Add our public keys
         if not dir_exists('~/.ssh'):
-            for host in env.hosts:
-                local('ssh-copy-id %s' % host)
+            if not sys.stdin.isatty():
+                abort("%s has no SSH keys and ssh-copy-id needs a terminal to ask for "
+                      "the password: run deploy_ssh interactively" % env.host_string)
+            local('ssh-copy-id %s' % env.host_string)
+            forget_facts(paths=['~/.ssh'])
 
 @task
 def prepare_dirs():
@@ -93,6 +165,7 @@ def prepare_dirs():
             dir_list.append(d)
     if dir_list:
         run("mkdir {0}".format(" ".join(['%s' % dir_ for dir_ in dir_list])))
+        forget_facts(paths=dir_list)
     with cd('/home/pi'):
         run('ln -sf /media/RaspiHD/ .')
 
@@ -108,31 +181,212 @@ def prepare_apt_repos():
         sudo('sudo add-apt-repository %s' % repo)
 
 @task
-def install_packages(update=True):
-    update = to_boolean(update)
-    if update:
-        with hide('stdout'):
-            sudo('apt-get update')
-    print "Installing software"
+def install_packages(update=True, max_age=apt_lists_max_age):
+    """Install the missing packages.
+
+    @arg  update: update the package lists if older than max_age (hours), 'force' to always
+        update them
+    @arg  max_age: maximum age of the package lists
+
+    """
+    packages = sorted(set(packages_to_install))
+    gather_facts(packages=packages)
+    missing = [package for package in packages if package_version(package) is None]
+    if not missing:
+        print "All packages are installed"
+        return
+    commands = []
+    if update == 'force':
+        commands.append('apt-get update')
+    elif to_boolean(update):
+        # find prints the lists that are recent enough
+        commands.append('[ -n "$(find /var/lib/apt/lists -maxdepth 1 -type f -mmin -{0} | head -1)" ] '
+                        '|| apt-get update'.format(int(float(max_age) * 60)))
+    commands.append('apt-get install -y {0}'.format(' '.join(missing)))
+    print "Installing %s" % ', '.join(missing)
+    with hide('stdout'):
+        sudo(' && '.join(commands))
+    forget_facts(packages=missing)
+
+def wheel_requirements():
+    # Editable installs can't be wheels
+    return [package.replace('-e ', '').strip('"') for package in easy_install_list]
+
+def normalize_project(name):
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+def wheel_project(wheel_file):
+    """Get (normalized name, version) from a wheel file name."""
+    name, version = os.path.basename(wheel_file).split('-')[:2]
+    return normalize_project(name), version
+
+def vcs_projects():
+    """Get the normalized names of the projects installed from git.
+
+    Their version is whatever the repository has, so they are only checked by name.
+
+    """
+    projects = set()
+    for requirement in wheel_requirements():
+        if 'git+' not in requirement:
+            continue
+        url, _, egg = requirement.partition('#egg=')
+        projects.add(normalize_project(egg or os.path.splitext(os.path.basename(url))[0]))
+    return projects
+
+def frozen_projects(lines):
+    """Parse pip freeze into a dict of normalized name -> version (None for VCS or URL installs)."""
+    projects = {}
+    for line in lines:
+        line = line.strip()
+        if line.startswith('-e ') and '#egg=' in line:
+            projects[normalize_project(line.split('#egg=')[1])] = None
+        elif ' @ ' in line:
+            projects[normalize_project(line.split(' @ ')[0])] = None
+        elif '==' in line:
+            name, _, version = line.partition('==')
+            projects[normalize_project(name)] = version
+    return projects
+
+@timed
+def build_wheelhouse(arch):
+    """Get the wheels for this architecture, building them on the host if not cached.
+
+    Hosts are deployed in parallel, so the cache of each architecture is
+    locked while checking and updating it: the first host builds the wheels
+    and the others wait for them.
+
+    @return: (local folder with the wheels, were they built on this host?)
+
+    """
+    if not os.path.exists(wheelhouse_cache):
+        try:
+            os.makedirs(wheelhouse_cache)
+        except OSError:
+            pass  # Created by another host in the meantime
+    with open(os.path.join(wheelhouse_cache, '%s.lock' % arch), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            return _update_wheelhouse(arch)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def _update_wheelhouse(arch):
+    """Build the wheelhouse on the host if the cached one is missing or outdated."""
+    local_wheelhouse = os.path.join(wheelhouse_cache, arch)
+    stamp_file = os.path.join(local_wheelhouse, 'requirements.txt')
+    requirements = '\n'.join(wheel_requirements())
+    if os.path.exists(stamp_file):
+        with open(stamp_file) as stamp:
+            if stamp.read() == requirements:
+                return local_wheelhouse, False
+    print "Building wheelhouse for %s" % arch
     with hide('stdout'):
-        sudo('apt-get install -y {0}'.format(' '.join(packages_to_install)))
+        run('rm -rf {0} && pip wheel --wheel-dir {0} {1}'.format(remote_wheelhouse,
+                                                                ' '.join(wheel_requirements())))
+        run('tar -czf {0}.tar.gz -C {0} .'.format(remote_wheelhouse))
+    # Fetch it back, in one transfer, for the next hosts and runs
+    temp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(__file__)))
+    try:
+        archive = get('{0}.tar.gz'.format(remote_wheelhouse), temp_dir)[0]
+        with tarfile.open(archive) as tar:
+            tar.extractall(os.path.join(temp_dir, arch))
+        with open(os.path.join(temp_dir, arch, 'requirements.txt'), 'w') as stamp:
+            stamp.write(requirements)
+        if os.path.exists(local_wheelhouse):
+            shutil.rmtree(local_wheelhouse)
+        os.rename(os.path.join(temp_dir, arch), local_wheelhouse)
+    finally:
+        shutil.rmtree(temp_dir)
+    return local_wheelhouse, True
 
 @task
 def install_python_packages():
-    # Now install packages
-    for package in easy_install_list:
-        print "Installing %s" % package
+    with hide('running', 'stdout'):
+        output = run('uname -m; pip freeze 2>/dev/null').splitlines()
+    arch = output[0].strip()
+    installed = frozen_projects(output[1:])
+    from_git = vcs_projects()
+    local_wheelhouse, built_here = build_wheelhouse(arch)
+
+    def is_installed(wheel):
+        name, version = wheel_project(wheel)
+        if name in from_git:
+            return name in installed
+        return installed.get(name) == version
+
+    wheels = sorted(wheel for wheel in os.listdir(local_wheelhouse)
+                    if wheel.endswith('.whl') and not is_installed(wheel))
+    if not wheels:
+        print "All python packages are up to date"
+        return
+    print "Installing %s" % ', '.join(wheels)
+    if not built_here:
+        # Ship the whole wheelhouse in one go, since the missing wheels may need any of the others
+        temp_dir = tempfile.mkdtemp()
+        try:
+            archive = os.path.join(temp_dir, 'wheels.tar.gz')
+            with tarfile.open(archive, 'w:gz') as tar:
+                for wheel in os.listdir(local_wheelhouse):
+                    if wheel.endswith('.whl'):
+                        tar.add(os.path.join(local_wheelhouse, wheel), wheel)
+            put(archive, '{0}.tar.gz'.format(remote_wheelhouse))
+        finally:
+            shutil.rmtree(temp_dir)
         with hide('stdout'):
-            sudo('pip install {0}'.format(package))
+            run('rm -rf {0} && mkdir -p {0} && tar -xzf {0}.tar.gz -C {0}'.format(remote_wheelhouse))
+    with hide('stdout'):
+        sudo('pip install --no-index --find-links {0} {1}'.format(
+             remote_wheelhouse, ' '.join('%s/%s' % (remote_wheelhouse, wheel) for wheel in wheels)))
 
 @task
-def clone_git_repos():
-    with settings(warn_only=True):
+def clone_git_repos(depth=git_clone_depth, filter=git_clone_filter):
+    """Clone the missing repositories and fast-forward the existing ones, all at the same time."""
+    clone_options = []
+    if depth and int(depth):
+        clone_options.append('--depth {0}'.format(int(depth)))
+    if filter and filter != 'None':
+        clone_options.append('--filter={0}'.format(filter))
+    # Every repository in a background subshell, reporting: repo <index> <action> <status> <seconds>
+    script = ['mkdir -p /tmp/clone_git_repos;']
+    for index, repo in enumerate(git_repositories):
+        name = os.path.splitext(os.path.split(repo)[1])[0]
+        log = '/tmp/clone_git_repos/{0}.log'.format(name)
+        script.append(
+            '(start=$(date +%s.%N); '
+            'if [ -d {name}/.git ]; then action=update; '
+            'git -C {name} fetch --quiet && git -C {name} merge --ff-only --quiet @{{u}}; '
+            'else action=clone; git clone --quiet {options} {repo} {name}; fi > {log} 2>&1; '
+            'status=$?; '
+            'echo "repo {index} $action $status $(awk "BEGIN {{print $(date +%s.%N) - $start}}")"; '
+            '[ $status -eq 0 ] || sed "s/^/log {index} /" {log}) &'.format(
+                name=name, repo=repo, index=index, log=log, options=' '.join(clone_options)))
+    script.append('wait')
+    with settings(hide('running', 'stdout'), warn_only=True):
         with cd('$HOME/src'):
-            for repo in git_repositories:
-                name = os.path.splitext(os.path.split(repo)[1])[0]
-                if run('test -d {0}'.format(name)).failed:
-                    run('git clone {0}'.format(repo))
+            output = run(' '.join(script))
+    forget_facts(paths=[repo_dir(repo) for repo in git_repositories])
+    results = {}
+    logs = {}
+    for line in output.splitlines():
+        fields = line.split(None, 2)
+        if len(fields) < 3:
+            continue
+        if fields[0] == 'repo':
+            action, status, elapsed = fields[2].split()
+            results[int(fields[1])] = (action, int(status), float(elapsed))
+        elif fields[0] == 'log':
+            logs.setdefault(int(fields[1]), []).append(fields[2])
+    for index, repo in enumerate(git_repositories):
+        if index not in results:
+            print "%s: no result" % repo
+            continue
+        action, status, elapsed = results[index]
+        print "%s: %s %s in %.1fs" % (repo, action, 'OK' if status == 0 else 'FAILED', elapsed)
+        for line in logs.get(index, []):
+            print "    %s" % line
+    if any(status != 0 for _, status, _ in results.values()) or len(results) != len(git_repositories):
+        raise RuntimeError("Some repositories could not be cloned or updated")
 
 #@task
 #def configure_xbmc():
@@ -142,21 +396,48 @@ def clone_git_repos():
             #if file_exists('/media/RaspiHD/backup/backup.tar.gz'):
                 #run('python src/raspi-config/scripts/backup.py restore /media/RaspiHD/backup/backup.tar.gz')
 
+def sync_config(groups=None, plan=False):
+    """Sync the configuration files of the given groups (all if None)."""
+    groups = groups or sorted(config_files)
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    files = [(source if source.startswith('remote:') else os.path.join(base_dir, source),
+              destination, handlers)
+             for group in groups for source, destination, handlers in config_files[group]]
+    with settings(warn_only=True):
+        return sync_files(files, config_handlers, to_boolean(plan))
+
 @task
-def configure_deluge():
-# sudo cp $HOME/src/raspi-config/deluge/logrotate.d_deluge /etc/logrotate.d/deluge
+def plan_configuration():
+    """Show which configuration files would change, and what would be run."""
+    if not sync_config(plan=True):
+        print "Configuration is up to date"
+
+@task
+def configure_deluge(restore=False):
+    """Configure deluge, only restarting it if its configuration changed.
+
+    The backup is restored when deluge has never run on the host, or if
+    restore is True.
+
+    """
+    first_run = not dir_exists(deluge_config_dir)
     with settings(warn_only=True):
-        sudo("cp /home/pi/src/raspi-config/deluge/deluge.conf /etc/init/")
-        sudo("cp /home/pi/src/raspi-config/deluge/deluge-webui.conf /etc/init/")
         sudo("mkdir -p /var/log/deluge && sudo chown -R pi:pi /var/log/deluge && sudo chmod -R 750 /var/log/deluge")
-        sudo("cp /home/pi/src/raspi-config/deluge/logrotate.d_deluge /etc/logrotate.d/deluge")
         run("ln -sf /media/RaspiHD/torrent/completo/ /home/pi/runtime/")
         run("ln -sf /media/RaspiHD/torrent/download/ /home/pi/runtime/")
         run("ln -sf /media/RaspiHD/torrent/tv_shows.cache /home/pi/runtime/")
-        sudo("systemctl start deluge")
+    sync_config(['deluge'])
+    if not (first_run or to_boolean(restore)):
+        return
+    with settings(warn_only=True):
+        if first_run:
+            # Let deluge create its configuration before overwriting it
+            sudo("systemctl start deluge")
         sudo("systemctl stop deluge")
-        if file_exists('/media/RaspiHD/backup/backup.deluge.tar.gz'):
+        if file_exists(deluge_backup):
             run('python $HOME/src/raspi-config/scripts/backup.py restore /media/RaspiHD/backup/ deluge')
+        sudo("systemctl start deluge")
+        forget_facts(paths=[deluge_config_dir], services=['deluge'])
 
 @task
 def configure_mail():
@@ -166,44 +447,92 @@ def configure_mail():
 
 @task
 def configure_crontab():
-    run("crontab /home/pi/src/raspi-config/config/crontab.pi")
+    sync_config(['crontab'])
 
 @task
 def configure_expensebot():
+    sync_config(['expensebot'])
     with settings(warn_only=True):
-        sudo('cp $HOME/src/expense-bot/service/expensebot.service /lib/systemd/system/')
-        sudo('systemctl daemon-reload')
-        sudo('systemctl start expensebot')
+        if service_state('expensebot') != 'active':
+            sudo('systemctl start expensebot')
 
 @task
 def configure_samba():
-    with settings(warn_only=True):
-        sudo('cp $HOME/src/raspi-config/config/smb-shares.conf /etc/samba/smb-shares.conf')
-        sudo('systemctl restart samba')
+    sync_config(['samba'])
+
+############################################################
+# Deploy on all hosts in parallel
+############################################################
+def software_steps(update=True):
+    return [(gather_host_facts, ()),
+            (prepare_dirs, ()),
+            (download_things, ()),
+            (prepare_apt_repos, ()),
+            (install_packages, (update,)),
+            (install_python_packages, ()),
+            (clone_git_repos, ())]
+
+configuration_steps = [(gather_host_facts, ()),
+                       #(configure_xbmc, ()),
+                       (configure_deluge, ()),
+                       (configure_mail, ()),
+                       (configure_crontab, ()),
+                       (configure_expensebot, ()),
+                       (configure_samba, ())]
+
+@parallel
+def run_steps(steps):
+    """Run the steps on the current host, going on if one fails.
+
+    @return: (list of (step name, error) of the failed steps, profile of the host)
+
+    """
+    # Each host runs in its own process, which starts with a copy of the parent's profile
+    profiler.reset()
+    failed = []
+    for step, args in steps:
+        try:
+            with profiler.timing(step.__name__):
+                step(*args)
+        # Fabric aborts with SystemExit
+        except (Exception, SystemExit), error:
+            failed.append((step.__name__, str(error) or error.__class__.__name__))
+    return failed, profiler.snapshot()
+
+def deploy_steps(steps, profile_json=None):
+    """Run the steps on all hosts in parallel, and summarize the failures and the profile."""
+    results = execute(run_steps, steps)
+    print
+    print "Deploy profile"
+    profiler.report(dict((host, profile) for host, (_, profile) in results.items()),
+                    output=profile_json)
+    print
+    print "Deploy summary"
+    for host in sorted(results):
+        failed = results[host][0]
+        if not failed:
+            print "  %s: OK" % host
+            continue
+        print "  %s: %s failed" % (host, len(failed))
+        for step_name, error in failed:
+            print "    %s -> %s" % (step_name, error)
+    return results
 
 @task
-def deploy_software(update=True):
-    prepare_dirs()
-    download_things()
-    prepare_apt_repos()
-    install_packages(update)
-    install_python_packages()
-    clone_git_repos()
+@runs_once
+def deploy_software(update=True, profile_json=None):
+    deploy_steps(software_steps(update), profile_json)
 
 @task
-def deploy_configuration():
-    #configure_xbmc()
-    configure_deluge()
-    configure_mail()
-    configure_crontab()
-    configure_expensebot()
-    configure_samba()
+@runs_once
+def deploy_configuration(profile_json=None):
+    deploy_steps(configuration_steps, profile_json)
 
 @task
-def deploy(update=True):
-    deploy_ssh()
-    deploy_software(update)
-    deploy_configuration()
+@runs_once
+def deploy(update=True, profile_json=None):
+    execute(deploy_ssh)
+    deploy_steps(software_steps(update) + configuration_steps, profile_json)
 
 if __name__ == '__main__':
     deploy()
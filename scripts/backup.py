@@ -7,7 +7,27 @@
 """XBMC backup utils."""
 
 import os
+import sys
+import shutil
 import argparse
+from distutils.spawn import find_executable
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..', 'show_downloader'))
+from RunCommand import Pipeline
+import incremental_backup
+from chunkstore import ChunkStore
+
+def report_failure(pipeline):
+    """Print the exit status of all the stages of a failed pipeline."""
+    for result in pipeline.results:
+        print "  %s -> exit code %s (%.1fs)" % (' '.join(result.command),
+                                               result.returncode,
+                                               result.elapsed)
+
+def compressor():
+    """Get the compression command, pigz (multi-core) if available."""
+    return ['pigz'] if find_executable('pigz') else ['gzip']
 
 def do_backup(args):
     """Backup XBMC and deluge."""
@@ -27,18 +47,147 @@ def do_backup(args):
         base_folder, folder_to_backup = os.path.split(origin_folder)
         if service:
             os.system("sudo stop %s" % service)
-        os.system("cd %s && tar -cvzf %s %s" % (base_folder, output_file, folder_to_backup))
+        pipeline = Pipeline(['tar', '-c', folder_to_backup], compressor(), cwd=base_folder)
+        pipeline.run(output_file)
         if service:
             os.system("sudo start %s" % service)
+        if not pipeline.succeeded:
+            print "Failed backing up to %s" % output_file
+            report_failure(pipeline)
+            return
         print "Backed up to %s" % output_file
 
+    def take_snapshot(origin_folder, service):
+        """Copy folder next to itself, keeping the service stopped only while copying.
+
+        Reflinks are used where the file system supports them.
+
+        @arg  origin_folder: folder to copy
+        @type origin_folder: str
+        @arg  service: service to stop while copying
+        @type service: str
+
+        @return: folder containing the copy, None if it failed
+
+        """
+        base_folder, folder_to_backup = os.path.split(origin_folder)
+        snapshot_folder = os.path.join(base_folder, '.%s.snapshot' % folder_to_backup)
+        if os.path.exists(snapshot_folder):
+            shutil.rmtree(snapshot_folder)
+        os.mkdir(snapshot_folder)
+        os.system("sudo stop %s" % service)
+        copy = Pipeline(['cp', '-a', '--reflink=auto', origin_folder, snapshot_folder])
+        copy.run()
+        os.system("sudo start %s" % service)
+        if not copy.succeeded:
+            print "Failed taking snapshot of %s" % origin_folder
+            report_failure(copy)
+            shutil.rmtree(snapshot_folder)
+            return None
+        print "Took snapshot of %s in %.1fs" % (origin_folder, copy.results[0].elapsed)
+        return snapshot_folder
+
+    def perform_snapshot_backup(origin_folder, output_file, service, background=False):
+        """Backup folder keeping the service stopped only while taking a snapshot.
+
+        Once the service is started again the snapshot is compressed,
+        optionally in a background process.
+
+        @arg  origin_folder: folder to backup
+        @type origin_folder: str
+        @arg  output_file: file to backup to
+        @type output_file: str
+        @arg  service: service to stop while copying
+        @type service: str
+        @arg  background: compress in a background process?
+        @type background: bool
+
+        """
+        snapshot_folder = take_snapshot(origin_folder, service)
+        if not snapshot_folder:
+            return
+        if background and os.fork():
+            return
+        # Keep the previous backup until the new one is complete
+        partial_file = output_file + '.part'
+        pipeline = Pipeline(['tar', '-c', os.path.basename(origin_folder)], compressor(),
+                            cwd=snapshot_folder)
+        pipeline.run(partial_file)
+        shutil.rmtree(snapshot_folder)
+        if pipeline.succeeded:
+            os.rename(partial_file, output_file)
+            print "Backed up to %s" % output_file
+        else:
+            os.remove(partial_file)
+            print "Failed backing up to %s" % output_file
+            report_failure(pipeline)
+        if background:
+            os._exit(0 if pipeline.succeeded else 1)
+
+    def perform_incremental_backup(origin_folder, output_folder, service):
+        """Backup only what changed since the last backup of the folder.
+
+        @arg  origin_folder: folder to backup
+        @type origin_folder: str
+        @arg  output_folder: folder where backups are kept
+        @type output_folder: str
+        @arg  service: service to stop, also used in the file names
+        @type service: str
+
+        """
+        os.system("sudo stop %s" % service)
+        try:
+            output_file, pipeline = incremental_backup.backup(origin_folder, output_folder, service)
+        finally:
+            os.system("sudo start %s" % service)
+        if output_file is None:
+            print "Nothing changed in %s" % origin_folder
+        elif not pipeline.succeeded:
+            print "Failed backing up to %s" % output_file
+            report_failure(pipeline)
+        else:
+            print "Backed up to %s" % output_file
+
+    def perform_repository_backup(origin_folder, store, service):
+        """Backup folder into a deduplicating repository.
+
+        The live folder is chunked while the service is stopped: copying it
+        first would write all of it to the SD card on every run (ext4 has no
+        reflinks), while chunking only reads files whose size or mtime
+        changed and only writes new chunks.
+
+        @arg  origin_folder: folder to backup
+        @type origin_folder: str
+        @arg  store: repository
+        @type store: ChunkStore
+        @arg  service: service to stop, also used as snapshot name
+        @type service: str
+
+        """
+        os.system("sudo stop %s" % service)
+        try:
+            stamp, read, written = store.backup(origin_folder, service)
+        finally:
+            os.system("sudo start %s" % service)
+        print "Backed up %s to snapshot %s: %.1f MB read, %.1f MB written" % (
+            origin_folder, stamp, read / 1e6, written / 1e6)
+
     output_folder = os.path.abspath(args.folder)
+    store = ChunkStore(output_folder) if args.repo else None
     for service in args.services:
         backup_file, backup_folder = all_services.get(service, (None, None))
         if backup_file is None:
             print "Unknown service %s" % service
             continue
-        perform_backup(backup_folder, os.path.join(output_folder, backup_file), service)
+        if store:
+            perform_repository_backup(backup_folder, store, service)
+        elif args.incremental:
+            perform_incremental_backup(backup_folder, output_folder, service)
+        elif args.snapshot or args.background:
+            perform_snapshot_backup(backup_folder, os.path.join(output_folder, backup_file),
+                                    service, args.background)
+        else:
+            perform_backup(backup_folder, os.path.join(output_folder, backup_file), service)
 
 def restore_backup(args):
     """Restore backup to  /home/pi/.xbmc.
@@ -63,18 +212,95 @@ def restore_backup(args):
         base_folder, _ = os.path.split(output_folder)
         if service:
             os.system("sudo stop %s" % service)
-        os.system("cd %s && tar -xzf %s" % (base_folder, backup_file))
+        pipeline = Pipeline(['gzip', '-dc', backup_file], ['tar', '-x'], cwd=base_folder)
+        pipeline.run()
         if service:
             os.system("sudo start %s" % service)
+        if not pipeline.succeeded:
+            print "Failed restoring backup from %s" % backup_file
+            report_failure(pipeline)
+            return
         print "Restored backup from %s" % backup_file
 
+    def perform_incremental_restore(backup_folder, output_folder, service, at):
+        """Restore folder from its base backup and deltas.
+
+        @arg  backup_folder: folder where backups are kept
+        @type backup_folder: str
+        @arg  output_folder: folder to restore
+        @type output_folder: str
+        @arg  service: service to stop, also used in the file names
+        @type service: str
+        @arg  at: time to restore (YYYYmmdd[-HHMMSS]), latest if None
+        @type at: str
+
+        """
+        os.system("sudo stop %s" % service)
+        try:
+            failed = incremental_backup.restore(backup_folder, service, output_folder, at)
+        except OSError, error:
+            print error
+            return
+        finally:
+            os.system("sudo start %s" % service)
+        for pipeline in failed:
+            print "Failed restoring %s" % pipeline.commands[0][-1]
+            report_failure(pipeline)
+        if not failed:
+            print "Restored %s as of %s" % (output_folder, at or 'last backup')
+
+    def perform_repository_restore(store, output_folder, service, at):
+        """Restore folder from a snapshot in a deduplicating repository.
+
+        @arg  store: repository
+        @type store: ChunkStore
+        @arg  output_folder: folder to restore
+        @type output_folder: str
+        @arg  service: service to stop, also used as snapshot name
+        @type service: str
+        @arg  at: time to restore (YYYYmmdd[-HHMMSS]), latest if None
+        @type at: str
+
+        """
+        os.system("sudo stop %s" % service)
+        try:
+            stamp = store.restore(service, output_folder, at)
+        except (OSError, IOError), error:
+            print "Failed restoring %s: %s" % (output_folder, error)
+            return
+        finally:
+            os.system("sudo start %s" % service)
+        print "Restored %s from snapshot %s" % (output_folder, stamp)
+
     backup_folder = os.path.abspath(args.folder)
+    store = ChunkStore(backup_folder) if args.repo else None
     for service in args.services:
         service_file, service_folder = all_services.get(service, (None, None))
         if service_file is None:
             print "Unknown service %s" % service
             continue
-        perform_restore(os.path.join(backup_folder, service_file), service_folder, service)
+        if store:
+            perform_repository_restore(store, service_folder, service, args.at)
+        elif args.incremental or args.at:
+            perform_incremental_restore(backup_folder, service_folder, service, args.at)
+        else:
+            perform_restore(os.path.join(backup_folder, service_file), service_folder, service)
+
+def prune_repository(args):
+    """Keep only the last snapshots of the services and remove unused chunks."""
+    store = ChunkStore(os.path.abspath(args.folder))
+    for service in args.services:
+        snapshots, chunks = store.prune(service, args.keep)
+        print "Removed %s snapshots of %s and %s unused chunks" % (snapshots, service, chunks)
+
+def verify_repository(args):
+    """Check that all chunks used by the snapshots are intact."""
+    problems = ChunkStore(os.path.abspath(args.folder)).verify()
+    for problem in problems:
+        print problem
+    if problems:
+        sys.exit(1)
+    print "Repository OK"
 
 all_services = {'xbmc'  : ('backup.xbmc.tar.gz', '/home/pi/.xbmc'),
                 'deluge': ('backup.deluge.tar.gz', '/home/pi/.config/deluge')}
@@ -87,12 +313,29 @@ if __name__ == '__main__':
     backup_parser = subparsers.add_parser("backup")
     backup_parser.add_argument('folder', action='store', type=str, help="Folder to copy the backup file to")
     backup_parser.add_argument('services', action='store', type=str, nargs='+', default=['xbmc', 'deluge'], help="Services to backup")
+    backup_parser.add_argument('--incremental', action='store_true', help="Only backup what changed since the last backup")
+    backup_parser.add_argument('--snapshot', action='store_true', help="Stop services only while taking a snapshot, then compress")
+    backup_parser.add_argument('--background', action='store_true', help="Compress snapshots in the background (implies --snapshot)")
+    backup_parser.add_argument('--repo', action='store_true', help="Folder is a deduplicating repository")
     backup_parser.set_defaults(func=do_backup)
     # Parser for the restore command
     restore_parser = subparsers.add_parser("restore")
     restore_parser.add_argument('folder', action='store', type=str, help="Backup folder to restore from")
     restore_parser.add_argument('services', action='store', type=str, nargs='+', default=['xbmc', 'deluge'], help="Services to restore")
+    restore_parser.add_argument('--incremental', action='store_true', help="Restore from incremental backups")
+    restore_parser.add_argument('--at', action='store', type=str, default=None, help="Restore incremental backups or snapshots as of YYYYmmdd[-HHMMSS]")
+    restore_parser.add_argument('--repo', action='store_true', help="Folder is a deduplicating repository")
     restore_parser.set_defaults(func=restore_backup)
+    # Parser for the prune command
+    prune_parser = subparsers.add_parser("prune")
+    prune_parser.add_argument('folder', action='store', type=str, help="Repository to prune")
+    prune_parser.add_argument('services', action='store', type=str, nargs='+', default=['xbmc', 'deluge'], help="Services to prune")
+    prune_parser.add_argument('--keep', action='store', type=int, default=7, help="Number of snapshots to keep")
+    prune_parser.set_defaults(func=prune_repository)
+    # Parser for the verify command
+    verify_parser = subparsers.add_parser("verify")
+    verify_parser.add_argument('folder', action='store', type=str, help="Repository to verify")
+    verify_parser.set_defaults(func=verify_repository)
     # Parse!
     args = parser.parse_args()
     args.func(args)
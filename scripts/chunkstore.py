@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+# =============================================================================
+# @file   chunkstore.py
+# @author Albert Puig (albert.puig@cern.ch)
+# @date   19.10.2026
+# =============================================================================
+"""Deduplicating backup repository.
+
+Files are split into chunks at content-defined boundaries, so inserting
+data in a file only changes the chunks around it. Every chunk is stored
+once, compressed, under its SHA-1, and each snapshot is a JSON index listing
+the files and their chunks.
+
+To find boundaries without looping over bytes in Python, every byte is
+mapped to one bit with a fixed random table (bytearray.translate) and a
+chunk ends wherever the bits of the last bytes spell a fixed pattern, which
+is searched with bytearray.find.
+
+Repository layout:
+  * chunks/<ab>/<digest>
+  * snapshots/<name>.<stamp>.json
+
+"""
+
+from __future__ import with_statement
+import os
+import json
+import time
+import stat
+import zlib
+import random
+import shutil
+import hashlib
+
+from PickleFile import atomic_write
+from pathnames import decode_path, encode_path
+
+MIN_CHUNK = 64 * 1024
+MAX_CHUNK = 1024 * 1024
+READ_SIZE = 4 * 1024 * 1024
+STAMP_FORMAT = '%Y%m%d-%H%M%S'
+
+# Fixed seed: boundaries must be the same in every run
+_random = random.Random(0x5eed)
+_bits = ['0'] * 128 + ['1'] * 128
+_random.shuffle(_bits)
+BIT_TABLE = ''.join(_bits)
+# 18 bits -> 256 KiB average. Mixed bits, so runs of the same byte never match
+BOUNDARY_PATTERN = '010110100101101001'
+del _random, _bits
+
+
+def find_boundary(marks, start, end):
+    """Find the end of the chunk starting at start.
+
+    @arg  marks: buffer translated with BIT_TABLE
+    @type marks: bytearray
+    @arg  start: position where the chunk starts
+    @type start: int
+    @arg  end: end of the available data
+    @type end: int
+
+    @return: end position of the chunk, None if data ends before finding it
+
+    """
+    if end - start <= MIN_CHUNK:
+        return None
+    limit = min(end, start + MAX_CHUNK)
+    found = marks.find(BOUNDARY_PATTERN, start + MIN_CHUNK - len(BOUNDARY_PATTERN) + 1, limit)
+    if found != -1:
+        return found + len(BOUNDARY_PATTERN)
+    return limit if limit == start + MAX_CHUNK else None
+
+
+def iter_chunks(file_):
+    """Split a file into content-defined chunks.
+
+    @arg  file_: file to read
+    @type file_: file
+
+    @return: iterator over the chunks (str)
+
+    """
+    buffer_ = bytearray()
+    marks = bytearray()
+    eof = False
+    while not eof:
+        block = file_.read(READ_SIZE)
+        eof = not block
+        buffer_.extend(block)
+        marks.extend(block.translate(BIT_TABLE))
+        start = 0
+        while True:
+            boundary = find_boundary(marks, start, len(marks))
+            if boundary is None:
+                break
+            yield str(buffer_[start:boundary])
+            start = boundary
+        del buffer_[:start]
+        del marks[:start]
+    if buffer_:
+        yield str(buffer_)
+
+
+class ChunkStore(object):
+    """Backup repository storing every chunk once."""
+
+    def __init__(self, repository):
+        """Open (and create if needed) the repository.
+
+        @arg  repository: folder of the repository
+        @type repository: str
+
+        """
+        self.repository = repository
+        self.chunks_folder = os.path.join(repository, 'chunks')
+        self.snapshots_folder = os.path.join(repository, 'snapshots')
+        for folder in (self.chunks_folder, self.snapshots_folder):
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+        self._known = None
+
+    def _chunk_path(self, digest):
+        return os.path.join(self.chunks_folder, digest[:2], digest)
+
+    def stored_chunks(self):
+        """Get the digests of all the stored chunks."""
+        if self._known is None:
+            self._known = set()
+            for prefix in os.listdir(self.chunks_folder):
+                self._known.update(os.listdir(os.path.join(self.chunks_folder, prefix)))
+        return self._known
+
+    def put(self, data):
+        """Store a chunk if it's not there yet.
+
+        @return: (digest, bytes written)
+
+        """
+        digest = hashlib.sha1(data).hexdigest()
+        if digest in self.stored_chunks():
+            return digest, 0
+        path = self._chunk_path(digest)
+        if not os.path.exists(os.path.dirname(path)):
+            os.mkdir(os.path.dirname(path))
+        compressed = zlib.compress(data, 6)
+        atomic_write(path, compressed)
+        self._known.add(digest)
+        return digest, len(compressed)
+
+    def get(self, digest):
+        """Read a chunk, checking its contents.
+
+        @raises: IOError: if the chunk is missing or corrupt
+
+        """
+        with open(self._chunk_path(digest), 'rb') as chunk_file:
+            try:
+                data = zlib.decompress(chunk_file.read())
+            except zlib.error, error:
+                raise IOError("Corrupt chunk %s: %s" % (digest, error))
+        if hashlib.sha1(data).hexdigest() != digest:
+            raise IOError("Corrupt chunk %s" % digest)
+        return data
+
+    def list_snapshots(self, name):
+        """Get the stamps of the snapshots of name, oldest first."""
+        prefix, suffix = '%s.' % name, '.json'
+        return sorted(file_name[len(prefix):-len(suffix)]
+                      for file_name in os.listdir(self.snapshots_folder)
+                      if file_name.startswith(prefix) and file_name.endswith(suffix))
+
+    def _snapshot_file(self, name, stamp):
+        return os.path.join(self.snapshots_folder, '%s.%s.json' % (name, stamp))
+
+    def load_snapshot(self, name, stamp):
+        """Load the index of a snapshot."""
+        with open(self._snapshot_file(name, stamp)) as snapshot:
+            return json.load(snapshot)
+
+    def backup(self, origin_folder, name):
+        """Store a snapshot of a folder.
+
+        Files with the same size and mtime as in the previous snapshot reuse
+        its chunks without being read.
+
+        @arg  origin_folder: folder to backup
+        @type origin_folder: str
+        @arg  name: name of the snapshot series
+        @type name: str
+
+        @return: (stamp, bytes read, bytes written)
+
+        """
+        previous = {}
+        stamps = self.list_snapshots(name)
+        if stamps:
+            previous = self.load_snapshot(name, stamps[-1])['files']
+        base_folder = os.path.dirname(origin_folder)
+        files = {}
+        read = written = 0
+        for root, folders, file_names in os.walk(origin_folder):
+            for element in [root] + [os.path.join(root, file_name) for file_name in file_names]:
+                path = decode_path(os.path.relpath(element, base_folder))
+                info = os.lstat(element)
+                entry = {'mode': info.st_mode, 'mtime': info.st_mtime}
+                if stat.S_ISLNK(info.st_mode):
+                    entry['target'] = decode_path(os.readlink(element))
+                elif stat.S_ISREG(info.st_mode):
+                    entry['size'] = info.st_size
+                    old = previous.get(path)
+                    # Restored mtimes can differ in the last microsecond
+                    if (old and old.get('size') == info.st_size and
+                            abs(old['mtime'] - info.st_mtime) < 1e-3):
+                        entry['chunks'] = old['chunks']
+                    else:
+                        entry['chunks'] = []
+                        with open(element, 'rb') as file_:
+                            for data in iter_chunks(file_):
+                                digest, chunk_written = self.put(data)
+                                entry['chunks'].append(digest)
+                                read += len(data)
+                                written += chunk_written
+                files[path] = entry
+            # Symlinks to folders are not followed, store them as links
+            for folder in folders:
+                if os.path.islink(os.path.join(root, folder)):
+                    link = os.path.join(root, folder)
+                    files[decode_path(os.path.relpath(link, base_folder))] = {
+                        'mode': os.lstat(link).st_mode, 'mtime': os.lstat(link).st_mtime,
+                        'target': decode_path(os.readlink(link))}
+        stamp = second = time.strftime(STAMP_FORMAT)
+        # Several snapshots in the same second get a sequence number
+        sequence = 0
+        while os.path.exists(self._snapshot_file(name, stamp)):
+            sequence += 1
+            stamp = '%s.%03d' % (second, sequence)
+        atomic_write(self._snapshot_file(name, stamp),
+                     json.dumps({'origin': origin_folder, 'files': files}))
+        return stamp, read, written
+
+    def restore(self, name, origin_folder, at=None):
+        """Reconstruct a folder from a snapshot.
+
+        The current folder is moved aside to <folder>.before-restore.
+
+        @arg  name: name of the snapshot series
+        @type name: str
+        @arg  origin_folder: folder to restore
+        @type origin_folder: str
+        @arg  at: restore the last snapshot before this stamp (YYYYmmdd or
+            YYYYmmdd-HHMMSS), the latest if None
+        @type at: str
+
+        @return: stamp of the restored snapshot
+
+        @raises: OSError: if there's no suitable snapshot
+        @raises: IOError: if a chunk is missing or corrupt
+
+        """
+        if at and len(at) == 8:
+            at += '-235959'
+        stamps = [stamp for stamp in self.list_snapshots(name) if not at or stamp[:len(at)] <= at]
+        if not stamps:
+            raise OSError("No snapshot of %s to restore" % name)
+        files = self.load_snapshot(name, stamps[-1])['files']
+        base_folder = os.path.dirname(origin_folder)
+        if os.path.exists(origin_folder):
+            aside = origin_folder + '.before-restore'
+            if os.path.exists(aside):
+                shutil.rmtree(aside)
+            os.rename(origin_folder, aside)
+        # Parents go before their contents
+        for path in sorted(files):
+            entry = files[path]
+            target = os.path.join(base_folder, encode_path(path))
+            if stat.S_ISDIR(entry['mode']):
+                os.mkdir(target)
+            elif 'target' in entry:
+                os.symlink(encode_path(entry['target']), target)
+            else:
+                with open(target, 'wb') as file_:
+                    for digest in entry['chunks']:
+                        file_.write(self.get(digest))
+        # Set permissions and times at the end, once folders are filled
+        for path in sorted(files, reverse=True):
+            entry = files[path]
+            if 'target' not in entry:
+                target = os.path.join(base_folder, encode_path(path))
+                os.chmod(target, stat.S_IMODE(entry['mode']))
+                os.utime(target, (entry['mtime'], entry['mtime']))
+        return stamps[-1]
+
+    def _referenced_chunks(self):
+        """Get the chunks used by any snapshot."""
+        referenced = set()
+        for file_name in os.listdir(self.snapshots_folder):
+            with open(os.path.join(self.snapshots_folder, file_name)) as snapshot:
+                for entry in json.load(snapshot)['files'].values():
+                    referenced.update(entry.get('chunks', []))
+        return referenced
+
+    def prune(self, name, keep):
+        """Remove all but the last snapshots of name and the chunks no longer used.
+
+        @arg  name: name of the snapshot series
+        @type name: str
+        @arg  keep: number of snapshots to keep
+        @type keep: int
+
+        @return: (snapshots removed, chunks removed)
+
+        """
+        stamps = self.list_snapshots(name)
+        to_remove = stamps[:max(0, len(stamps) - keep)]
+        for stamp in to_remove:
+            os.remove(self._snapshot_file(name, stamp))
+        unused = self.stored_chunks() - self._referenced_chunks()
+        for digest in unused:
+            os.remove(self._chunk_path(digest))
+        self._known -= unused
+        return len(to_remove), len(unused)
+
+    def verify(self):
+        """Check that all chunks used by the snapshots are there and intact.
+
+        @return: list of problems found
+
+        """
+        problems = []
+        for digest in sorted(self._referenced_chunks()):
+            try:
+                self.get(digest)
+            except IOError, error:
+                problems.append(str(error))
+        return problems
+
+# EOF
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# =============================================================================
+# @file   disk_scheduler.py
+# @author Albert Puig (albert.puig@cern.ch)
+# @date   19.10.2026
+# =============================================================================
+"""Run the jobs that need the USB disk together, in a single spin-up.
+
+Jobs are queued with `submit`, declaring the mount point they need, and
+`run` executes all the queued jobs back to back, grouped by disk. With
+--only-if-active, jobs whose disk is in standby stay queued, so they can
+piggyback on a disk that something else already woke up.
+
+Jobs leave the queue only once they have finished, so a run that is
+interrupted leaves them for the next one. What the scheduler does and the
+output of the jobs go to a log file.
+
+The number of spin-ups and the time spent waiting for the disk are kept in
+a JSON stats file.
+
+"""
+
+from __future__ import with_statement
+import os
+import sys
+import json
+import time
+import fcntl
+import subprocess
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..', 'show_downloader'))
+from RunCommand import run_command_status
+from PickleFile import atomic_write
+
+QUEUE_FILE = os.path.expanduser('~/runtime/disk_jobs.json')
+STATS_FILE = os.path.expanduser('~/runtime/disk_stats.json')
+LOG_FILE = os.path.expanduser('~/runtime/disk_jobs.log')
+# The log is moved to <log>.1 when it gets bigger than this
+MAX_LOG_SIZE = 1024 * 1024
+HDPARM = '/sbin/hdparm'
+STANDBY, ACTIVE, UNKNOWN = 'standby', 'active', 'unknown'
+
+
+@contextmanager
+def locked(lock_file, blocking=True):
+    """Hold an exclusive lock on lock_file.
+
+    @return: True if the lock is held, False if not blocking and somebody else holds it
+
+    """
+    with open(lock_file, 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except IOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def load_json(file_name, default):
+    """Load a JSON file, default if it doesn't exist."""
+    if not os.path.exists(file_name):
+        return default
+    with open(file_name) as json_file:
+        return json.load(json_file)
+
+
+def device_for(path):
+    """Get the device mounted on the longest mount point containing path."""
+    path = os.path.realpath(path)
+    best_mount, best_device = '', None
+    with open('/proc/mounts') as mounts:
+        for line in mounts:
+            device, mount_point = line.split()[:2]
+            if (path == mount_point or path.startswith(mount_point.rstrip('/') + '/')) \
+                    and len(mount_point) > len(best_mount):
+                best_mount, best_device = mount_point, device
+    return best_device
+
+
+def disk_state(device):
+    """Get the power state of the disk with hdparm -C."""
+    try:
+        result = run_command_status('sudo', '-n', HDPARM, '-C', device, timeout=30)
+    except OSError:
+        return UNKNOWN
+    for line in result.output:
+        if 'drive state is' in line:
+            return STANDBY if 'standby' in line or 'sleeping' in line else ACTIVE
+    return UNKNOWN
+
+
+def wake_up(device):
+    """Read the first block of the disk, bypassing the cache.
+
+    @return: time (in s) it took
+
+    """
+    start = time.time()
+    try:
+        run_command_status('sudo', '-n', 'dd', 'if=%s' % device, 'of=/dev/null',
+                           'bs=4096', 'count=1', 'iflag=direct', timeout=120)
+    except OSError:
+        pass  # The job will wake it up anyway
+    return time.time() - start
+
+
+def submit(command, needs=None, queue_file=QUEUE_FILE):
+    """Add a job to the queue.
+
+    @arg  command: command and its arguments
+    @type command: list
+    @arg  needs: mount point the job needs
+    @type needs: str
+    @arg  queue_file: queue
+    @type queue_file: str
+
+    """
+    with locked(queue_file + '.lock'):
+        jobs = load_json(queue_file, [])
+        jobs.append({'command': command, 'needs': needs, 'submitted': time.time()})
+        atomic_write(queue_file, json.dumps(jobs))
+
+
+def pending_jobs(queue_file, keep):
+    """Get the queued jobs, except those for which keep is True."""
+    with locked(queue_file + '.lock'):
+        return [job for job in load_json(queue_file, []) if not keep(job)]
+
+
+def remove_job(queue_file, job):
+    """Remove a finished job from the queue."""
+    with locked(queue_file + '.lock'):
+        jobs = load_json(queue_file, [])
+        if job in jobs:
+            jobs.remove(job)
+            atomic_write(queue_file, json.dumps(jobs))
+
+
+def open_log(log_file):
+    """Open the log to append to it, moving it aside first if it's too big."""
+    if os.path.exists(log_file) and os.path.getsize(log_file) > MAX_LOG_SIZE:
+        os.rename(log_file, log_file + '.1')
+    return open(log_file, 'a')
+
+
+def run(only_if_active=False, queue_file=QUEUE_FILE, stats_file=STATS_FILE, log_file=LOG_FILE):
+    """Run all queued jobs, grouped by disk.
+
+    @arg  only_if_active: leave queued the jobs whose disk is in standby
+    @type only_if_active: bool
+    @arg  log_file: file to log to, together with the output of the jobs
+    @type log_file: str
+
+    @return: list of (job, exit code)
+
+    """
+    with open_log(log_file) as log, \
+            locked(queue_file + '.run.lock', blocking=False) as acquired:
+
+        def note(message):
+            log.write('%s : %s\n' % (time.strftime('%Y-%m-%d %H:%M:%S'), message))
+            log.flush()
+
+        if not acquired:
+            note("Another run is in progress")
+            return []
+        devices = {}
+        states = {}
+
+        def device_of(job):
+            if job['needs'] and job['needs'] not in devices:
+                devices[job['needs']] = device_for(job['needs'])
+            return devices.get(job['needs'])
+
+        def keep(job):
+            device = device_of(job)
+            if not only_if_active or not device:
+                return False
+            if device not in states:
+                states[device] = disk_state(device)
+            return states[device] != ACTIVE
+
+        jobs = pending_jobs(queue_file, keep)
+        stats = load_json(stats_file, {})
+        results = []
+        # Jobs that don't need a disk go first, the rest grouped by disk in submission order
+        jobs.sort(key=lambda job: (device_of(job) or '', job['submitted']))
+        current_device = None
+        for job in jobs:
+            device = device_of(job)
+            if device and device != current_device:
+                current_device = device
+                device_stats = stats.setdefault(device, {'spinups': 0, 'wait_time': 0.0,
+                                                         'batches': 0, 'jobs': 0})
+                device_stats['batches'] += 1
+                if disk_state(device) == STANDBY:
+                    waited = wake_up(device)
+                    device_stats['spinups'] += 1
+                    device_stats['wait_time'] += waited
+                    note("Spun up %s in %.1fs" % (device, waited))
+            if device:
+                stats[device]['jobs'] += 1
+            note("Running %s" % ' '.join(job['command']))
+            start = time.time()
+            try:
+                returncode = subprocess.call(job['command'], stdout=log, stderr=subprocess.STDOUT)
+            except OSError, error:
+                note("Cannot run: %s" % error)
+                returncode = None
+            note("Exit code %s (%.1fs)" % (returncode, time.time() - start))
+            remove_job(queue_file, job)
+            results.append((job, returncode))
+        if jobs:
+            atomic_write(stats_file, json.dumps(stats, indent=2, sort_keys=True))
+        return results
+
+
+def show_stats(stats_file=STATS_FILE):
+    """Print the spin-up statistics."""
+    for device, device_stats in sorted(load_json(stats_file, {}).items()):
+        print "%s: %s spin-ups (%.1fs waiting), %s jobs in %s batches" % (
+            device, device_stats['spinups'], device_stats['wait_time'],
+            device_stats['jobs'], device_stats['batches'])
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--queue', action='store', type=str, default=QUEUE_FILE)
+    parser.add_argument('--stats', action='store', type=str, default=STATS_FILE)
+    parser.add_argument('--log', action='store', type=str, default=LOG_FILE)
+    subparsers = parser.add_subparsers(dest='action')
+    submit_parser = subparsers.add_parser('submit', help="Queue a job")
+    submit_parser.add_argument('--needs', action='store', type=str, default=None,
+                               help="Mount point the job needs")
+    submit_parser.add_argument('job', nargs=argparse.REMAINDER, help="Command to run")
+    run_parser = subparsers.add_parser('run', help="Run the queued jobs")
+    run_parser.add_argument('--only-if-active', action='store_true',
+                            help="Leave queued the jobs whose disk is in standby")
+    subparsers.add_parser('stats', help="Show spin-up statistics")
+    args = parser.parse_args()
+    for file_name in (args.queue, args.stats, args.log):
+        if not os.path.exists(os.path.dirname(file_name)):
+            os.makedirs(os.path.dirname(file_name))
+    if args.action == 'submit':
+        job = args.job[1:] if args.job[:1] == ['--'] else args.job
+        if not job:
+            parser.error("No command to submit")
+        submit(job, args.needs, args.queue)
+    elif args.action == 'run':
+        results = run(args.only_if_active, args.queue, args.stats, args.log)
+        if any(returncode != 0 for _, returncode in results):
+            sys.exit(1)
+    else:
+        show_stats(args.stats)
+
+# EOF
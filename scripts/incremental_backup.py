@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# =============================================================================
+# @file   incremental_backup.py
+# @author Albert Puig (albert.puig@cern.ch)
+# @date   19.10.2026
+# =============================================================================
+"""Incremental backups based on a manifest.
+
+The first backup of a service is a full base archive. Afterwards, only the
+files whose size or modification time changed are hashed, and those whose
+contents really changed go into a dated delta archive, together with the
+list of deleted files. The manifest keeps (size, mtime, hash) for every
+file of the last backup.
+
+Every base gets an id, which its deltas record: if the manifest is lost and
+a new base is made, the deltas of the old one are removed and never replayed
+on top of it. File names that are not valid UTF-8 are escaped with
+pathnames.
+
+Files in the backup folder, for each service:
+  * backup.<service>.base.tar.gz and backup.<service>.base.json (its id)
+  * backup.<service>.manifest.json
+  * backup.<service>.<stamp>.delta.tar.gz and backup.<service>.<stamp>.delta.json
+
+"""
+
+from __future__ import with_statement
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+
+from RunCommand import Pipeline
+from PickleFile import atomic_write
+from pathnames import decode_path, encode_path
+
+BASE_NAME = 'backup.%s.base.tar.gz'
+BASE_INFO_NAME = 'backup.%s.base.json'
+MANIFEST_NAME = 'backup.%s.manifest.json'
+DELTA_NAME = 'backup.%s.%s.delta.tar.gz'
+DELTA_INDEX_NAME = 'backup.%s.%s.delta.json'
+STAMP_FORMAT = '%Y%m%d-%H%M%S'
+
+
+def file_hash(path):
+    """Hash the contents of a file, or the target of a symlink."""
+    if os.path.islink(path):
+        return hashlib.sha1(os.readlink(path)).hexdigest()
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file_:
+        for block in iter(lambda: file_.read(1024 * 1024), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def scan(base_folder, folder_to_backup):
+    """Get size and modification time of all files to backup.
+
+    @return: dict of path relative to base_folder -> (size, mtime)
+
+    """
+    files = {}
+    for root, folders, file_names in os.walk(os.path.join(base_folder, folder_to_backup)):
+        # Symlinks to folders are not followed, so keep them as files
+        for name in file_names + [folder for folder in folders
+                                  if os.path.islink(os.path.join(root, folder))]:
+            path = os.path.join(root, name)
+            stat = os.lstat(path)
+            files[os.path.relpath(path, base_folder)] = (stat.st_size, stat.st_mtime)
+    return files
+
+
+def load_manifest(backup_folder, service):
+    """Load the manifest of the last backup.
+
+    @return: (base id, dict of path -> [size, mtime, hash]), (None, None) if
+        there's no usable manifest
+
+    """
+    manifest_file = os.path.join(backup_folder, MANIFEST_NAME % service)
+    if not os.path.exists(manifest_file):
+        return None, None
+    try:
+        with open(manifest_file) as manifest:
+            data = json.load(manifest)
+        base_id, files = data['base'], data['files']
+    except (ValueError, KeyError, TypeError):
+        # Corrupt, or from before bases had ids
+        return None, None
+    # Paths are compared with the (byte) strings from os.walk
+    return base_id, dict((encode_path(path), value) for path, value in files.items())
+
+
+def save_manifest(backup_folder, service, base_id, manifest):
+    """Save the manifest atomically."""
+    atomic_write(os.path.join(backup_folder, MANIFEST_NAME % service),
+                 json.dumps({'base': base_id,
+                             'files': dict((decode_path(path), value)
+                                           for path, value in manifest.items())}))
+
+
+def load_base_id(backup_folder, service):
+    """Get the id of the base backup, None if unknown."""
+    try:
+        with open(os.path.join(backup_folder, BASE_INFO_NAME % service)) as base_info:
+            return json.load(base_info)['id']
+    except (IOError, ValueError, KeyError, TypeError):
+        return None
+
+
+def _archive(base_folder, paths, output_file, recursive=False):
+    """Archive the given paths, relative to base_folder, with tar | gzip.
+
+    @return: the Pipeline that was run
+
+    """
+    with tempfile.TemporaryFile() as file_list:
+        file_list.write(''.join(path + '\0' for path in paths))
+        file_list.seek(0)
+        tar = ['tar', '-c', '--null', '-T', '-']
+        if not recursive:
+            tar.insert(2, '--no-recursion')
+        pipeline = Pipeline(tar, ['gzip'], cwd=base_folder)
+        pipeline.run(output_file, stdin=file_list)
+    return pipeline
+
+
+def backup(origin_folder, backup_folder, service):
+    """Make a base backup if there's none, otherwise a delta.
+
+    @arg  origin_folder: folder to backup
+    @type origin_folder: str
+    @arg  backup_folder: folder to store the backups in
+    @type backup_folder: str
+    @arg  service: service name, used in file names
+    @type service: str
+
+    @return: (archive written or None if nothing changed, Pipeline or None)
+
+    """
+    base_folder, folder_to_backup = os.path.split(origin_folder)
+    files = scan(base_folder, folder_to_backup)
+    base_id, manifest = load_manifest(backup_folder, service)
+    if manifest is None or base_id != load_base_id(backup_folder, service):
+        # Base backup: everything goes in
+        changed = sorted(files)
+        hashes = {}
+        deleted = []
+        manifest = {}
+        base_id = '%.6f' % time.time()
+        output_file = os.path.join(backup_folder, BASE_NAME % service)
+        index_file = None
+    else:
+        changed = []
+        hashes = {}
+        for path, (size, mtime) in files.items():
+            previous = manifest.get(path)
+            if previous and previous[0] == size and previous[1] == mtime:
+                continue
+            content_hash = file_hash(os.path.join(base_folder, path))
+            if previous and previous[2] == content_hash:
+                # Touched but not modified
+                manifest[path] = [size, mtime, content_hash]
+                continue
+            changed.append(path)
+            hashes[path] = content_hash
+        changed.sort()
+        deleted = sorted(set(manifest) - set(files))
+        if not changed and not deleted:
+            save_manifest(backup_folder, service, base_id, manifest)
+            return None, None
+        stamp = time.strftime(STAMP_FORMAT)
+        output_file = os.path.join(backup_folder, DELTA_NAME % (service, stamp))
+        index_file = os.path.join(backup_folder, DELTA_INDEX_NAME % (service, stamp))
+    # Keep the previous archive until the new one is complete
+    partial_file = output_file + '.part'
+    if index_file:
+        pipeline = _archive(base_folder, changed, partial_file)
+    else:
+        pipeline = _archive(base_folder, [folder_to_backup], partial_file, recursive=True)
+    if not pipeline.succeeded:
+        os.remove(partial_file)
+        return output_file, pipeline
+    os.rename(partial_file, output_file)
+    for path in changed:
+        size, mtime = files[path]
+        content_hash = hashes.get(path) or file_hash(os.path.join(base_folder, path))
+        manifest[path] = [size, mtime, content_hash]
+    for path in deleted:
+        del manifest[path]
+    if index_file:
+        atomic_write(index_file, json.dumps({'base': base_id,
+                                             'changed': [decode_path(path) for path in changed],
+                                             'deleted': [decode_path(path) for path in deleted]}))
+    else:
+        atomic_write(os.path.join(backup_folder, BASE_INFO_NAME % service),
+                     json.dumps({'id': base_id}))
+        # Deltas of previous bases must never be replayed on this one
+        for stamp in _delta_stamps(backup_folder, service):
+            if _delta_base(backup_folder, service, stamp) == base_id:
+                continue
+            for name in (DELTA_NAME, DELTA_INDEX_NAME):
+                path = os.path.join(backup_folder, name % (service, stamp))
+                if os.path.exists(path):
+                    os.remove(path)
+    save_manifest(backup_folder, service, base_id, manifest)
+    return output_file, pipeline
+
+
+def _delta_base(backup_folder, service, stamp):
+    """Get the base id a delta was made on, None if unknown."""
+    try:
+        with open(os.path.join(backup_folder, DELTA_INDEX_NAME % (service, stamp))) as index:
+            return json.load(index).get('base')
+    except (IOError, ValueError, AttributeError):
+        return None
+
+
+def _delta_stamps(backup_folder, service):
+    """Get the stamps of all delta indexes, oldest first."""
+    prefix, suffix = (DELTA_INDEX_NAME % (service, '*')).split('*')
+    return sorted(name[len(prefix):-len(suffix)] for name in os.listdir(backup_folder)
+                  if name.startswith(prefix) and name.endswith(suffix))
+
+
+def list_deltas(backup_folder, service):
+    """Get the stamps of the deltas of the current base, oldest first."""
+    base_id = load_base_id(backup_folder, service)
+    if base_id is None:
+        return []
+    return [stamp for stamp in _delta_stamps(backup_folder, service)
+            if _delta_base(backup_folder, service, stamp) == base_id]
+
+
+def restore(backup_folder, service, origin_folder, at=None):
+    """Reconstruct the folder as it was at the given time.
+
+    The current folder is moved aside to <folder>.before-restore.
+
+    @arg  backup_folder: folder with the backups
+    @type backup_folder: str
+    @arg  service: service name, used in file names
+    @type service: str
+    @arg  origin_folder: folder to restore
+    @type origin_folder: str
+    @arg  at: stamp (YYYYmmdd or YYYYmmdd-HHMMSS) to restore, latest if None
+    @type at: str
+
+    @return: list of failed Pipelines (empty on success)
+
+    @raises: OSError: if there's no base backup
+
+    """
+    base_archive = os.path.join(backup_folder, BASE_NAME % service)
+    if not os.path.exists(base_archive):
+        raise OSError("Cannot find base backup %s" % base_archive)
+    if at and len(at) == 8:
+        at += '-235959'
+    base_folder = os.path.dirname(origin_folder)
+    if os.path.exists(origin_folder):
+        aside = origin_folder + '.before-restore'
+        if os.path.exists(aside):
+            shutil.rmtree(aside)
+        os.rename(origin_folder, aside)
+    failed = []
+    archives = [(base_archive, [])]
+    for stamp in list_deltas(backup_folder, service):
+        if at and stamp > at:
+            break
+        with open(os.path.join(backup_folder, DELTA_INDEX_NAME % (service, stamp))) as index:
+            deleted = [encode_path(path) for path in json.load(index)['deleted']]
+        archives.append((os.path.join(backup_folder, DELTA_NAME % (service, stamp)), deleted))
+    for archive, deleted in archives:
+        pipeline = Pipeline(['gzip', '-dc', archive], ['tar', '-x'], cwd=base_folder)
+        pipeline.run()
+        if not pipeline.succeeded:
+            failed.append(pipeline)
+        for path in deleted:
+            path = os.path.join(base_folder, path)
+            if os.path.lexists(path):
+                os.remove(path)
+    return failed
+
+# EOF
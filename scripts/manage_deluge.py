@@ -4,43 +4,29 @@
 # @author Albert Puig (albert.puig@epfl.ch)
 # @date   09.02.2014
 # =============================================================================
-""""""
+"""Pause and resume all deluge torrents."""
 
-from deluge.log import setupLogger
-setupLogger()
+import os
+import sys
 
-from deluge.ui.client import client
-from twisted.internet import reactor
-from deluge.log import setupLogger
-setupLogger()
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..', 'show_downloader'))
+from delugerpc import get_client, DelugeRPCError
 
 def pause():
-    def pause_all_torrents():
-        return client.core.pause_all_torrents()
     print "Telling Deluge to pause all torrents."
-    tell_deluge_to(pause_all_torrents)
+    tell_deluge_to(lambda client: client.pause())
 
 def resume():
-    def resume_all_torrents():
-        return client.core.resume_all_torrents()
     print "Telling Deluge to resume all torrents."
-    tell_deluge_to(resume_all_torrents)
+    tell_deluge_to(lambda client: client.resume())
 
 
 def tell_deluge_to(act):
-    def on_connect_success(result):
-        def disconnect(result):
-            client.disconnect()
-            reactor.crash()
-        act().addCallback(disconnect)
-
-    def on_connect_fail(result):
-        print "Connection failed!"
-
-    d = client.connect()
-    d.addCallback(on_connect_success)
-    d.addErrback(on_connect_fail)
-    reactor.run()
+    try:
+        act(get_client())
+    except (IOError, DelugeRPCError), error:
+        print "Connection failed! -> %s" % error
 
 if __name__ == '__main__':
     import argparse
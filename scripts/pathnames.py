@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# =============================================================================
+# @file   pathnames.py
+# @author Albert Puig (albert.puig@cern.ch)
+# @date   19.10.2026
+# =============================================================================
+"""Store file names of any encoding in JSON.
+
+Names are decoded as UTF-8, and bytes that are not valid UTF-8 are kept as
+the lone surrogates U+DC80 to U+DCFF, like Python 3's surrogateescape, so
+they can be encoded back to the original bytes.
+
+"""
+
+import re
+import codecs
+
+_re_escaped = re.compile(u'([\udc80-\udcff])')
+# Python 2 decodes UTF-8 encoded surrogates, which are invalid UTF-8
+_re_encoded_surrogate = re.compile(r'(\xed[\xa0-\xbf][\x80-\xbf])')
+
+
+def _escape_bytes(data):
+    return u''.join(unichr(0xdc00 + ord(byte)) for byte in data)
+
+
+def _escape(error):
+    return _escape_bytes(error.object[error.start:error.end]), error.end
+
+codecs.register_error('pathnames-escape', _escape)
+
+
+def decode_path(path):
+    """Convert a file name (bytes) to unicode, escaping invalid UTF-8."""
+    return u''.join(_escape_bytes(part) if index % 2 else part.decode('utf-8', 'pathnames-escape')
+                    for index, part in enumerate(_re_encoded_surrogate.split(path)))
+
+
+def encode_path(name):
+    """Convert a name from decode_path back to the original bytes."""
+    return ''.join(chr(ord(part) - 0xdc00) if index % 2 else part.encode('utf-8')
+                   for index, part in enumerate(_re_escaped.split(name)))
+
+# EOF
@@ -5,51 +5,271 @@
 # @author Albert Puig (albert.puig@cern.ch)
 # @date   02.11.2014
 # =============================================================================
-"""Measure the Raspberry Pi temperature."""
+"""Measure the Raspberry Pi temperature.
+
+Samples are kept in a fixed-size file, mapped in memory, with three ring
+buffers: raw samples, 1-minute aggregates and 1-hour aggregates. Every
+record is (timestamp, min, max, sum, count), so a raw sample is just an
+aggregate of one; the current minute and hour records are updated in place
+as samples arrive.
+
+"""
 
 from __future__ import with_statement
 import os
-import cPickle
-import subprocess
+import mmap
+import time
+import struct
+
+DATAFILE = os.path.expanduser('~/runtime/temps.ring')
+THERMAL_ZONE = '/sys/class/thermal/thermal_zone0/temp'
 
+MAGIC = 'TMP1'
+RECORD = struct.Struct('<dffdI')
+# Decimals kept from min and max, stored as float32 (the sensor gives milli-degrees)
+DECIMALS = 3
+# (name, bucket size in s, capacity): 1 day of 5s samples, 1 week of minutes, 1 year of hours
+RESOLUTIONS = [('raw', None, 17280),
+               ('minute', 60, 10080),
+               ('hour', 3600, 8760)]
+# Per ring: capacity, next position to write, number of records
+RING_HEADER = struct.Struct('<III')
+HEADER_SIZE = len(MAGIC) + RING_HEADER.size * len(RESOLUTIONS)
 
-DATAFILE = 'temps.dat'
 
 def get_temp():
-    output = [line for line in subprocess.Popen(['/opt/vc/bin/vcgencmd', 'measure_temp'],
-                                                stdout=subprocess.PIPE,
-                                                stderr=subprocess.STDOUT).communicate()[0].split('\n') if line]
-    if len(output) != 1:
-        return 0.0
-    output = output[0]
-    return float((output.split('=')[1]).split("'")[0])
+    """Read the SoC temperature in ºC, None if not available."""
+    try:
+        with open(THERMAL_ZONE) as zone:
+            return int(zone.read()) / 1000.0
+    except (IOError, ValueError):
+        return None
+
+
+class Ring(object):
+    """Ring buffer of records inside the mapped file."""
+
+    def __init__(self, data, header_offset, offset, bucket):
+        self._data = data
+        self._header_offset = header_offset
+        self.offset = offset
+        self.bucket = bucket
+        self.capacity, self.head, self.count = RING_HEADER.unpack_from(data, header_offset)
+
+    def _write_header(self):
+        RING_HEADER.pack_into(self._data, self._header_offset,
+                              self.capacity, self.head, self.count)
+
+    def _position(self, index):
+        """Offset of the index-th newest record (0 is the newest)."""
+        return self.offset + RECORD.size * ((self.head - 1 - index) % self.capacity)
+
+    def _record(self, index):
+        """Get the index-th newest record, without float32 noise."""
+        timestamp, minimum, maximum, total, count = RECORD.unpack_from(self._data,
+                                                                       self._position(index))
+        return timestamp, round(minimum, DECIMALS), round(maximum, DECIMALS), total, count
+
+    @property
+    def wrapped(self):
+        """Have the oldest records been overwritten?"""
+        return self.count == self.capacity
+
+    def newest(self):
+        """Get the newest record, None if empty."""
+        if not self.count:
+            return None
+        return self._record(0)
+
+    def add(self, timestamp, value):
+        """Add a value, merging it into the newest record if in the same bucket."""
+        if self.bucket:
+            timestamp = timestamp - timestamp % self.bucket
+            newest = self.newest()
+            if newest and newest[0] == timestamp:
+                _, minimum, maximum, total, count = newest
+                RECORD.pack_into(self._data, self._position(0), timestamp,
+                                 min(minimum, value), max(maximum, value),
+                                 total + value, count + 1)
+                return
+        RECORD.pack_into(self._data, self.offset + RECORD.size * self.head,
+                         timestamp, value, value, value, 1)
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        self._write_header()
+
+    def since(self, start):
+        """Get the records with timestamp >= start, newest first."""
+        records = []
+        for index in xrange(self.count):
+            record = self._record(index)
+            if record[0] < start:
+                break
+            records.append(record)
+        return records
+
+    def oldest_timestamp(self):
+        """Timestamp of the oldest record, None if empty."""
+        if not self.count:
+            return None
+        return self._record(self.count - 1)[0]
+
+
+class TemperatureStore(object):
+    """Multi-resolution temperature history."""
+
+    def __init__(self, data_file=DATAFILE):
+        """Open the data file, creating it if needed.
+
+        @arg  data_file: file to store the samples in
+        @type data_file: str
+
+        """
+        if not os.path.exists(data_file):
+            self._create(data_file)
+        self._file = open(data_file, 'r+b')
+        self._data = mmap.mmap(self._file.fileno(), 0)
+        if self._data[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s is not a temperature file" % data_file)
+        self.rings = {}
+        offset = HEADER_SIZE
+        for position, (name, bucket, _) in enumerate(RESOLUTIONS):
+            ring = Ring(self._data, len(MAGIC) + RING_HEADER.size * position, offset, bucket)
+            self.rings[name] = ring
+            offset += ring.capacity * RECORD.size
+
+    @staticmethod
+    def _create(data_file):
+        folder = os.path.dirname(data_file)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        with open(data_file, 'wb') as file_:
+            file_.write(MAGIC)
+            for _, _, capacity in RESOLUTIONS:
+                file_.write(RING_HEADER.pack(capacity, 0, 0))
+            file_.truncate(HEADER_SIZE + RECORD.size * sum(capacity
+                                                           for _, _, capacity in RESOLUTIONS))
+
+    def close(self):
+        """Flush and close the file."""
+        self._data.flush()
+        self._data.close()
+        self._file.close()
+
+    def add(self, value, timestamp=None):
+        """Store a sample in all resolutions.
+
+        @arg  value: temperature
+        @type value: float
+        @arg  timestamp: time of the sample, now if None
+        @type timestamp: float
+
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        for name, _, _ in RESOLUTIONS:
+            self.rings[name].add(timestamp, value)
+
+    def records(self, window, now=None):
+        """Get the records covering the window at the finest resolution available.
+
+        That's the finest ring that goes back to the window start, or that
+        still has all its samples if the store is younger than the window.
+
+        @arg  window: length of the window (in s) before now
+        @type window: float
+
+        @return: (resolution name, list of records)
+
+        """
+        start = (now or time.time()) - window
+        for name, bucket, _ in RESOLUTIONS:
+            ring = self.rings[name]
+            oldest = ring.oldest_timestamp()
+            if oldest is not None and (oldest <= start or not ring.wrapped):
+                break
+        if bucket:
+            # Include the bucket the window starts in
+            start -= start % bucket
+        return name, self.rings[name].since(start)
+
+    def stats(self, window, percentiles=(50, 95), now=None):
+        """Get min, max, mean and percentiles over a window.
+
+        Percentiles are exact with raw samples. With aggregates, they are
+        computed from the bucket means weighted by their number of samples.
+
+        @arg  window: length of the window (in s) before now
+        @type window: float
+        @arg  percentiles: percentiles to compute
+        @type percentiles: list
+
+        @return: dict, None if there are no samples in the window
 
+        """
+        resolution, records = self.records(window, now)
+        if not records:
+            return None
+        count = sum(record[4] for record in records)
+        result = {'resolution': resolution,
+                  'samples': count,
+                  'min': min(record[1] for record in records),
+                  'max': max(record[2] for record in records),
+                  'mean': sum(record[3] for record in records) / count}
+        values = sorted((record[3] / record[4], record[4]) for record in records)
+        for percentile in percentiles:
+            rank = percentile / 100.0 * count
+            seen = 0
+            for value, weight in values:
+                seen += weight
+                if seen >= rank:
+                    break
+            result['p%s' % percentile] = value
+        return result
 
-def get_data():
-    if not os.path.exists(DATAFILE):
-        return None, None, None, None
-    with open(DATAFILE) as f:
-        temp_sum, temp_max, temp_min, n_measures = cPickle.load(f)
-    return temp_sum, temp_max, temp_min, n_measures
 
+def parse_window(window):
+    """Convert 30s, 15m, 2h or 7d to seconds."""
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    if window[-1] in units:
+        return float(window[:-1]) * units[window[-1]]
+    return float(window)
 
-def save_data(temp_sum, temp_max, temp_min, n_measures):
-    with open(DATAFILE, 'w') as f:
-        cPickle.dump((temp_sum, temp_max, temp_min, n_measures), f)
 
 if __name__ == '__main__':
-    temp_sum, temp_max, temp_min, n_measures= get_data()
-    if not temp_sum:
-        temp_sum = 0.0
-        temp_max = 0.0
-        temp_min = 100.0
-        n_measures = 0
-    temperature = get_temp()
-    if temperature:
-        temp_sum += temperature
-        temp_max = max(temp_max, temperature)
-        temp_min = min(temp_min, temperature)
-        n_measures += 1
-    save_data(temp_sum, temp_max, temp_min, n_measures)
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', action='store', type=str, default=DATAFILE,
+                        help="File to store the samples in")
+    subparsers = parser.add_subparsers(dest='command')
+    sample_parser = subparsers.add_parser('sample', help="Store the current temperature")
+    sample_parser.add_argument('--every', action='store', type=float, default=None,
+                               help="Keep sampling every so many seconds")
+    stats_parser = subparsers.add_parser('stats', help="Show temperature statistics")
+    stats_parser.add_argument('--window', action='store', type=str, default='1d',
+                              help="Window to summarize (e.g. 30s, 15m, 2h, 7d)")
+    args = parser.parse_args()
+    store = TemperatureStore(args.data)
+    try:
+        if args.command == 'sample':
+            while True:
+                temperature = get_temp()
+                if temperature is not None:
+                    store.add(temperature)
+                if not args.every:
+                    break
+                time.sleep(args.every)
+        else:
+            stats = store.stats(parse_window(args.window))
+            if not stats:
+                print "No samples in the last %s" % args.window
+            else:
+                print "Last %s (%s samples, %s resolution)" % (args.window,
+                                                              stats['samples'],
+                                                              stats['resolution'])
+                for key in ('min', 'max', 'mean', 'p50', 'p95'):
+                    print "  %-4s %.1f ºC" % (key, stats[key])
+    finally:
+        store.close()
 
 # EOF
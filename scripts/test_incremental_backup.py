@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# =============================================================================
+# @file   test_incremental_backup.py
+# @author Albert Puig (albert.puig@cern.ch)
+# @date   19.10.2026
+# =============================================================================
+"""Check the incremental backups.
+
+    $ python test_incremental_backup.py
+
+"""
+
+from __future__ import with_statement
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..', 'show_downloader'))
+import incremental_backup
+from incremental_backup import MANIFEST_NAME
+
+SERVICE = 'test'
+LATIN1_NAME = 'caf\xe9.txt'
+
+
+class IncrementalBackupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.origin = os.path.join(self.folder, 'data')
+        self.backups = os.path.join(self.folder, 'backups')
+        os.mkdir(self.origin)
+        os.mkdir(self.backups)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write(self, name, contents):
+        with open(os.path.join(self.origin, name), 'w') as file_:
+            file_.write(contents)
+
+    def backup(self):
+        output_file, pipeline = incremental_backup.backup(self.origin, self.backups, SERVICE)
+        self.assertTrue(pipeline is None or pipeline.succeeded)
+        return output_file
+
+    def restore(self):
+        self.assertEqual(incremental_backup.restore(self.backups, SERVICE, self.origin), [])
+        contents = {}
+        for name in os.listdir(self.origin):
+            with open(os.path.join(self.origin, name)) as file_:
+                contents[name] = file_.read()
+        return contents
+
+    def test_delta(self):
+        self.write('kept', 'kept')
+        self.write('removed', 'removed')
+        self.backup()
+        os.remove(os.path.join(self.origin, 'removed'))
+        self.write('added', 'added')
+        self.assertNotEqual(self.backup(), None)
+        self.assertEqual(len(incremental_backup.list_deltas(self.backups, SERVICE)), 1)
+        self.assertEqual(self.restore(), {'kept': 'kept', 'added': 'added'})
+
+    def test_lost_manifest(self):
+        self.write('kept', 'kept')
+        self.write('removed', 'removed')
+        self.backup()
+        os.remove(os.path.join(self.origin, 'removed'))
+        self.write('kept', 'modified')
+        self.backup()
+        # A new base is made, and the delta of the old one must not be replayed
+        os.remove(os.path.join(self.backups, MANIFEST_NAME % SERVICE))
+        self.write('added', 'added')
+        self.backup()
+        self.assertEqual(incremental_backup.list_deltas(self.backups, SERVICE), [])
+        self.assertFalse([name for name in os.listdir(self.backups) if 'delta' in name])
+        self.write('kept', 'back to the start')
+        self.backup()
+        self.assertEqual(self.restore(), {'kept': 'back to the start', 'added': 'added'})
+
+    def test_corrupt_manifest(self):
+        self.write('kept', 'kept')
+        self.backup()
+        with open(os.path.join(self.backups, MANIFEST_NAME % SERVICE), 'w') as manifest:
+            manifest.write('{"base": ')
+        self.write('added', 'added')
+        self.backup()
+        self.assertEqual(self.restore(), {'kept': 'kept', 'added': 'added'})
+
+    def test_non_utf8_names(self):
+        self.write(LATIN1_NAME, 'latin-1')
+        self.write('removed', 'removed')
+        self.backup()
+        os.remove(os.path.join(self.origin, 'removed'))
+        self.write(LATIN1_NAME, 'changed')
+        self.backup()
+        # Unchanged files are recognized with the saved manifest
+        self.assertEqual(self.backup(), None)
+        self.assertEqual(self.restore(), {LATIN1_NAME: 'changed'})
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# EOF
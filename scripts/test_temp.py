@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# =============================================================================
+# @file   test_temp.py
+# @author Albert Puig (albert.puig@cern.ch)
+# @date   19.10.2026
+# =============================================================================
+"""Check the temperature store.
+
+    $ python test_temp.py
+
+"""
+
+from __future__ import with_statement
+import os
+import shutil
+import tempfile
+import unittest
+
+from temp import TemperatureStore
+
+NOW = 1500000000.0
+
+
+class TemperatureStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.store = TemperatureStore(os.path.join(self.folder, 'temps.ring'))
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.folder)
+
+    def fill(self, duration, step=5):
+        """Add samples going up from 40 to 50 degrees, ending at NOW."""
+        samples = int(duration / step)
+        values = [40.0 + 10.0 * index / samples for index in range(samples)]
+        for index, value in enumerate(values):
+            self.store.add(value, NOW - (samples - index) * step)
+        return sorted(values)
+
+    def test_store_younger_than_window(self):
+        values = self.fill(3600)
+        stats = self.store.stats(86400, now=NOW)
+        self.assertEqual(stats['resolution'], 'raw')
+        self.assertEqual(stats['samples'], len(values))
+        self.assertEqual(stats['p95'], values[int(0.95 * len(values)) - 1])
+
+    def test_coarser_ring_once_raw_wrapped(self):
+        self.fill(2 * 86400)
+        self.assertEqual(self.store.stats(3600, now=NOW)['resolution'], 'raw')
+        self.assertEqual(self.store.stats(1.5 * 86400, now=NOW)['resolution'], 'minute')
+
+    def test_no_float32_noise(self):
+        self.store.add(49.9, NOW)
+        stats = self.store.stats(60, now=NOW + 1)
+        self.assertEqual((stats['min'], stats['max'], stats['p50']), (49.9, 49.9, 49.9))
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# EOF
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# =============================================================================
+# @file   throttle_deluge.py
+# @author Albert Puig (albert.puig@cern.ch)
+# @date   19.10.2026
+# =============================================================================
+"""Adapt deluge speed to what the media center is doing.
+
+Every few seconds the media center is asked whether it's playing a video
+and from where, and a profile of rate and active torrent limits is chosen
+from that and the time of day. The deluge configuration is only changed
+when the profile changes.
+
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..', 'show_downloader'))
+from delugerpc import get_client, DelugeRPCError
+
+XBMC_URL = 'http://localhost:8080/jsonrpc'
+MEDIA_DISK = '/media/RaspiHD'
+# Hours in which the upload is limited to leave room for the rest of the network
+DAY_HOURS = (8, 24)
+
+# Rates in KiB/s, -1 is unlimited
+PROFILES = {'playing_from_disk': {'max_download_speed': 150.0,
+                                  'max_upload_speed': 20.0,
+                                  'max_active_limit': 2,
+                                  'max_active_downloading': 1},
+            'playing': {'max_download_speed': 1000.0,
+                        'max_upload_speed': 50.0,
+                        'max_active_limit': 4,
+                        'max_active_downloading': 2},
+            'day': {'max_download_speed': -1.0,
+                    'max_upload_speed': 100.0,
+                    'max_active_limit': 8,
+                    'max_active_downloading': 3},
+            'night': {'max_download_speed': -1.0,
+                      'max_upload_speed': -1.0,
+                      'max_active_limit': 8,
+                      'max_active_downloading': 3}}
+
+
+def playing_files(xbmc):
+    """Get the files of the videos being played.
+
+    @arg  xbmc: media center client
+    @type xbmc: xbmcjson.XBMC
+
+    @return: list of file names ('' if unknown)
+
+    """
+    files = []
+    for player in xbmc.Player.GetActivePlayers().get('result', []):
+        if player.get('type') != 'video':
+            continue
+        item = xbmc.Player.GetItem(playerid=player['playerid'], properties=['file'])
+        files.append(item.get('result', {}).get('item', {}).get('file', ''))
+    return files
+
+
+def choose_profile(files, hour):
+    """Choose the profile for the current situation.
+
+    @arg  files: files being played
+    @type files: list
+    @arg  hour: current hour
+    @type hour: int
+
+    @return: name of the profile
+
+    """
+    if any(file_name.startswith(MEDIA_DISK) for file_name in files):
+        return 'playing_from_disk'
+    if files:
+        return 'playing'
+    if DAY_HOURS[0] <= hour < DAY_HOURS[1]:
+        return 'day'
+    return 'night'
+
+
+def apply_profile(name):
+    """Set the deluge limits of a profile.
+
+    @return: was it applied?
+
+    """
+    try:
+        get_client().call('core.set_config', PROFILES[name])
+    except (IOError, DelugeRPCError), error:
+        print "Cannot set profile %s -> %s" % (name, error)
+        return False
+    return True
+
+
+def throttle(interval=10, once=False):
+    """Poll the media center and apply the right profile when it changes.
+
+    @arg  interval: time (in s) between polls
+    @type interval: float
+    @arg  once: only poll once
+    @type once: bool
+
+    """
+    from xbmcjson import XBMC
+    xbmc = XBMC(XBMC_URL)
+    current = None
+    while True:
+        try:
+            files = playing_files(xbmc)
+        except Exception:
+            # Media center not running or not answering: nothing plays
+            files = []
+        profile = choose_profile(files, time.localtime().tm_hour)
+        if profile != current:
+            if apply_profile(profile):
+                print "%s: switched to %s" % (time.strftime('%Y-%m-%d %H:%M:%S'), profile)
+                current = profile
+        if once:
+            break
+        time.sleep(interval)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--interval', action='store', type=float, default=10,
+                        help="Seconds between polls of the media center")
+    parser.add_argument('--once', action='store_true', help="Poll only once")
+    args = parser.parse_args()
+    throttle(args.interval, args.once)
+
+# EOF
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# =============================================================================
+# @file   AsyncRunCommand.py
+# @author Albert Puig (albert.puig@cern.ch)
+# @date   19.10.2026
+# =============================================================================
+"""asyncio version of RunCommand.
+
+Python 3 only, for tools running inside an event loop.
+
+"""
+
+import os
+import signal
+import asyncio
+
+from RunCommand import CommandResult
+
+
+def _kill_process_group(process):
+    """Kill the process and all its children."""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass  # Already finished
+
+
+async def iter_command(cmd, *args, timeout=None):
+    """Iterate over the output lines of the given command while it runs.
+
+    Empty lines are skipped and the command is killed, together with its
+    children, after timeout seconds.
+
+    """
+    process = await asyncio.create_subprocess_exec(cmd, *args,
+                                                   stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.STDOUT,
+                                                   start_new_session=True)
+    loop = asyncio.get_running_loop()
+    timer = loop.call_later(timeout, _kill_process_group, process) if timeout is not None else None
+    try:
+        async for line in process.stdout:
+            line = line.rstrip(b'\n')
+            if line:
+                yield line
+    finally:
+        await process.wait()
+        if timer:
+            timer.cancel()
+
+
+async def run_command_status(cmd, *args, timeout=None):
+    """Run given command with args, keeping its exit code.
+
+    @return: CommandResult
+
+    """
+    process = await asyncio.create_subprocess_exec(cmd, *args,
+                                                   stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.STDOUT,
+                                                   start_new_session=True)
+    timed_out = False
+    try:
+        output, _ = await asyncio.wait_for(process.communicate(), timeout)
+    except asyncio.TimeoutError:
+        timed_out = True
+        _kill_process_group(process)
+        output, _ = await process.communicate()
+    return CommandResult([cmd] + list(args), process.returncode,
+                         [line for line in output.split(b'\n') if line], timed_out)
+
+
+async def run_commands(commands, max_concurrency=4, timeout=None):
+    """Run several commands concurrently, at most max_concurrency at a time.
+
+    @arg  commands: commands to run, each of them a list with the command
+        and its arguments
+    @type commands: list
+
+    @return: list of CommandResult, in the same order as the commands
+
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run_one(command):
+        async with semaphore:
+            return await run_command_status(*command, timeout=timeout)
+
+    return await asyncio.gather(*[run_one(command) for command in commands])
+
+# EOF
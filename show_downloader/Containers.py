@@ -8,7 +8,8 @@
   * Dictionary with case-insensitive keys (CaseInsensitiveDict).
   * Dictionary where keys have a definite timespan (TimedDict and the locking
     TimedLockingDict) and a list
-  * Dictionary with a limited number of items (Limitedlist).
+  * Dictionary with a limited number of items, dropping the least recently
+    used ones (LimitedDict).
 
 """
 
@@ -273,4 +274,74 @@ class TimedLockingDict(TimedDict):
         if key in self._dict:
             self._dict[key]['lock'].release()
 
+
+class LimitedDict(object):
+    """Dictionary-like class with a maximum number of items.
+
+    When the limit is reached, the least recently used key is dropped, so it
+    can be used as a bounded memoization cache.
+
+    """
+    def __init__(self, max_size):
+        """Initialize internal ordered dictionary and size limit.
+
+        @param max_size: maximum number of keys to keep
+        @type max_size: int
+
+        """
+        self._dict = collections.OrderedDict()
+        self.max_size = max_size
+
+    def __contains__(self, key):
+        """Check if key is in the internal dictionary."""
+        return key in self._dict
+
+    def __iter__(self):
+        """Return internal dictionary iterator."""
+        return self._dict.__iter__()
+
+    def __len__(self):
+        """Return length of internal dictionary."""
+        return len(self._dict)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, dict(self._dict.items()))
+
+    def add(self, key, value):
+        """Add a key to the internal dictionary, dropping the oldest one if needed.
+
+        @param key: key to add
+        @type key: object
+        @param value: value associated to the key
+        @type value: object
+
+        """
+        if key in self._dict:
+            del self._dict[key]
+        elif len(self._dict) >= self.max_size:
+            self._dict.popitem(last=False)
+        self._dict[key] = value
+
+    def get(self, key, default=None):
+        """Get a key from the internal dictionary, marking it as recently used.
+
+        @param key: key to return
+        @type key: object
+        @param default: value to return if the key is not present
+        @type default: object
+
+        @return: value associated to the key or default
+
+        """
+        try:
+            value = self._dict.pop(key)
+        except KeyError:
+            return default
+        self._dict[key] = value
+        return value
+
+    def clear(self):
+        """Clear the internal dictionary."""
+        self._dict.clear()
+
 # EOF
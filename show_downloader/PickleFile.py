@@ -1,5 +1,7 @@
 from __future__ import with_statement
 import os
+import errno
+import binascii
 
 import cPickle
 
@@ -10,7 +12,40 @@ def load(filename):
     decoded = cPickle.load(f)
   return decoded
 
-def write(filename, obj):  
-  with open(filename, 'w') as f:
-    cPickle.dump(obj, f)
+def write(filename, obj):
+  atomic_write(filename, cPickle.dumps(obj))
+
+def _create_temp(filename):
+  """Create a temporary file next to filename.
+
+  Like open(), it's created as 0666 and the kernel applies the umask, which
+  can't be read without changing it for all threads.
+
+  @return: (file descriptor, name)
+
+  """
+  folder = os.path.dirname(os.path.abspath(filename))
+  while True:
+    temp_name = os.path.join(folder, '.%s.%s' % (os.path.basename(filename),
+                                                 binascii.hexlify(os.urandom(6))))
+    try:
+      return os.open(temp_name, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666), temp_name
+    except OSError, error:
+      if error.errno != errno.EEXIST:
+        raise
+
+def atomic_write(filename, data):
+  """Write data so that filename has either the old or the new contents, even on crashes."""
+  temp_fd, temp_name = _create_temp(filename)
+  try:
+    with os.fdopen(temp_fd, 'wb') as f:
+      f.write(data)
+      f.flush()
+      os.fsync(f.fileno())
+    if os.path.exists(filename):
+      os.chmod(temp_name, os.stat(filename).st_mode & 0777)
+    os.rename(temp_name, filename)
+  except Exception:
+    os.remove(temp_name)
+    raise
 
@@ -7,21 +7,325 @@
 """
 """
 
+from __future__ import with_statement
+
 __author__ = "Albert Puig (albert.puig@cern.ch)"
 
-def run_command(cmd, *args):
+import os
+import time
+import signal
+import threading
+import subprocess
+from collections import namedtuple
+
+CommandResult = namedtuple('CommandResult', 'command returncode output timed_out')
+
+
+def _new_process_group():
+    """Run the child in its own process group, with the default SIGPIPE handling."""
+    os.setsid()
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+
+def _kill_process_group(process):
+    """Kill the process and all its children."""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        pass  # Already finished
+
+
+class StreamingCommand(object):
+    """Run a command, iterating over its output lines as they are produced.
+
+    Standard error is merged into standard output and empty lines are
+    skipped. The command runs in its own process group, so it can be killed
+    together with its children when it times out. Once the iteration
+    finishes, `returncode` and `timed_out` are set.
+
+    """
+    def __init__(self, cmd, args=None, timeout=None):
+        """Start the command.
+
+        @arg  cmd: command to execute
+        @type cmd: string
+        @arg  args: arguments of the command
+        @type args: list
+        @arg  timeout: time (in s) after which the command is killed
+        @type timeout: float
+
+        """
+        self.command = [cmd] + list(args or [])
+        self.returncode = None
+        self.timed_out = False
+        self._process = subprocess.Popen(self.command,
+                                         stdout=subprocess.PIPE,
+                                         stderr=subprocess.STDOUT,
+                                         preexec_fn=_new_process_group)
+        self._timer = None
+        if timeout is not None:
+            self._timer = threading.Timer(timeout, self._timeout)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _timeout(self):
+        self.timed_out = True
+        _kill_process_group(self._process)
+
+    def __iter__(self):
+        try:
+            for line in iter(self._process.stdout.readline, b''):
+                line = line.rstrip(b'\n')
+                if line:
+                    yield line
+        finally:
+            self._process.stdout.close()
+            self.returncode = self._process.wait()
+            if self._timer:
+                self._timer.cancel()
+
+    def result(self):
+        """Run the command to completion.
+
+        @return: CommandResult
+
+        """
+        output = list(self)
+        return CommandResult(self.command, self.returncode, output, self.timed_out)
+
+
+def run_command_status(cmd, *args, **kwargs):
+    """Run given command with args on the command line, keeping its exit code.
+
+    @arg  cmd: command to execute
+    @type cmd: string
+    @arg  args: arguments of the command
+    @type args: list
+    @kwarg timeout: time (in s) after which the command is killed
+    @type  timeout: float
+
+    @return: CommandResult
+
+    """
+    return StreamingCommand(cmd, args, kwargs.get('timeout')).result()
+
+def run_command(cmd, *args, **kwargs):
     """Run given command with args on the command line.
 
     @arg  cmd: command to execute
     @type cmd: string
     @arg  args: arguments of the command
     @type args: list
+    @kwarg timeout: time (in s) after which the command is killed
+    @type  timeout: float
 
     @return: list of lines of the output
 
     """
-    import subprocess
-    return [line for line in subprocess.Popen([cmd]+list(args), stdout=subprocess.PIPE, stderr=subprocess.STDOUT).communicate()[0].split('\n') if line]
+    return run_command_status(cmd, *args, **kwargs).output
+
+def iter_command(cmd, *args, **kwargs):
+    """Iterate over the output lines of the given command while it runs.
+
+    @arg  cmd: command to execute
+    @type cmd: string
+    @arg  args: arguments of the command
+    @type args: list
+    @kwarg timeout: time (in s) after which the command is killed
+    @type  timeout: float
+
+    @return: StreamingCommand, to iterate over
+
+    """
+    return StreamingCommand(cmd, args, kwargs.get('timeout'))
+
+def run_commands(commands, max_workers=4, timeout=None):
+    """Run several commands concurrently.
+
+    @arg  commands: commands to run, each of them a list with the command
+        and its arguments
+    @type commands: list
+    @arg  max_workers: maximum number of commands running at the same time
+    @type max_workers: int
+    @arg  timeout: time (in s) after which each command is killed
+    @type timeout: float
+
+    @return: list of CommandResult, in the same order as the commands
+
+    """
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(max(1, min(max_workers, len(commands))))
+    try:
+        return pool.map(lambda command: run_command_status(*command, timeout=timeout),
+                        commands)
+    finally:
+        pool.close()
+
+
+StageResult = namedtuple('StageResult', 'command returncode elapsed')
+
+
+class Pipeline(object):
+    """Chain of commands connected as in a shell pipe.
+
+    Each stage reads directly from the file descriptor of the previous one,
+    so data never goes through Python unless its output is consumed with a
+    callback or an iterator. After running, `results` holds the exit code
+    and running time of every stage.
+
+    """
+    def __init__(self, *commands, **kwargs):
+        """Define the pipeline.
+
+        @arg  commands: stages, each of them a list with the command and its arguments
+        @type commands: list
+        @kwarg cwd: working directory of the commands
+        @type  cwd: str
+        @kwarg timeout: time (in s) after which all the stages are killed
+        @type  timeout: float
+
+        """
+        self.commands = [list(command) for command in commands]
+        self.cwd = kwargs.get('cwd')
+        self.timeout = kwargs.get('timeout')
+        self.results = []
+        self.timed_out = False
+
+    def pipe(self, cmd, *args):
+        """Add a stage at the end of the pipeline.
+
+        @return: the pipeline itself, to allow chaining
+
+        """
+        self.commands.append([cmd] + list(args))
+        return self
+
+    def _start(self, stdin, stdout):
+        """Start all the stages and the threads timing them."""
+        if not self.commands:
+            raise ValueError("Empty pipeline")
+        processes = []
+        previous_output = stdin
+        start_time = time.time()
+        started = False
+        try:
+            for position, command in enumerate(self.commands):
+                last_stage = position == len(self.commands) - 1
+                process = subprocess.Popen(command,
+                                           stdin=previous_output,
+                                           stdout=stdout if last_stage else subprocess.PIPE,
+                                           cwd=self.cwd,
+                                           close_fds=True,
+                                           preexec_fn=_new_process_group)
+                if processes:
+                    # Only the next stage must keep the pipe open, so it gets SIGPIPE
+                    previous_output.close()
+                previous_output = process.stdout
+                processes.append(process)
+            started = True
+        finally:
+            if not started:
+                # A stage could not start: don't leave the previous ones behind
+                if processes and previous_output:
+                    previous_output.close()
+                for process in processes:
+                    _kill_process_group(process)
+                    process.wait()
+        end_times = [None] * len(processes)
+
+        def wait_for(position):
+            processes[position].wait()
+            end_times[position] = time.time()
+
+        waiters = [threading.Thread(target=wait_for, args=(position,))
+                   for position in range(len(processes))]
+        for waiter in waiters:
+            waiter.daemon = True
+            waiter.start()
+        timer = None
+        if self.timeout is not None:
+            timer = threading.Timer(self.timeout, self._kill, (processes,))
+            timer.daemon = True
+            timer.start()
+        return processes, (start_time, end_times, waiters, timer)
+
+    def _kill(self, processes):
+        self.timed_out = True
+        for process in processes:
+            _kill_process_group(process)
+
+    def _finish(self, processes, timing):
+        """Wait for all stages and collect their results."""
+        start_time, end_times, waiters, timer = timing
+        for waiter in waiters:
+            waiter.join()
+        if timer:
+            timer.cancel()
+        self.results = [StageResult(command, process.returncode, end_time - start_time)
+                        for command, process, end_time in zip(self.commands, processes, end_times)]
+        return self.results
+
+    def run(self, output=None, stdin=None, chunk_size=64 * 1024):
+        """Run the pipeline.
+
+        @arg  output: where to send the output of the last stage: a file
+            name or a file object, which the last stage writes to directly,
+            a callable, which gets the output in chunks, or None to inherit
+            standard output
+        @type output: str, file or callable
+        @arg  stdin: input of the first stage, inherited if None
+        @type stdin: file
+        @arg  chunk_size: size of the chunks given to the callable
+        @type chunk_size: int
+
+        @return: list of StageResult
+
+        """
+        if callable(output):
+            processes, timing = self._start(stdin, subprocess.PIPE)
+            output_fd = processes[-1].stdout.fileno()
+            while True:
+                chunk = os.read(output_fd, chunk_size)
+                if not chunk:
+                    break
+                output(chunk)
+            processes[-1].stdout.close()
+        elif isinstance(output, str):
+            with open(output, 'wb') as output_file:
+                processes, timing = self._start(stdin, output_file)
+        else:
+            processes, timing = self._start(stdin, output)
+        return self._finish(processes, timing)
+
+    def iter_lines(self, stdin=None):
+        """Run the pipeline, iterating over the non-empty output lines of the last stage.
+
+        Results are available once the iteration finishes.
+
+        """
+        processes, timing = self._start(stdin, subprocess.PIPE)
+        try:
+            for line in iter(processes[-1].stdout.readline, b''):
+                line = line.rstrip(b'\n')
+                if line:
+                    yield line
+        finally:
+            processes[-1].stdout.close()
+            self._finish(processes, timing)
+
+    @property
+    def succeeded(self):
+        """Did all stages finish successfully?
+
+        A stage other than the last one may also be killed by SIGPIPE, which
+        only means that the following stages didn't need all its output.
+
+        """
+        if not self.results:
+            return False
+        return self.results[-1].returncode == 0 and \
+            all(result.returncode in (0, -signal.SIGPIPE) for result in self.results[:-1])
+
 
 def run_command_with_pipe(cmd1, args1, cmd2, args2):
     """Run given command piping its result to another one.
@@ -41,7 +345,6 @@ def run_command_with_pipe(cmd1, args1, cmd2, args2):
     @return: list of lines of the output
 
     """
-    import subprocess
     if not args1:
         args1 = []
     if not args2:
@@ -50,11 +353,6 @@ def run_command_with_pipe(cmd1, args1, cmd2, args2):
         args1 = [args1]
     if not isinstance(args2, (tuple, list)):
         args2 = [args2]
-    #print "About to execute: %s | %s" %(' '.join([cmd1]+args1), ' '.join([cmd2]+args2))
-    p1 = subprocess.Popen([cmd1]+args1, stdout=subprocess.PIPE)
-    p2 = subprocess.Popen([cmd2]+args2, stdin=p1.stdout, stdout=subprocess.PIPE)
-    p1.stdout.close()  # Allow p1 to receive a SIGPIPE if p2 exits.
-    # return p2.communicate()[0].split('\n')
-    return [line for line in p2.communicate()[0].split('\n') if line]
+    return list(Pipeline([cmd1] + list(args1), [cmd2] + list(args2)).iter_lines())
 
 # EOF
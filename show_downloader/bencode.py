@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# =============================================================================
+# @file   bencode.py
+# @author Albert Puig (albert.puig@cern.ch)
+# @date   19.10.2026
+# =============================================================================
+"""Encode and decode bencoded data, as used by torrent and fastresume files."""
+
+import re
+
+_re_integer = re.compile(r'i(-?\d+)e')
+_re_length = re.compile(r'(\d+):')
+
+
+def _decode(data, position):
+    """Decode the element starting at position.
+
+    @return: (element, position after the element)
+
+    """
+    token = data[position]
+    if token == 'i':
+        match = _re_integer.match(data, position)
+        if not match:
+            raise ValueError("Invalid integer at %s" % position)
+        return int(match.group(1)), match.end()
+    if token == 'l':
+        position += 1
+        elements = []
+        while data[position] != 'e':
+            element, position = _decode(data, position)
+            elements.append(element)
+        return elements, position + 1
+    if token == 'd':
+        position += 1
+        elements = {}
+        while data[position] != 'e':
+            key, position = _decode(data, position)
+            elements[key], position = _decode(data, position)
+        return elements, position + 1
+    match = _re_length.match(data, position)
+    if not match:
+        raise ValueError("Invalid token %r at %s" % (token, position))
+    end = match.end() + int(match.group(1))
+    if end > len(data):
+        raise ValueError("Truncated string at %s" % position)
+    return data[match.end():end], end
+
+
+def bdecode(data):
+    """Decode bencoded data.
+
+    @arg  data: bencoded data
+    @type data: str
+
+    @return: decoded object
+
+    @raises: ValueError: if the data is not valid bencode
+
+    """
+    try:
+        element, position = _decode(data, 0)
+    except IndexError:
+        raise ValueError("Truncated data")
+    if position != len(data):
+        raise ValueError("Trailing data at %s" % position)
+    return element
+
+
+def _encode(element, output):
+    """Append the bencoded element to output."""
+    if isinstance(element, bool):
+        element = int(element)
+    if isinstance(element, (int, long)):
+        output.append('i%de' % element)
+    elif isinstance(element, str):
+        output.extend((str(len(element)), ':', element))
+    elif isinstance(element, (list, tuple)):
+        output.append('l')
+        for item in element:
+            _encode(item, output)
+        output.append('e')
+    elif isinstance(element, dict):
+        output.append('d')
+        for key in sorted(element):
+            _encode(key, output)
+            _encode(element[key], output)
+        output.append('e')
+    else:
+        raise TypeError("Cannot bencode %s" % type(element))
+
+
+def bencode(element):
+    """Bencode an object.
+
+    @arg  element: object made of ints, strs, lists and dicts
+    @type element: object
+
+    @return: str
+
+    """
+    output = []
+    _encode(element, output)
+    return ''.join(output)
+
+# EOF
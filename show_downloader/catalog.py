@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# =============================================================================
+# @file   catalog.py
+# @author Albert Puig (albert.puig@cern.ch)
+# @date   19.10.2026
+# =============================================================================
+"""Catalog of the episodes in the library.
+
+Episodes are stored in an SQLite table keyed by the episode_parser key
+(normalized show, season, episode, airdate), so the downloader can skip
+what is already in the library even when its cache is lost or expired.
+move_episodes adds the episodes it moves, and `rebuild` scans the whole
+library.
+
+"""
+
+from __future__ import with_statement
+import os
+import sqlite3
+import datetime
+
+import episode_parser
+from find_repacked_duplicates import VIDEO_EXTENSIONS
+
+CATALOG_FILE = os.path.expanduser('~/runtime/episode_catalog.db')
+
+
+def _row_key(key):
+    """Convert an EpisodeInfo key to a row key: primary keys can't have NULLs."""
+    show, season, episode, airdate = key
+    return (show,
+            -1 if season is None else season,
+            -1 if episode is None else episode,
+            airdate or '')
+
+
+class Catalog(object):
+    """Episodes in the library."""
+
+    def __init__(self, db_file=CATALOG_FILE):
+        """Open the catalog, creating it if needed.
+
+        @arg  db_file: SQLite database
+        @type db_file: str
+
+        """
+        folder = os.path.dirname(db_file)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        self._db = sqlite3.connect(db_file)
+        self._db.text_factory = str
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS episodes ("
+                             "show TEXT NOT NULL, season INTEGER NOT NULL, "
+                             "episode INTEGER NOT NULL, airdate TEXT NOT NULL, "
+                             "path TEXT NOT NULL, "
+                             "PRIMARY KEY (show, season, episode, airdate))")
+
+    def close(self):
+        self._db.close()
+
+    def add(self, paths):
+        """Add video files to the catalog.
+
+        @arg  paths: files in the library
+        @type paths: list
+
+        @return: number of files added (those whose name could be parsed)
+
+        """
+        rows = []
+        for path in paths:
+            info = episode_parser.parse(os.path.basename(path))
+            if info:
+                rows.append(_row_key(info.key) + (path,))
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO episodes VALUES (?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+    def __contains__(self, key):
+        """Is the episode with this EpisodeInfo key in the library?"""
+        return self._db.execute("SELECT 1 FROM episodes WHERE show = ? AND season = ? AND "
+                                "episode = ? AND airdate = ?",
+                                _row_key(key)).fetchone() is not None
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM episodes").fetchone()[0]
+
+    def keys(self):
+        """Get the keys of all episodes, for fast repeated lookups.
+
+        @return: set of EpisodeInfo keys
+
+        """
+        # Airdates are stored as ISO strings
+        return set((show,
+                    None if season == -1 else season,
+                    None if episode == -1 else episode,
+                    datetime.datetime.strptime(airdate, '%Y-%m-%d').date() if airdate else None)
+                   for show, season, episode, airdate
+                   in self._db.execute("SELECT show, season, episode, airdate FROM episodes"))
+
+    def rebuild(self, library):
+        """Replace the contents of the catalog with the episodes found in the library.
+
+        @arg  library: folder containing the shows
+        @type library: str
+
+        @return: number of episodes in the catalog
+
+        """
+        videos = []
+        for base_dir, _, files in os.walk(library):
+            videos.extend(os.path.join(base_dir, file_name) for file_name in files
+                          if os.path.splitext(file_name)[1].lower() in VIDEO_EXTENSIONS)
+        with self._db:
+            self._db.execute("DELETE FROM episodes")
+        self.add(videos)
+        return len(self)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('--catalog', action='store', type=str, default=CATALOG_FILE)
+    subparsers = parser.add_subparsers(dest='command')
+    rebuild_parser = subparsers.add_parser('rebuild', help="Scan the whole library")
+    rebuild_parser.add_argument('library', action='store', type=str, nargs='?',
+                                default='/media/RaspiHD/Series')
+    check_parser = subparsers.add_parser('check', help="Check if episodes are in the library")
+    check_parser.add_argument('names', action='store', type=str, nargs='+')
+    args = parser.parse_args()
+    catalog = Catalog(args.catalog)
+    if args.command == 'rebuild':
+        print "%s episodes in the catalog" % catalog.rebuild(args.library)
+    else:
+        for name in args.names:
+            info = episode_parser.parse(name)
+            if not info:
+                print "%s: cannot parse" % name
+            else:
+                print "%s: %s" % (name, 'in library' if info.key in catalog else 'missing')
+    catalog.close()
+
+# EOF
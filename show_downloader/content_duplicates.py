@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# =============================================================================
+# @file   content_duplicates.py
+# @author Albert Puig (albert.puig@cern.ch)
+# @date   19.10.2026
+# =============================================================================
+"""Find videos with the same contents, whatever their names.
+
+Files are first grouped by size, then by a hash of their head, middle and
+tail, and only files that still collide are hashed completely. Hashes are
+kept in a cache keyed by (device, inode, size, mtime), so later runs only
+read new or modified files.
+
+Hardlinks share their contents but not their space, so they are not
+duplicates: each file is only considered once, whatever its number of names.
+
+"""
+
+import os
+import hashlib
+
+import PickleFile
+from find_repacked_duplicates import VIDEO_EXTENSIONS
+
+SAMPLE_SIZE = 256 * 1024
+READ_SIZE = 1024 * 1024
+
+
+def partial_hash(path, size):
+    """Hash the head, middle and tail of a file.
+
+    @arg  path: file to hash
+    @type path: str
+    @arg  size: size of the file
+    @type size: int
+
+    @return: hex digest
+
+    """
+    digest = hashlib.sha1(str(size))
+    with open(path, 'rb') as video:
+        for offset in (0, max(0, size / 2 - SAMPLE_SIZE / 2), max(0, size - SAMPLE_SIZE)):
+            video.seek(offset)
+            digest.update(video.read(SAMPLE_SIZE))
+    return digest.hexdigest()
+
+
+def full_hash(path):
+    """Hash the whole file.
+
+    @arg  path: file to hash
+    @type path: str
+
+    @return: hex digest
+
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as video:
+        for block in iter(lambda: video.read(READ_SIZE), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class HashCache(object):
+    """Persistent cache of file hashes, keyed by (device, inode, size, mtime)."""
+
+    def __init__(self, cache_file):
+        """Load the cache.
+
+        @arg  cache_file: file where the cache is stored
+        @type cache_file: str
+
+        """
+        self.cache_file = cache_file
+        self._hashes = PickleFile.load(cache_file) or {}
+        self._used = set()
+
+    @staticmethod
+    def _key(stat):
+        # Inode numbers are only unique within a device
+        return (stat.st_dev, stat.st_ino, stat.st_size, int(stat.st_mtime))
+
+    def get(self, path, stat, kind):
+        """Get the 'partial' or 'full' hash of a file, computing it if needed."""
+        key = self._key(stat)
+        self._used.add(key)
+        hashes = self._hashes.setdefault(key, {})
+        if kind not in hashes:
+            if kind == 'partial':
+                hashes[kind] = partial_hash(path, stat.st_size)
+            else:
+                hashes[kind] = full_hash(path)
+        return hashes[kind]
+
+    def save(self):
+        """Save the cache, forgetting files that were not seen in this run."""
+        PickleFile.write(self.cache_file,
+                         dict((key, value) for key, value in self._hashes.items()
+                              if key in self._used))
+
+
+def _group(paths, key):
+    """Group paths by key, keeping only groups with more than one element."""
+    groups = {}
+    for path in paths:
+        groups.setdefault(key(path), []).append(path)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def find_content_duplicates(paths, cache):
+    """Find files with identical contents.
+
+    @arg  paths: files to check
+    @type paths: list
+    @arg  cache: hash cache
+    @type cache: HashCache
+
+    @return: list of groups of identical files, with one path (the first
+        in sorted order) for files with several hardlinks
+
+    """
+    stats = {}
+    seen = set()
+    for path in sorted(paths):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue  # Removed while scanning
+        if (stat.st_dev, stat.st_ino) in seen:
+            continue  # Another name of a file that is already there
+        seen.add((stat.st_dev, stat.st_ino))
+        stats[path] = stat
+    duplicates = []
+    for same_size in _group(stats, lambda path: stats[path].st_size):
+        for same_sample in _group(same_size,
+                                  lambda path: cache.get(path, stats[path], 'partial')):
+            if stats[same_sample[0]].st_size <= 3 * SAMPLE_SIZE:
+                # The samples cover the whole file
+                duplicates.append(same_sample)
+                continue
+            duplicates.extend(_group(same_sample,
+                                     lambda path: cache.get(path, stats[path], 'full')))
+    return duplicates
+
+
+def get_videos(library):
+    """Get all video files in the library."""
+    videos = []
+    for base_dir, _, files in os.walk(library):
+        videos.extend(os.path.join(base_dir, file_name) for file_name in files
+                      if os.path.splitext(file_name)[1].lower() in VIDEO_EXTENSIONS)
+    return videos
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('--cache', action='store', type=str,
+                        default=os.path.expanduser('~/runtime/content_hashes.cache'))
+    parser.add_argument('library', action='store', type=str, nargs='?',
+                        default='/media/RaspiHD/Series')
+    args = parser.parse_args()
+    hash_cache = HashCache(args.cache)
+    for group in find_content_duplicates(get_videos(args.library), hash_cache):
+        print "Same contents:"
+        for path in sorted(group):
+            print "  %s" % path
+    hash_cache.save()
+
+# EOF
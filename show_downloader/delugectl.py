@@ -7,35 +7,172 @@
 # =============================================================================
 """Manage deluge."""
 
+from __future__ import with_statement
 import os
+import time
+import socket
 
 from RunCommand import run_command
-from PickleFile import load, write
+from PickleFile import load, write, atomic_write
+from bencode import bdecode, bencode
+from delugerpc import get_client, DEFAULT_PORT
 
 config_folder = os.path.expandvars('$HOME/.config/deluge/')
+pid_file = os.path.join(config_folder, 'deluged.pid')
+
+# Daemon status
+DEAD = 'dead'
+STARTING = 'starting'
+RUNNING = 'running'
+STATUS_TTL = 5
+SYSTEMCTL_TIMEOUT = 120
+# Time (in s) the daemon may take to show up after start_deluge
+STARTUP_GRACE = 30
+
+_status_cache = {'time': 0.0, 'status': None, 'started': 0.0}
+
+
+def _is_deluged_process(pid):
+    """Is the given process deluged?"""
+    try:
+        with open('/proc/%s/cmdline' % pid) as cmdline_file:
+            cmdline = cmdline_file.read().split('\0')
+    except IOError:
+        return False
+    # Either deluged itself or the interpreter running it
+    return any(os.path.basename(arg) == 'deluged' for arg in cmdline[:2])
+
+
+def find_deluged_pid():
+    """Find the PID of deluged, without spawning any process.
+
+    The PID file is used if deluged wrote one, otherwise /proc is scanned.
+
+    :returns: PID of deluged, None if it's not running.
+    :rtype: int
+
+    """
+    if os.path.exists(pid_file):
+        try:
+            with open(pid_file) as pid_data:
+                pid = int(pid_data.read().split(';')[0])
+            if _is_deluged_process(pid):
+                return pid
+        except (IOError, ValueError):
+            pass
+    for entry in os.listdir('/proc'):
+        if entry.isdigit() and _is_deluged_process(entry):
+            return int(entry)
+    return None
+
+
+def deluge_status(max_age=STATUS_TTL):
+    """Get deluged status.
+
+    The daemon is running if it accepts connections on its RPC port, and
+    starting if the process exists but doesn't accept connections yet. The
+    result is cached for max_age seconds.
+
+    :param float max_age: Maximum age (in s) of the cached status.
+
+    :returns: One of DEAD, STARTING or RUNNING.
+    :rtype: str
+
+    """
+    now = time.time()
+    if _status_cache['status'] and now - _status_cache['time'] < max_age:
+        return _status_cache['status']
+    status = DEAD
+    if find_deluged_pid():
+        status = STARTING
+        try:
+            socket.create_connection(('127.0.0.1', DEFAULT_PORT), 0.5).close()
+            status = RUNNING
+        except socket.error:
+            pass
+    _status_cache['time'] = now
+    _status_cache['status'] = status
+    return status
+
+
+def wait_for_deluge(timeout=60, poll_interval=1):
+    """Wait until deluged accepts connections.
+
+    Right after start_deluge, the process may not exist yet, so DEAD only
+    gives up once STARTUP_GRACE has passed since the start.
+
+    :param float timeout: Maximum time to wait (in s).
+    :param float poll_interval: Time between checks (in s).
+
+    :returns: Whether deluged is running.
+    :rtype: bool
+
+    """
+    end_time = time.time() + timeout
+    while True:
+        status = deluge_status(max_age=0)
+        if status == RUNNING:
+            return True
+        now = time.time()
+        if now > end_time:
+            return False
+        if status == DEAD and now > _status_cache['started'] + STARTUP_GRACE:
+            return False
+        time.sleep(poll_interval)
 
 
 def is_deluge_running():
     """Is deluge running?"""
-    return 'running' in run_command('sudo', 'systemctl', 'status', 'deluged')[2]
+    return deluge_status() == RUNNING
 
 def start_deluge():
     """Start deluge."""
-    run_command('sudo', 'systemctl', 'start', 'deluged', 'deluge-web')
+    _status_cache['status'] = None
+    _status_cache['started'] = time.time()
+    run_command('sudo', 'systemctl', 'start', 'deluged', 'deluge-web', timeout=SYSTEMCTL_TIMEOUT)
 
 def stop_deluge():
     """Stop deluge."""
-    run_command('sudo', 'systemctl', 'stop', 'deluged', 'deluge-web')
+    _status_cache['status'] = None
+    run_command('sudo', 'systemctl', 'stop', 'deluged', 'deluge-web', timeout=SYSTEMCTL_TIMEOUT)
+
+def prune_fastresume(fastresume_file, torrent_ids):
+    """Remove the resume data of the given torrents from torrents.fastresume.
+
+    The rest of torrents keep their resume data, so they don't need to be
+    re-checked when deluge starts.
+
+    :param str fastresume_file: Path to torrents.fastresume.
+    :param list torrent_ids: Torrents to remove.
 
-def cleanup_torrents(delete_fastresume=True, raise_on_fail=True, restart=False):
+    :returns: Number of removed entries.
+    :rtype: int
+
+    :raises: ValueError: if the file is not valid bencode
+
+    """
+    if not os.path.exists(fastresume_file):
+        return 0
+    with open(fastresume_file, 'rb') as fastresume_data:
+        fastresume = bdecode(fastresume_data.read())
+    removed = [torrent_id for torrent_id in torrent_ids if torrent_id in fastresume]
+    if removed:
+        for torrent_id in removed:
+            del fastresume[torrent_id]
+        atomic_write(fastresume_file, bencode(fastresume))
+    return len(removed)
+
+def cleanup_torrents(delete_fastresume=False, raise_on_fail=True, restart=False):
     """Cleanup deluge before moving torrent files.
 
     1) Load the torrents.state file
     2) Get finished torrents.
     3) Remove them.
     4) Save modified torrents.state.
+    5) Remove their entries from torrents.fastresume.
 
-    :param bool delete_fastresume: Delete torrents.fastresume file?
+    :param bool delete_fastresume: Delete the whole torrents.fastresume file
+        instead of only the entries of removed torrents?
     :param bool raise_on_fail: Raise exception if torrent file is not found.
 
     :returns: Number of deleted torrents.
@@ -65,16 +202,53 @@ def cleanup_torrents(delete_fastresume=True, raise_on_fail=True, restart=False):
                 os.remove(torrent_file)
         state.torrents = [torrent for torrent in state.torrents if not torrent.is_finished]
         write(state_file, state)
-        if delete_fastresume:
-            fastresume_file = os.path.join(state_folder, 'torrents.fastresume')
-            if os.path.exists(fastresume_file):
-                os.remove(fastresume_file)
+        fastresume_file = os.path.join(state_folder, 'torrents.fastresume')
+        if not delete_fastresume:
+            try:
+                prune_fastresume(fastresume_file,
+                                 [torrent.torrent_id for torrent in finished_torrents])
+            except ValueError:
+                # Corrupt, so it's useless anyway
+                delete_fastresume = True
+        if delete_fastresume and os.path.exists(fastresume_file):
+            os.remove(fastresume_file)
     if restart:
         start_deluge()
     return num_finished_torrents
 
+def remove_finished_torrents(remove_data=False):
+    """Remove finished torrents from the running daemon.
+
+    Unlike cleanup_torrents, deluge is not stopped and the resume data of the
+    other torrents is kept, so nothing needs to be re-checked.
+
+    :param bool remove_data: Also remove the downloaded data?
+
+    :returns: Number of removed torrents.
+    :rtype: int
+
+    :raises: DelugeRPCError: if the daemon fails to remove a torrent
+
+    """
+    client = get_client()
+    status = client.status(['is_finished'])
+    finished_torrents = [torrent_id for torrent_id, torrent_status in status.items()
+                         if torrent_status['is_finished']]
+    client.remove(finished_torrents, remove_data)
+    return len(finished_torrents)
+
 if __name__ == '__main__':
-    cleaned_files = cleanup_torrents()
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--live', action='store_true',
+                        help="Remove torrents from the running daemon")
+    parser.add_argument('--remove-data', action='store_true',
+                        help="Also remove downloaded data (only with --live)")
+    args = parser.parse_args()
+    if args.live:
+        cleaned_files = remove_finished_torrents(args.remove_data)
+    else:
+        cleaned_files = cleanup_torrents()
     print "I cleaned %s files" % cleaned_files
 
 
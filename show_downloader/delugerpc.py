@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# =============================================================================
+# @file   delugerpc.py
+# @author Albert Puig (albert.puig@cern.ch)
+# @date   19.10.2026
+# =============================================================================
+"""Talk to a running deluged over its RPC interface.
+
+Implements the Deluge 1.3 wire protocol: requests and responses are
+rencoded and zlib-compressed, and travel over an SSL connection. Several
+requests can be sent in one message, which is what `batch` does.
+
+All tools share one persistent connection through `get_client`, which
+reconnects when needed and can be used from several threads.
+
+"""
+
+from __future__ import with_statement
+import os
+import re
+import ssl
+import zlib
+import atexit
+import select
+import socket
+import itertools
+import threading
+
+try:
+    from deluge import rencode
+except ImportError:
+    import rencode
+
+RPC_RESPONSE = 1
+RPC_ERROR = 2
+RPC_EVENT = 3
+
+DEFAULT_PORT = 58846
+READ_SIZE = 64 * 1024
+
+STATUS_KEYS = ['name', 'state', 'progress', 'is_finished', 'save_path']
+
+
+class DelugeRPCError(Exception):
+    """Error raised by the daemon while executing a call."""
+    def __init__(self, method, exception_type, message):
+        Exception.__init__(self, "%s failed -> %s: %s" % (method, exception_type, message))
+        self.method = method
+        self.exception_type = exception_type
+
+
+def get_localclient_credentials(config_folder=os.path.expandvars('$HOME/.config/deluge/')):
+    """Get the credentials deluged creates for local clients.
+
+    @arg  config_folder: deluge configuration folder
+    @type config_folder: str
+
+    @return: (username, password), or (None, None) if not found
+
+    """
+    auth_file = os.path.join(config_folder, 'auth')
+    if os.path.exists(auth_file):
+        with open(auth_file) as auth:
+            for line in auth:
+                fields = line.strip().split(':')
+                if len(fields) >= 2 and fields[0] == 'localclient':
+                    return fields[0], fields[1]
+    return None, None
+
+
+def _loads(data):
+    """Decode rencoded data, getting text strings where rencode allows it."""
+    try:
+        return rencode.loads(data, decode_utf8=True)
+    except TypeError:
+        return rencode.loads(data)
+
+
+def _stream_ended(decompressor):
+    """Has the decompressor reached the end of its zlib stream?"""
+    if hasattr(decompressor, 'eof'):
+        return decompressor.eof
+    # Python 2 has no eof, but anything past the end goes to unused_data
+    probe = decompressor.copy()
+    try:
+        probe.decompress(b'\0')
+    except zlib.error:
+        return False
+    return bool(probe.unused_data)
+
+
+class DelugeRPCClient(object):
+    """Connection to deluged.
+
+    Can be used as a context manager, which connects and logs in on enter
+    and disconnects on exit.
+
+    """
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT, username=None, password=None,
+                 timeout=30, use_ssl=True):
+        """Configure the connection.
+
+        If no username is given, the local client credentials are used.
+
+        @arg  host: daemon host
+        @type host: str
+        @arg  port: daemon RPC port
+        @type port: int
+        @arg  username: user to log in as
+        @type username: str
+        @arg  password: password of the user
+        @type password: str
+        @arg  timeout: socket timeout (in s)
+        @type timeout: float
+        @arg  use_ssl: encrypt the connection? Only the fake daemon works without it
+        @type use_ssl: bool
+
+        """
+        if username is None:
+            username, password = get_localclient_credentials()
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.use_ssl = use_ssl
+        self._socket = None
+        self._buffer = b''
+        self._request_ids = itertools.count()
+        self._lock = threading.RLock()
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.disconnect()
+
+    @property
+    def connected(self):
+        """Is the connection open?"""
+        return self._socket is not None
+
+    def connect(self):
+        """Open the connection and log in."""
+        with self._lock:
+            sock = socket.create_connection((self.host, self.port), self.timeout)
+            if self.use_ssl:
+                context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS', ssl.PROTOCOL_SSLv23))
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+                sock = context.wrap_socket(sock)
+            self._socket = sock
+            self._buffer = b''
+            try:
+                self._send([('daemon.login', (self.username, self.password), {})], True)
+            except Exception:
+                self.disconnect()
+                raise
+
+    def disconnect(self):
+        """Close the connection."""
+        with self._lock:
+            if self._socket:
+                try:
+                    self._socket.close()
+                finally:
+                    self._socket = None
+
+    def call(self, method, *args, **kwargs):
+        """Call a method of the daemon.
+
+        @arg  method: RPC method, such as 'core.get_torrents_status'
+        @type method: str
+
+        @return: result of the call
+
+        @raises: DelugeRPCError: if the call fails in the daemon
+
+        """
+        return self.batch([(method, args, kwargs)])[0]
+
+    def batch(self, calls, raise_on_error=True):
+        """Send several calls in one message and wait for all their results.
+
+        @arg  calls: calls to make
+        @type calls: list of (method, args, kwargs) tuples
+        @arg  raise_on_error: raise the first error found? Otherwise, failed
+            calls get a DelugeRPCError as result
+        @type raise_on_error: bool
+
+        @return: list of results, in the same order as the calls
+
+        @raises: DelugeRPCError: if any call fails and raise_on_error is set
+
+        """
+        if not calls:
+            return []
+        with self._lock:
+            if self._socket and self._is_stale():
+                self.disconnect()
+            if not self._socket:
+                self.connect()
+            try:
+                pending = self._request(calls)
+            except (IOError, ssl.SSLError):
+                # Nothing reached the daemon, it may have been restarted: try once more
+                self.disconnect()
+                self.connect()
+                pending = self._request(calls)
+            # Calls may have run already, so they are never sent again from here
+            try:
+                return self._collect(pending, len(calls), raise_on_error)
+            except (IOError, ssl.SSLError):
+                self.disconnect()
+                raise
+
+    def _is_stale(self):
+        """Has the daemon closed the connection since it was last used?"""
+        try:
+            if not select.select([self._socket], [], [], 0)[0]:
+                return False
+            chunk = self._socket.recv(READ_SIZE)
+        except (IOError, ssl.SSLError, select.error):
+            return True
+        if not chunk:
+            return True
+        # Unrequested messages, such as events, are left for _receive
+        self._buffer += chunk
+        return False
+
+    def _send(self, calls, raise_on_error):
+        """Send the calls and collect their results."""
+        return self._collect(self._request(calls), len(calls), raise_on_error)
+
+    def _request(self, calls):
+        """Send the calls in one message.
+
+        @return: dict of request id -> (position, method) of the calls sent
+
+        """
+        requests = []
+        pending = {}
+        for position, (method, args, kwargs) in enumerate(calls):
+            request_id = next(self._request_ids)
+            requests.append((request_id, method, tuple(args), dict(kwargs)))
+            pending[request_id] = (position, method)
+        self._socket.sendall(zlib.compress(rencode.dumps(requests)))
+        return pending
+
+    def _collect(self, pending, number_of_calls, raise_on_error):
+        """Wait for the results of the pending calls."""
+        results = [None] * number_of_calls
+        while pending:
+            message = self._receive()
+            if message[0] == RPC_EVENT:
+                continue
+            position, method = pending.pop(message[1])
+            if message[0] == RPC_RESPONSE:
+                results[position] = message[2]
+            else:
+                results[position] = DelugeRPCError(method, message[2], message[3])
+        if raise_on_error:
+            for result in results:
+                if isinstance(result, DelugeRPCError):
+                    raise result
+        return results
+
+    # Torrent management
+    def add_magnets(self, magnets, options=None):
+        """Add magnet links.
+
+        @arg  magnets: magnet URIs
+        @type magnets: list
+        @arg  options: torrent options, such as 'add_paused'
+        @type options: dict
+
+        @return: list with torrent id or DelugeRPCError for each magnet
+
+        """
+        return self.batch([('core.add_torrent_magnet', (magnet, options or {}), {})
+                           for magnet in magnets], raise_on_error=False)
+
+    def add_torrent_file(self, file_name, file_data, options=None):
+        """Add a torrent from its .torrent contents.
+
+        @arg  file_name: name of the torrent file
+        @type file_name: str
+        @arg  file_data: contents of the torrent file
+        @type file_data: bytes
+        @arg  options: torrent options
+        @type options: dict
+
+        @return: torrent id
+
+        """
+        import base64
+        return self.call('core.add_torrent_file', file_name, base64.b64encode(file_data),
+                         options or {})
+
+    def pause(self, torrent_ids=None):
+        """Pause the given torrents, or all of them if torrent_ids is None."""
+        if torrent_ids is None:
+            return self.call('core.pause_all_torrents')
+        return self.call('core.pause_torrent', list(torrent_ids))
+
+    def resume(self, torrent_ids=None):
+        """Resume the given torrents, or all of them if torrent_ids is None."""
+        if torrent_ids is None:
+            return self.call('core.resume_all_torrents')
+        return self.call('core.resume_torrent', list(torrent_ids))
+
+    def remove(self, torrent_ids, remove_data=False):
+        """Remove torrents in one batch.
+
+        @arg  torrent_ids: torrents to remove
+        @type torrent_ids: list
+        @arg  remove_data: also remove downloaded data?
+        @type remove_data: bool
+
+        @return: list of results, one per torrent
+
+        """
+        return self.batch([('core.remove_torrent', (torrent_id, remove_data), {})
+                           for torrent_id in torrent_ids])
+
+    def status(self, keys=None, torrent_ids=None):
+        """Get the status of torrents.
+
+        @arg  keys: status fields to get
+        @type keys: list
+        @arg  torrent_ids: torrents to query, all if None
+        @type torrent_ids: list
+
+        @return: dict of torrent id -> status dict
+
+        """
+        filter_dict = {'id': list(torrent_ids)} if torrent_ids is not None else {}
+        return self.call('core.get_torrents_status', filter_dict, keys or STATUS_KEYS)
+
+    def _receive(self):
+        """Read one message from the daemon.
+
+        Each message is a separate zlib stream, so it's complete once the
+        decompressor reaches the end of the stream. Chunks are fed to the
+        decompressor as they arrive, and bytes past the end are kept for the
+        next message.
+
+        """
+        decompressor = zlib.decompressobj()
+        data = []
+        while True:
+            if self._buffer:
+                chunk, self._buffer = self._buffer, b''
+                try:
+                    data.append(decompressor.decompress(chunk))
+                except zlib.error:
+                    self.disconnect()
+                    raise IOError("Corrupt message from deluged")
+                if decompressor.unused_data or _stream_ended(decompressor):
+                    self._buffer = decompressor.unused_data
+                    return _loads(b''.join(data))
+            chunk = self._socket.recv(READ_SIZE)
+            if not chunk:
+                self.disconnect()
+                raise IOError("Connection to deluged lost")
+            self._buffer += chunk
+
+
+_shared_client = {}
+_shared_lock = threading.Lock()
+
+
+def get_client(host='127.0.0.1', port=DEFAULT_PORT, **kwargs):
+    """Get the persistent client shared by all tools in this process.
+
+    The connection is opened on first use and closed at exit.
+
+    @arg  host: daemon host
+    @type host: str
+    @arg  port: daemon RPC port
+    @type port: int
+
+    @return: DelugeRPCClient
+
+    """
+    with _shared_lock:
+        if (host, port) not in _shared_client:
+            client = DelugeRPCClient(host, port, **kwargs)
+            atexit.register(client.disconnect)
+            _shared_client[(host, port)] = client
+        return _shared_client[(host, port)]
+
+
+def torrent_id_from_magnet(magnet):
+    """Extract the torrent id (info hash) from a magnet link.
+
+    @arg  magnet: magnet URI
+    @type magnet: str
+
+    @return: lowercase hex info hash, or None if not found
+
+    """
+    match = re.search(r'xt=urn:btih:([0-9a-fA-F]{40})', magnet)
+    return match.group(1).lower() if match else None
+
+# EOF
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# =============================================================================
+# @file   episode_parser.py
+# @author Albert Puig (albert.puig@cern.ch)
+# @date   19.10.2026
+# =============================================================================
+"""Parse scene-style episode names.
+
+Understands the usual ways of numbering an episode:
+  * Show.Name.S01E02.720p.HDTV-GRP
+  * Show.Name.S01E02E03.720p.HDTV-GRP (also S01E02-E03, S01E02-03 and 1x02-1x03)
+  * Show Name 1x02 Episode Title
+  * Show.Name.102.HDTV-GRP (also 4 digits, 1002)
+  * Show.Name.2016.03.05.720p-GRP (date-based)
+
+Results are memoized in a bounded cache, since the same names are parsed
+again and again by the downloader, the mover and the duplicate finder.
+
+"""
+
+import re
+import datetime
+from collections import namedtuple
+
+from Containers import LimitedDict
+
+CACHE_SIZE = 4096
+
+_VIDEO_EXTENSIONS = ['.mkv', '.mp4', '.avi', '.srt', '.sub', '.idx', '.nfo']
+
+# Episode markers, tried in order of reliability
+_re_sxxeyy = re.compile(r'(?<![a-z0-9])s(\d{1,2})[ ._-]?e(\d{1,3})(?![0-9])', re.I)
+_re_nxnn = re.compile(r'(?<![a-z0-9])(\d{1,2})x(\d{2,3})(?![a-z0-9])', re.I)
+_re_date = re.compile(r'(?<![0-9])((?:19|20)\d\d)[ ._-](\d\d)[ ._-](\d\d)(?![0-9])')
+# Not the codec in H.264 or x.265
+_re_nnn = re.compile(r'(?<=[ ._-])(?<![ ._-][hHxX][ ._-])(\d{1,2})(\d\d)(?=[ ._-]|\Z)')
+# More episodes right after the marker, not to be confused with a resolution (S01E01-720p)
+_re_more_sxxeyy = re.compile(r'(?:[ ._-]?-?[ ._-]?e|-)(\d{1,3})(?![0-9pi])', re.I)
+_re_more_nxnn = re.compile(r'[ ._]?-[ ._]?(?:\d{1,2}x)?(\d{2,3})(?![a-z0-9])', re.I)
+# Extra information, looked for after the marker
+_re_quality = re.compile(r'(?<![a-z0-9])(\d{3,4}[pi])(?![a-z0-9])', re.I)
+_re_proper = re.compile(r'(?<![a-z])proper(?![a-z])', re.I)
+_re_repack = re.compile(r'(?<![a-z])(?:repack(?:ed)?|rerip)(?![a-z])', re.I)
+# Show name cleanup
+_re_tags = re.compile(r'^(?:\[[^\]]*\][ ._-]*)+')
+_re_spaces = re.compile(r'\s+')
+_re_not_alnum = re.compile(r'[^a-z0-9 ]')
+
+
+class EpisodeInfo(namedtuple('EpisodeInfo',
+                             'show season episode airdate quality proper repack last_episode')):
+    """Parsed episode name.
+
+    Date-based episodes have `airdate` set and no season or episode.
+    `last_episode` is the last episode in multi-episode files, and the same
+    as `episode` otherwise.
+
+    """
+    __slots__ = ()
+
+    @property
+    def is_proper(self):
+        """Is this a PROPER or REPACK release?"""
+        return self.proper or self.repack
+
+    @property
+    def key(self):
+        """Hashable key identifying the episode, regardless of release."""
+        return (normalize_show(self.show), self.season, self.episode, self.airdate)
+
+
+def normalize_show(show):
+    """Normalize show name for comparisons.
+
+    Lowercase, no punctuation and single spaces, so 'Marvels.Agents.of.S.H.I.E.L.D'
+    and 'Marvels Agents of SHIELD' give the same result.
+
+    @arg  show: show name
+    @type show: str
+
+    @return: str
+
+    """
+    return _re_spaces.sub(' ', _re_not_alnum.sub('', show.lower())).strip()
+
+
+def _clean_show(prefix):
+    """Convert the part of the name before the episode marker to a show name.
+
+    Dots and underscores are used as separators unless the name already has
+    spaces. Acronyms such as S.H.I.E.L.D. are preserved.
+
+    """
+    prefix = _re_tags.sub('', prefix)
+    if ' ' not in prefix:
+        words = []
+        acronym = []
+        for token in prefix.replace('_', '.').split('.'):
+            if len(token) == 1 and token.isalpha():
+                acronym.append(token)
+                continue
+            if acronym:
+                words.append('.'.join(acronym) + ('.' if len(acronym) > 1 else ''))
+                acronym = []
+            words.append(token)
+        if acronym:
+            words.append('.'.join(acronym) + ('.' if len(acronym) > 1 else ''))
+        prefix = ' '.join(words)
+    return _re_spaces.sub(' ', prefix).strip(' -_')
+
+
+def _parse(name):
+    """Parse the episode name, without caching."""
+    base, dot, extension = name.rpartition('.')
+    if dot and '.' + extension.lower() in _VIDEO_EXTENSIONS:
+        name = base
+    season = episode = last_episode = airdate = None
+    match = _re_sxxeyy.search(name)
+    more_episodes = _re_more_sxxeyy
+    if not match:
+        match = _re_nxnn.search(name)
+        more_episodes = _re_more_nxnn
+    if match:
+        season, episode = int(match.group(1)), int(match.group(2))
+        last_episode = episode
+        end = match.end()
+        while True:
+            more = more_episodes.match(name, end)
+            if not more or int(more.group(1)) <= last_episode:
+                break
+            last_episode, end = int(more.group(1)), more.end()
+    else:
+        match = _re_date.search(name)
+        if match:
+            try:
+                airdate = datetime.date(*[int(group) for group in match.groups()])
+            except ValueError:
+                match = None
+        if not match:
+            for match in _re_nnn.finditer(name):
+                # Don't mistake years for season + episode
+                if match.group(0)[:2] not in ('19', '20') or len(match.group(0)) == 3:
+                    season, episode = int(match.group(1)), int(match.group(2))
+                    last_episode = episode
+                    break
+            else:
+                return None
+        end = match.end()
+    show = _clean_show(name[:match.start()])
+    if not show:
+        return None
+    rest = name[end:]
+    quality = _re_quality.search(rest)
+    return EpisodeInfo(show, season, episode, airdate,
+                       quality.group(1).lower() if quality else None,
+                       bool(_re_proper.search(rest)),
+                       bool(_re_repack.search(rest)),
+                       last_episode)
+
+
+_cache = LimitedDict(CACHE_SIZE)
+_missing = object()
+
+
+def parse(name):
+    """Parse an episode name.
+
+    @arg  name: release name or file base name
+    @type name: str
+
+    @return: EpisodeInfo, or None if the name could not be understood
+
+    """
+    info = _cache.get(name, _missing)
+    if info is _missing:
+        info = _parse(name)
+        _cache.add(name, info)
+    return info
+
+
+def build_corpus():
+    """Build a corpus of (name, expected EpisodeInfo or None) covering all the formats."""
+    shows = ['Mar de Plastico', 'Marvels Agents of S.H.I.E.L.D.', 'House of Cards 2013',
+             'This Is Us', 'The 100', 'Better Call Saul', 'Luke Cage', 'La Casa de Papel',
+             'Tom Clancys Jack Ryan', 'El Ministerio del Tiempo', 'Mr Robot', 'Westworld',
+             'The Daily Show', 'Last Week Tonight with John Oliver', 'Velvet', 'Fargo']
+    qualities = [None, '480p', '720p', '1080p']
+    flags = [(False, False), (True, False), (False, True)]
+    corpus = []
+    for show in shows:
+        dotted = show.replace(' ', '.')
+        has_digits = any(char.isdigit() for char in show)
+        for season in (1, 2, 10):
+            for episode in (1, 9, 13, 22):
+                for quality in qualities:
+                    for proper, repack in flags:
+                        extra = []
+                        if proper:
+                            extra.append('PROPER')
+                        if repack:
+                            extra.append('REPACK')
+                        if quality:
+                            extra.append(quality)
+                        expected = EpisodeInfo(show, season, episode, None,
+                                               quality, proper, repack, episode)
+                        corpus.append(('.'.join([dotted, 'S%02dE%02d' % (season, episode)] +
+                                                extra + ['HDTV.x264-LOL.mkv']),
+                                       expected))
+                        corpus.append(('.'.join([dotted, 'S%02dE%02dE%02d' % (season, episode,
+                                                                              episode + 1)] +
+                                                extra + ['HDTV.x264-LOL.mkv']),
+                                       expected._replace(last_episode=episode + 1)))
+                        corpus.append((' '.join([show, '%sx%02d-%sx%02d' % (season, episode,
+                                                                            season, episode + 1)] +
+                                                extra),
+                                       expected._replace(last_episode=episode + 1)))
+                        corpus.append((' '.join([show, '%sx%02d' % (season, episode)] + extra),
+                                       expected))
+                        if not has_digits:
+                            corpus.append(('.'.join([dotted, '%s%02d' % (season, episode)] +
+                                                    extra + ['HDTV-KILLERS']),
+                                           expected))
+                            # No episode at all, and H.264 is not one
+                            corpus.append(('.'.join([dotted] + extra + ['WEB-DL.H.264-GRP']),
+                                           None))
+                        airdate = datetime.date(2010 + season, 1 + episode % 12, episode)
+                        corpus.append(('.'.join([dotted, airdate.strftime('%Y.%m.%d')] +
+                                                extra + ['WEB-TBS.mp4']),
+                                       expected._replace(season=None, episode=None,
+                                                         last_episode=None, airdate=airdate)))
+    return corpus
+
+
+def benchmark(repeat):
+    """Check correctness over the corpus and measure parsing throughput.
+
+    @arg  repeat: number of passes over the corpus for the cached measurement
+    @type repeat: int
+
+    @return: number of wrongly parsed names
+
+    """
+    import time
+    corpus = build_corpus()
+    errors = 0
+    for name, expected in corpus:
+        result = _parse(name)
+        if (result is None or expected is None or result.key != expected.key or
+                result[3:] != expected[3:]) and result != expected:
+            errors += 1
+            if errors <= 10:
+                print "Wrong parse of %s -> %s (expected %s)" % (name, result, expected)
+    print "Parsed %s names, %s errors" % (len(corpus), errors)
+    start = time.time()
+    for name, _ in corpus:
+        _parse(name)
+    elapsed = time.time() - start
+    print "Uncached: %.0f names/s" % (len(corpus) / elapsed)
+    names = [name for name, _ in corpus][:CACHE_SIZE]
+    start = time.time()
+    for _ in range(repeat):
+        for name in names:
+            parse(name)
+    elapsed = time.time() - start
+    print "Cached: %.0f names/s" % (repeat * len(names) / elapsed)
+    return errors
+
+
+if __name__ == '__main__':
+    import sys
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('--benchmark', action='store_true',
+                        help="Check the parser against a generated corpus")
+    parser.add_argument('--repeat', action='store', type=int, default=20)
+    parser.add_argument('names', action='store', type=str, nargs='*')
+    args = parser.parse_args()
+    if args.benchmark:
+        sys.exit(1 if benchmark(args.repeat) else 0)
+    for name in args.names:
+        print name, '->', parse(name)
+
+# EOF
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# =============================================================================
+# @file   fake_deluged.py
+# @author Albert Puig (albert.puig@cern.ch)
+# @date   19.10.2026
+# =============================================================================
+"""Fake deluged speaking the RPC protocol, for trying out the tools.
+
+Keeps torrents in memory and implements the subset of methods used by
+delugerpc. Connections are not encrypted, so clients need use_ssl=False.
+
+    $ python fake_deluged.py --port 58846
+
+"""
+
+from __future__ import with_statement
+import zlib
+import hashlib
+import threading
+import traceback
+
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+from delugerpc import rencode, _loads, torrent_id_from_magnet, \
+    RPC_RESPONSE, RPC_ERROR, DEFAULT_PORT, READ_SIZE
+
+
+class FakeCore(object):
+    """In-memory torrent session."""
+
+    def __init__(self, username='localclient', password='secret'):
+        self.credentials = (username, password)
+        self.torrents = {}
+        self.config = {'max_download_speed': -1.0,
+                       'max_upload_speed': -1.0,
+                       'max_active_limit': 8,
+                       'max_active_downloading': 3,
+                       'max_active_seeding': 5}
+        self.lock = threading.Lock()
+
+    def _add(self, torrent_id, name, options):
+        if torrent_id in self.torrents:
+            return None
+        self.torrents[torrent_id] = {'name': name,
+                                     'state': 'Paused' if options.get('add_paused') else 'Downloading',
+                                     'progress': 0.0,
+                                     'is_finished': False,
+                                     'save_path': '/tmp'}
+        return torrent_id
+
+    def finish(self, torrent_id):
+        """Mark a torrent as completely downloaded."""
+        self.torrents[torrent_id].update({'state': 'Seeding',
+                                          'progress': 100.0,
+                                          'is_finished': True})
+
+    # RPC methods
+    def daemon_login(self, username, password):
+        if (username, password) != self.credentials:
+            raise ValueError("Password does not match")
+        return 10
+
+    def daemon_info(self):
+        return '1.3.15'
+
+    def core_add_torrent_magnet(self, uri, options):
+        torrent_id = torrent_id_from_magnet(uri)
+        if not torrent_id:
+            raise ValueError("Invalid magnet %s" % uri)
+        return self._add(torrent_id, uri, options)
+
+    def core_add_torrent_file(self, filename, filedump, options):
+        return self._add(hashlib.sha1(filedump.encode() if hasattr(filedump, 'encode')
+                                      else filedump).hexdigest(),
+                         filename, options)
+
+    def core_add_torrent_url(self, url, options, headers=None):
+        return self._add(hashlib.sha1(url.encode('utf-8')).hexdigest(), url, options)
+
+    def core_pause_torrent(self, torrent_ids):
+        for torrent_id in torrent_ids:
+            self.torrents[torrent_id]['state'] = 'Paused'
+
+    def core_resume_torrent(self, torrent_ids):
+        for torrent_id in torrent_ids:
+            torrent = self.torrents[torrent_id]
+            torrent['state'] = 'Seeding' if torrent['is_finished'] else 'Downloading'
+
+    def core_pause_all_torrents(self):
+        self.core_pause_torrent(list(self.torrents))
+
+    def core_resume_all_torrents(self):
+        self.core_resume_torrent(list(self.torrents))
+
+    def core_remove_torrent(self, torrent_id, remove_data):
+        if torrent_id not in self.torrents:
+            raise KeyError("Torrent %s not found" % torrent_id)
+        del self.torrents[torrent_id]
+        return True
+
+    def core_get_torrents_status(self, filter_dict, keys):
+        torrent_ids = filter_dict.get('id', list(self.torrents))
+        return dict((torrent_id, dict((key, value)
+                                      for key, value in self.torrents[torrent_id].items()
+                                      if not keys or key in keys))
+                    for torrent_id in torrent_ids if torrent_id in self.torrents)
+
+    def core_get_torrent_status(self, torrent_id, keys):
+        return self.core_get_torrents_status({'id': [torrent_id]}, keys).get(torrent_id, {})
+
+    def core_get_config(self):
+        return dict(self.config)
+
+    def core_get_config_value(self, key):
+        return self.config.get(key)
+
+    def core_set_config(self, config):
+        self.config.update(config)
+
+
+class FakeDelugeHandler(socketserver.BaseRequestHandler):
+    """Handle one client connection."""
+
+    def handle(self):
+        core = self.server.core
+        logged_in = False
+        buffer_ = b''
+        while True:
+            chunk = self.request.recv(READ_SIZE)
+            if not chunk:
+                return
+            buffer_ += chunk
+            while buffer_:
+                decompressor = zlib.decompressobj()
+                try:
+                    data = decompressor.decompress(buffer_)
+                    if not decompressor.unused_data:
+                        zlib.decompress(buffer_)
+                except zlib.error:
+                    break  # Wait for the rest of the message
+                buffer_ = decompressor.unused_data
+                for request_id, method, args, kwargs in _loads(data):
+                    if method != 'daemon.login' and not logged_in:
+                        response = (RPC_ERROR, request_id, 'NotAuthorizedError',
+                                    "Not logged in", '')
+                    else:
+                        try:
+                            with core.lock:
+                                result = getattr(core, method.replace('.', '_'))(*args, **kwargs)
+                            response = (RPC_RESPONSE, request_id, result)
+                            logged_in = logged_in or method == 'daemon.login'
+                        except Exception as error:
+                            response = (RPC_ERROR, request_id, error.__class__.__name__,
+                                        str(error), traceback.format_exc())
+                    self.request.sendall(zlib.compress(rencode.dumps(response)))
+
+
+class FakeDeluged(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """Fake deluged listening on localhost.
+
+    Use port 0 to get a free port, available afterwards in `port`.
+
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=DEFAULT_PORT, core=None):
+        socketserver.TCPServer.__init__(self, ('127.0.0.1', port), FakeDelugeHandler)
+        self.core = core or FakeCore()
+        self.port = self.server_address[1]
+
+    def start(self):
+        """Serve in a background thread."""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', action='store', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--username', action='store', type=str, default='localclient')
+    parser.add_argument('--password', action='store', type=str, default='secret')
+    args = parser.parse_args()
+    server = FakeDeluged(args.port, FakeCore(args.username, args.password))
+    print("Fake deluged listening on port %s" % server.port)
+    server.serve_forever()
+
+# EOF
@@ -5,36 +5,197 @@
 # @author Albert Puig (albert.puig@cern.ch)
 # @date   05.03.2016
 # =============================================================================
-"""Check for duplicate shows that have been repacked."""
+"""Check for duplicate shows that have been repacked.
+
+The library is scanned once, one show folder per thread, and every video is
+indexed by (show folder, season, episode range). Episodes with more than one file
+are reported, and with --apply all but the one chosen by the policy are
+removed, together with their subtitles.
+
+"""
 
 import os
+import sys
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+import episode_parser
+
+VIDEO_EXTENSIONS = ['.mkv', '.mp4', '.avi']
+SUBTITLE_EXTENSIONS = ['.srt', '.sub', '.idx']
+
+VideoFile = namedtuple('VideoFile', 'path size info')
+
+
+def scan_show(show_folder):
+    """Get all the parsable video files in a show folder.
+
+    @arg  show_folder: folder to scan recursively
+    @type show_folder: str
+
+    @return: list of VideoFile
 
-REPACKED_WORDS = ['REPACKED', 'PROPER']
-
-for base_dir, folders, files in os.walk(os.path.expandvars('$HOME/Series')):
-    # Check we are in a show folder
-    if not files:
-        pass
-    if len(files) == 1 and files[0] == '.DS_Store':
-        pass
-    # Locate duplicates
-    for file_name in files:
-	if file_name.endswith('.srt'):
+    """
+    videos = []
+    for base_dir, _, files in os.walk(show_folder):
+        for file_name in files:
+            if os.path.splitext(file_name)[1].lower() not in VIDEO_EXTENSIONS:
+                continue
+            info = episode_parser.parse(file_name)
+            if not info:
+                continue
+            path = os.path.join(base_dir, file_name)
+            try:
+                videos.append(VideoFile(path, os.path.getsize(path), info))
+            except OSError:
+                pass  # Removed while scanning
+    return videos
+
+
+def subtitles_of(video_path):
+    """Get the subtitles of a video: same name, possibly with a language (.en.srt).
+
+    A subtitle that also matches a longer video name in the folder belongs
+    to that video (Show.S01E01.PROPER.srt is not for Show.S01E01.mkv).
+
+    @arg  video_path: video file
+    @type video_path: str
+
+    @return: sorted list of subtitle paths
+
+    """
+    folder, video_name = os.path.split(video_path)
+    stem = os.path.splitext(video_name)[0]
+    try:
+        names = os.listdir(folder or '.')
+    except OSError:
+        return []
+    stems = [os.path.splitext(name)[0] for name in names
+             if os.path.splitext(name)[1].lower() in VIDEO_EXTENSIONS]
+    subtitles = []
+    for name in names:
+        base, extension = os.path.splitext(name)
+        if extension.lower() not in SUBTITLE_EXTENSIONS:
             continue
-        for word in REPACKED_WORDS:
-            if word in file_name:
-                for file_ in files:
-                    if file_.endswith('.srt'):
-                        continue
-                    if file_.startswith(file_name.split(word)[0]) and \
-                            file_ is not file_name:
-			print "Do you want to replace?"
-			print file_
-			print "with"
-			print file_name
-			answer = raw_input("[y/n]")
-			if answer.lower() == 'y':
-			    os.remove(os.path.join(base_dir, file_))
+        owners = [other for other in stems if base == other or base.startswith(other + '.')]
+        if owners and max(owners, key=len) == stem:
+            subtitles.append(os.path.join(folder, name))
+    return sorted(subtitles)
 
-# EOF
 
+def index_library(library, workers=4):
+    """Index the video files of the library by episode.
+
+    @arg  library: folder containing one folder per show
+    @type library: str
+    @arg  workers: number of show folders scanned at the same time
+    @type workers: int
+
+    @return: dict of (show, season, first episode, last episode, airdate) -> list
+        of VideoFile. Multi-episode files are only duplicates of files with the
+        same episodes
+
+    """
+    show_folders = [os.path.join(library, element) for element in os.listdir(library)
+                    if os.path.isdir(os.path.join(library, element))]
+    pool = ThreadPool(max(1, workers))
+    try:
+        scanned = pool.map(scan_show, show_folders)
+    finally:
+        pool.close()
+    index = {}
+    for show_folder, videos in zip(show_folders, scanned):
+        show = os.path.basename(show_folder).lower()
+        for video in videos:
+            key = (show, video.info.season, video.info.episode, video.info.last_episode,
+                   video.info.airdate)
+            index.setdefault(key, []).append(video)
+    return index
+
+
+def _resolution(video):
+    """Vertical resolution of the video, 0 if unknown."""
+    quality = video.info.quality
+    return int(quality[:-1]) if quality else 0
+
+POLICIES = {'proper': lambda video: (video.info.is_proper, video.size),
+            'largest': lambda video: (video.size, video.info.is_proper),
+            'resolution': lambda video: (_resolution(video), video.info.is_proper, video.size)}
+
+
+def find_duplicates(index, policy='proper'):
+    """Decide which file to keep for every duplicated episode.
+
+    @arg  index: output of index_library
+    @type index: dict
+    @arg  policy: name of the policy in POLICIES used to choose the file to keep
+    @type policy: str
+
+    @return: list of (key, kept VideoFile, list of VideoFile to remove), sorted by key
+
+    """
+    preference = POLICIES[policy]
+    duplicates = []
+    for key in sorted(index, key=lambda key: tuple(str(element) for element in key)):
+        videos = index[key]
+        if len(videos) < 2:
+            continue
+        videos = sorted(videos, key=preference, reverse=True)
+        duplicates.append((key, videos[0], videos[1:]))
+    return duplicates
+
+
+def write_report(duplicates, output):
+    """Write the duplicates report.
+
+    @arg  duplicates: output of find_duplicates
+    @type duplicates: list
+    @arg  output: where to write
+    @type output: file
+
+    """
+    for (show, season, episode, last, airdate), keep, remove in duplicates:
+        if airdate:
+            output.write("%s %s\n" % (show, airdate))
+        elif last != episode:
+            output.write("%s %sx%02d-%02d\n" % (show, season, episode, last))
+        else:
+            output.write("%s %sx%02d\n" % (show, season, episode))
+        output.write("  keep   %s\n" % keep.path)
+        for video in remove:
+            for path in [video.path] + subtitles_of(video.path):
+                output.write("  remove %s\n" % path)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('--policy', action='store', choices=sorted(POLICIES), default='proper',
+                        help="How to choose the file to keep")
+    parser.add_argument('--apply', action='store_true', help="Remove the duplicates")
+    parser.add_argument('--report', action='store', type=str, default=None,
+                        help="File to write the report to (default: stdout)")
+    parser.add_argument('--workers', action='store', type=int, default=4)
+    parser.add_argument('library', action='store', type=str, nargs='?',
+                        default=os.path.expandvars('$HOME/Series'))
+    args = parser.parse_args()
+    duplicates = find_duplicates(index_library(args.library, args.workers), args.policy)
+    if args.report:
+        with open(args.report, 'w') as report:
+            write_report(duplicates, report)
+    else:
+        write_report(duplicates, sys.stdout)
+    if args.apply:
+        removed_subtitles = 0
+        for _, _, remove in duplicates:
+            for video in remove:
+                # Before the video goes, or its subtitles can't be told apart
+                subtitles = subtitles_of(video.path)
+                os.remove(video.path)
+                for subtitle in subtitles:
+                    os.remove(subtitle)
+                removed_subtitles += len(subtitles)
+        print "Removed %s files and %s subtitles" % (sum(len(remove) for _, _, remove in duplicates),
+                                                     removed_subtitles)
+
+# EOF
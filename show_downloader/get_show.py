@@ -1,36 +1,87 @@
 #!/usr/bin/env python3
-"""Download a show given its link"""
+"""Download shows given their links"""
 
-import os
 import logging
-import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
-import urllib.request
-import time
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+import lxml.html
+import lxml.etree
 
 import click
 
+from delugerpc import get_client, DelugeRPCError
+
 
 logging.basicConfig()
 
+MAGNET_XPATH = "//a[contains(concat(' ', normalize-space(@class), ' '), ' sd ')]/@href"
+
+
+def make_session(pool_size):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=2)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def parse_magnets(content):
+    # xpath gives lxml string subclasses, which rencode can't send
+    return [str(href) for href in lxml.html.fromstring(content).xpath(MAGNET_XPATH)]
+
+
+def get_magnets(session, show_url):
+    response = session.get(show_url, timeout=30)
+    response.raise_for_status()
+    return parse_magnets(response.content)
+
 
-def download_magnet(torrent_file):
-    command = ["deluge-console", "add", torrent_file]
-    with open(os.devnull, 'wb') as devnull:
-        logging.debug(' Adding magnet with command %s', command)
-        if subprocess.call(command, stdout=devnull, stderr=devnull):
-            return False
-    return True
+def download_magnet(magnets):
+    logging.debug(' Adding %s magnets', len(magnets))
+    try:
+        results = get_client().add_magnets(magnets)
+    except (IOError, DelugeRPCError) as error:
+        logging.error('Cannot talk to deluge -> %s', error)
+        return [False] * len(magnets)
+    return [not isinstance(result, DelugeRPCError) for result in results]
 
 
 @click.command()
-@click.argument('show_url')
-def main(show_url):
-    response = requests.get(show_url)
-    soup = BeautifulSoup(response.text, 'html.parser')
-    download_magnet(' '.join(magnet['href'] for magnet in soup.findAll('a', 'sd')))
+@click.argument('show_urls', nargs=-1)
+@click.option('--from-file', type=click.File('r'),
+              help='File with one show URL per line')
+@click.option('--workers', default=8, show_default=True,
+              help='Number of pages fetched at the same time')
+def main(show_urls, from_file, workers):
+    show_urls = list(show_urls)
+    if from_file:
+        show_urls.extend(line.strip() for line in from_file
+                         if line.strip() and not line.startswith('#'))
+    if not show_urls:
+        raise click.UsageError('No show URLs given')
+    session = make_session(workers)
+    with ThreadPoolExecutor(workers) as executor:
+        futures = [executor.submit(get_magnets, session, show_url) for show_url in show_urls]
+    # Add all magnets in one go
+    magnets = {}
+    failed = False
+    for show_url, future in zip(show_urls, futures):
+        try:
+            magnets[show_url] = future.result()
+        # Empty or non-HTML pages raise ParserError, which is not a ValueError
+        except (requests.RequestException, ValueError, lxml.etree.LxmlError) as error:
+            logging.error('Cannot get %s -> %s', show_url, error)
+            failed = True
+    results = iter(download_magnet([magnet for show_magnets in magnets.values()
+                                    for magnet in show_magnets]))
+    for show_url, show_magnets in magnets.items():
+        added = sum(next(results) for _ in show_magnets)
+        failed = failed or added != len(show_magnets)
+        click.echo('%s: added %s of %s magnets' % (show_url, added, len(show_magnets)))
+    if failed:
+        raise SystemExit(1)
 
 
 if __name__ == '__main__':
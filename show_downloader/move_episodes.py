@@ -8,13 +8,19 @@
 
 import os
 import re
-import shutil
+import sys
+import sqlite3
 from argparse import ArgumentParser
 
 import subliminal
 from babelfish import Language
 
-from delugectl import cleanup_torrents, start_deluge, is_deluge_running
+from delugectl import cleanup_torrents, remove_finished_torrents, start_deluge, stop_deluge, \
+    deluge_status, wait_for_deluge, DEAD
+import episode_parser
+from move_journal import MoveJournal
+from catalog import Catalog
+from delugerpc import DelugeRPCError
 
 # Deluge stuff
 
@@ -23,13 +29,6 @@ _forbidden_regexes = [re.compile(r'sample'),
                       re.compile(r'rarbg.com.mp4$'),
                       re.compile(r'/rarbg.mp4$')]
 
-re_tv = re.compile(r'(.+?)'
-                   r'[ .][Ss](\d\d?)[Ee](\d\d?)|(\d\d?)x(\d\d?)|(\d\d?)(\d\d)'
-                   r'.*?'
-                   r'(?:[ .](\d{3}\d?p)|\Z)?')
-
-re_season = re.compile(r"[Ss](\d\d?)[Ee](\d\d?)|(\d\d?)x(\d\d?)|(\d)(\d\d)")
-
 SHOW_CONVERSIONS = {'Marvels Agents of S.H.I.E.L.D.': 'Marvels Agents of S.H.I.E.L.D'.lower(),
                     'Marvels Luke Cage': 'Luke Cage'.lower(),
                     'House of Cards': 'House of cards (2013)'.lower(),
@@ -53,8 +52,8 @@ _reasons = {'season': "I couldn't determine season number",
             'id': "I couldn't determine the show name",
             'showlist': "I couldn't match the show name with any folder"}
 
-get_show_list = lambda folder: [os.path.split(os.path.join(folder, element))[1].lower()
-                                for element in os.listdir(folder)]
+get_show_list = lambda folder: dict((element.lower(), element)
+                                    for element in os.listdir(folder))
 
 class EpisodePlaceholder(object):
     """Dirty hack to use as a placeholder for episodes."""
@@ -92,13 +91,13 @@ def match_episodes(episodes, show_list):
         try:
             episode = subliminal.scan_video(episode_path)
         except ValueError:
-            tv_data = re_tv.match(os.path.basename(episode_path))
+            tv_data = episode_parser.parse(os.path.basename(episode_path))
             episode = None
-            if tv_data:
+            if tv_data and tv_data.season is not None:
                 episode = subliminal.video.Episode(episode_path,
-                                                   tv_data.group(1).replace(".", " "),
-                                                   tv_data.group(2),
-                                                   tv_data.group(3))
+                                                   tv_data.show,
+                                                   tv_data.season,
+                                                   tv_data.episode)
         if not episode:
             episode_matching['notmatched'].append((episode_path, 'id'))
             continue
@@ -111,9 +110,10 @@ def match_episodes(episodes, show_list):
             episod.name = episode.name
             episode = episod
         else:
-            if SHOW_CONVERSIONS.get(episode.series, episode.series.lower()) in show_list:
-                series = show
-                episode.series = show
+            show = SHOW_CONVERSIONS.get(episode.series, episode.series.lower())
+            if show in show_list:
+                series = show_list[show]
+                episode.series = series
         if not series:
             episode_matching['notmatched'].append((episode_path, 'showlist'))
             continue
@@ -134,8 +134,6 @@ def find_path_for_episodes(episodes, dest_folder):
         except Exception, e:
             print "Error processing episode: ", episode.name, episode.series, episode.season
             raise e
-        if not os.path.isdir(final_dir):
-            os.mkdir(final_dir)
         output.append((episode.name, final_dest))
     return output
 
@@ -197,12 +195,40 @@ if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument('--update-xbmc', action='store_true')
     parser.add_argument('--send-email', action='store_true')
+    parser.add_argument('--rollback', action='store_true',
+                        help="Roll back an interrupted run instead of completing it")
+    parser.add_argument('--journal', action='store', type=str,
+                        default=os.path.expanduser('~/runtime/move_episodes.journal'))
     parser.add_argument('downloads_folder', action='store', type=str)
     parser.add_argument('shows_folder', action='store', type=str)
     args = parser.parse_args()
-    # Get deluge situation, stop and clean
-    was_deluge_running = is_deluge_running()
-    cleanup_torrents(raise_on_fail=False)
+    problems = []
+    # Finish what an interrupted run left
+    journal = MoveJournal(args.journal)
+    recovered = []
+    restart_deluge = False
+    if args.rollback:
+        # Only undo the interrupted run, or the episodes go straight back to the library
+        if not journal.pending():
+            print "No interrupted run to roll back"
+            sys.exit(0)
+        _, recover_problems, extra = journal.recover(rollback=True)
+        if extra.get('restart_deluge', False) and deluge_status() == DEAD:
+            start_deluge()
+        for problem in recover_problems:
+            print problem
+        print "Rolled back interrupted run"
+        sys.exit(1 if recover_problems else 0)
+    if journal.pending():
+        recovered, recover_problems, extra = journal.recover()
+        problems.extend(recover_problems)
+        restart_deluge = extra.get('restart_deluge', False)
+    # Get deluge situation, only stopping it if torrents can't be cleaned up live
+    status = deluge_status()
+    is_running = status != DEAD and wait_for_deluge()
+    was_deluge_running = status != DEAD or restart_deluge
+    if not is_running:
+        stop_deluge()
     # Check folders
     if not os.path.isdir(args.downloads_folder):
         raise ValueError("Downloads folder does not exist!")
@@ -222,31 +248,40 @@ if __name__ == '__main__':
     folders_to_protect = set([os.path.dirname(file_name)
                               for file_name, _ in episodes_unmatched] +
                              [downloads_folder])
-    # Move
-    problems = []
-    folders_to_remove = []
-    final_videos = []
-    for origin, dest in episodes_destination:
+    # Move and remove the source folders
+    episodes_moved, move_problems = journal.run(episodes_destination,
+                                                folders_to_protect,
+                                                extra={'restart_deluge': was_deluge_running})
+    problems.extend(move_problems)
+    episodes_moved = recovered + episodes_moved
+    # Only clean up torrents once the moves are done, so a rollback still finds them
+    cleaned_live = False
+    if is_running:
         try:
-            os.system('mv "%s" "%s"' % (origin, dest))
-            #print 'mv "%s" "%s"' % (origin, dest)
-            #shutil.copyfile(origin, dest)
-            # Cleanup
-            origin_folder = os.path.dirname(origin)
-            if not origin_folder in folders_to_protect:
-                folders_to_remove.append(origin_folder)
-            if not any([no_sub_show in dest for no_sub_show in NO_SUBS]):
-                final_videos.append(subliminal.scan_video(dest))
-        except Exception, exception:
-            print exception
-            problems.append("Exception moving %s to %s -> %s\n" % (origin, dest, exception))
-    # Now remove
-    for folder_to_remove in set(folders_to_remove):
-        #print "Remove", folder_to_remove
-        shutil.rmtree(folder_to_remove)
+            remove_finished_torrents()
+            cleaned_live = True
+        except (IOError, DelugeRPCError), error:
+            print "Cannot clean up running deluge -> %s" % error
+    if not cleaned_live:
+        cleanup_torrents(raise_on_fail=False)
+    # Keep the catalog of the library up to date
+    try:
+        catalog = Catalog()
+        catalog.add([dest for _, dest in episodes_moved])
+        catalog.close()
+    except sqlite3.Error, error:
+        problems.append("Cannot update the episode catalog -> %s\n" % error)
     # Put deluge in previous status
     if was_deluge_running:
         start_deluge()
+    final_videos = []
+    for origin, dest in episodes_moved:
+        if not any([no_sub_show in dest for no_sub_show in NO_SUBS]):
+            try:
+                final_videos.append(subliminal.scan_video(dest))
+            except Exception, exception:
+                print exception
+                problems.append("Exception scanning %s -> %s\n" % (dest, exception))
     # Get subtitles
     subtitles = subliminal.download_best_subtitles(final_videos,
                                                    {Language('eng')},
@@ -258,9 +293,9 @@ if __name__ == '__main__':
         else:
             subliminal.save_subtitles(video, subtitles[video])
     # Format body
-    body = format_body(show_folder, episodes_destination, episodes_unmatched, problems)
+    body = format_body(show_folder, episodes_moved, episodes_unmatched, problems)
     # Communicate if I did something
-    if episodes_with_show or episodes_unmatched:
+    if episodes_moved or episodes_unmatched or problems:
         # Write email
         if args.send_email:
             send_email(body)
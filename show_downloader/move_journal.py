@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# =============================================================================
+# @file   move_journal.py
+# @author Albert Puig (albert.puig@cern.ch)
+# @date   19.10.2026
+# =============================================================================
+"""Crash-safe batch moves.
+
+Before touching anything, the whole plan (moves, folders to protect and any
+extra information needed to finish the job) is written to a journal, and
+every completed move is appended to it. If the run is interrupted, the next
+one finds the journal and either replays the remaining moves or rolls back
+the finished ones, so there's never the need to rescan everything by hand.
+
+Journal records are JSON lines:
+  * {"op": "plan", "moves": [[origin, dest], ...], "protect": [...], "extra": {...}}
+  * {"op": "done", "move": index}
+  * {"op": "moved"}: all moves attempted, only source cleanup remains
+
+"""
+
+from __future__ import with_statement
+import os
+import json
+import shutil
+
+
+class MoveJournal(object):
+    """Execute a list of moves, keeping track of them in a journal file."""
+
+    def __init__(self, journal_file):
+        """Initialize the journal.
+
+        @arg  journal_file: file in which to keep the journal
+        @type journal_file: str
+
+        """
+        self.journal_file = journal_file
+        self._journal = None
+
+    def pending(self):
+        """Is there an interrupted run to recover?"""
+        return os.path.exists(self.journal_file)
+
+    def _write(self, record):
+        """Append a record to the journal and make sure it reaches the disk."""
+        self._journal.write(json.dumps(record) + '\n')
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def _read(self):
+        """Read journal records, ignoring a truncated last line."""
+        records = []
+        with open(self.journal_file) as journal:
+            for line in journal:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break
+        return records
+
+    def _close(self):
+        """Close the journal, leaving it in place for recovery."""
+        if self._journal:
+            self._journal.close()
+            self._journal = None
+
+    def _finish(self):
+        """Close and remove the journal."""
+        self._close()
+        if os.path.exists(self.journal_file):
+            os.remove(self.journal_file)
+
+    def run(self, moves, protect=None, extra=None):
+        """Move files, creating destination folders and removing emptied sources.
+
+        All destination folders are created first, then the files are moved
+        and finally the source folders of moved files are removed unless they
+        are protected.
+
+        @arg  moves: files to move
+        @type moves: list of (origin, dest) tuples
+        @arg  protect: folders that must not be removed
+        @type protect: list
+        @arg  extra: information needed to complete the run after a crash
+        @type extra: dict
+
+        @return: list of (origin, dest) moved, list of problems
+
+        """
+        if self.pending():
+            raise OSError("Journal from interrupted run exists -> %s" % self.journal_file)
+        moves = [(origin, dest) for origin, dest in moves]
+        protect = list(protect or [])
+        self._journal = open(self.journal_file, 'w')
+        finished = False
+        try:
+            self._write({'op': 'plan', 'moves': moves, 'protect': protect, 'extra': extra or {}})
+            problems = self._make_folders(moves)
+            done, move_problems = self._move(moves, range(len(moves)))
+            problems.extend(move_problems)
+            self._write({'op': 'moved'})
+            problems.extend(self._remove_sources([moves[index] for index in done], protect))
+            finished = True
+        finally:
+            if not finished:
+                # Interrupted (even by Ctrl-C): keep the journal for the next run
+                self._close()
+        self._finish()
+        return [moves[index] for index in done], problems
+
+    def recover(self, rollback=False):
+        """Complete or roll back an interrupted run.
+
+        Roll back is only possible if the run was interrupted while moving
+        files; once all moves are done, the run is always completed.
+
+        @arg  rollback: move files back to their origin instead of completing the run?
+        @type rollback: bool
+
+        @return: list of (origin, dest) moved, list of problems, extra information
+
+        """
+        records = self._read()
+        if not records or records[0].get('op') != 'plan':
+            self._finish()
+            return [], ["Discarded unreadable journal %s" % self.journal_file], {}
+        plan = records[0]
+        moves = [tuple(move) for move in plan['moves']]
+        done = set(record['move'] for record in records if record.get('op') == 'done')
+        all_moved = any(record.get('op') == 'moved' for record in records)
+        self._journal = open(self.journal_file, 'a')
+        finished = False
+        try:
+            if rollback and not all_moved:
+                # The move in progress when crashing may not be journaled, so check
+                # all of them
+                moved_back = [index for index in range(len(moves))
+                              if not os.path.exists(moves[index][0])]
+                _, problems = self._move([(dest, origin) for origin, dest in moves],
+                                         moved_back, journal=False)
+                moved = []
+            else:
+                problems = []
+                if not all_moved:
+                    problems = self._make_folders(moves)
+                    remaining = [index for index in range(len(moves)) if index not in done]
+                    newly_done, move_problems = self._move(moves, remaining)
+                    problems.extend(move_problems)
+                    done.update(newly_done)
+                    self._write({'op': 'moved'})
+                moved = [moves[index] for index in sorted(done)]
+                problems.extend(self._remove_sources(moved, plan['protect']))
+            finished = True
+        finally:
+            if not finished:
+                self._close()
+        self._finish()
+        return moved, problems, plan['extra']
+
+    @staticmethod
+    def _make_folders(moves):
+        """Create all destination folders in one pass."""
+        problems = []
+        for folder in sorted(set(os.path.dirname(dest) for _, dest in moves)):
+            if not os.path.isdir(folder):
+                try:
+                    os.makedirs(folder)
+                except OSError, error:
+                    problems.append("Cannot create folder %s -> %s" % (folder, error))
+        return problems
+
+    def _move(self, moves, indices, journal=True):
+        """Move the given subset of files, journaling each finished move.
+
+        An origin that is gone while the destination exists is considered moved,
+        since that's what a crash just after the move looks like.
+
+        """
+        done = []
+        problems = []
+        for index in indices:
+            origin, dest = moves[index]
+            try:
+                if not os.path.exists(origin):
+                    if not os.path.exists(dest):
+                        raise OSError("Neither origin nor destination exist")
+                else:
+                    shutil.move(origin, dest)
+                if journal:
+                    self._write({'op': 'done', 'move': index})
+                done.append(index)
+            except Exception, exception:
+                problems.append("Exception moving %s to %s -> %s\n" % (origin, dest, exception))
+        return done, problems
+
+    @staticmethod
+    def _remove_sources(moved, protect):
+        """Remove the source folders of moved files, unless protected."""
+        problems = []
+        folders_to_remove = set(os.path.dirname(origin) for origin, _ in moved) - set(protect)
+        for folder_to_remove in folders_to_remove:
+            if os.path.isdir(folder_to_remove):
+                try:
+                    shutil.rmtree(folder_to_remove)
+                except OSError, error:
+                    problems.append("Cannot remove %s -> %s" % (folder_to_remove, error))
+        return problems
+
+# EOF
@@ -8,9 +8,9 @@
 from datetime import datetime
 import os
 import string
-import subprocess
 import urllib2
 import socket
+import sqlite3
 import argparse
 import logging
 
@@ -19,10 +19,12 @@ from lxml import etree
 from Containers import TimedDict
 from retry import retry
 import PickleFile
+import episode_parser
+from catalog import Catalog
 
-from delugectl import is_deluge_running, start_deluge
+from delugerpc import get_client, DelugeRPCError
+from delugectl import deluge_status, start_deluge, wait_for_deluge, DEAD
 
-PROPER_WORDS = ["PROPER", "REPACK"]
 CACHE_SIZE = 8*7
 
 
@@ -63,18 +65,42 @@ def sanitize_feed(feed_list):
 
     """
     # Find shows that have been uploaded twice
-    repacked_episodes = []
+    repacked_episodes = set()
     for show_title, _, _ in feed_list:
-        for proper_word in PROPER_WORDS:
-            if proper_word in show_title:
-                repacked_episodes.append(show_title.replace(proper_word, '').strip())
+        episode_info = episode_parser.parse(show_title)
+        if episode_info and episode_info.is_proper:
+            repacked_episodes.add(episode_info.key)
     final_list = []
     for show_title, date, magnet in feed_list:
-        if show_title not in repacked_episodes:
-            final_list.append((show_title, date, magnet))
+        episode_info = episode_parser.parse(show_title)
+        if episode_info and not episode_info.is_proper and \
+                episode_info.key in repacked_episodes:
+            continue
+        final_list.append((show_title, date, magnet))
     return final_list
 
 
+def add_magnets(magnets):
+    """Add magnet links to deluge in one batch.
+
+    @arg  magnets: magnet links
+    @type magnets: list
+
+    @return: list of booleans upon success/failure
+
+    """
+    logging.debug(' Adding %s magnets', len(magnets))
+    try:
+        results = get_client().add_magnets(magnets)
+    except (IOError, DelugeRPCError), error:
+        logging.error("Cannot talk to deluge -> %s", error)
+        return [False] * len(magnets)
+    for magnet, result in zip(magnets, results):
+        if isinstance(result, DelugeRPCError):
+            logging.error("Problem adding %s -> %s", magnet, result)
+    return [not isinstance(result, DelugeRPCError) for result in results]
+
+
 def download_torrent(torrent_file):
     """Get the torrent.
 
@@ -90,12 +116,7 @@ def download_torrent(torrent_file):
 
     """
     if torrent_file.startswith("magnet:"):  # Magnet!!
-        command = ["deluge-console", "add", torrent_file]
-        with open(os.devnull, 'wb') as devnull:
-            logging.debug(' Adding magnet with command %s', command)
-            if subprocess.call(command, stdout=devnull, stderr=devnull):
-            #if subprocess.call(command, stderr=devnull):
-                return False
+        return add_magnets([torrent_file])[0]
     else:
         file_name = os.path.split(torrent_file)[1]
         dest_file = os.path.join(os.environ['HOME'], 'runtime', 'watch', file_name)
@@ -134,12 +155,29 @@ def download_shows(feed_list, accept_fail, download):
     cache = TimedDict(CACHE_SIZE*24*3600) # Keys last for two months
     if os.path.exists(cache_file):
         cache = PickleFile.load(cache_file)
+
+    # Episodes already in the library, whatever the cache says
+    try:
+        catalog = Catalog()
+        in_library = catalog.keys()
+        catalog.close()
+    except sqlite3.Error, error:
+        logging.error("Cannot read the episode catalog -> %s", error)
+        in_library = set()
+
+    def register(episode, episode_date, sc):
+        if not accept_fail and not sc:
+            logging.error("Problems downloading %s", episode)
+        else:
+            cache.add(episode, episode_date)
+
     for feed in feed_list:
         feed_info = sanitize_feed(get_info(feed))
         # print 'Today is', datetime.today()
         # print 'Initial cache'
         # for key in cache:
         #    print ' -', key
+        magnets = []
         for episode, episode_date, torrent_file in feed_info:
             logging.debug('Found episode: %s %s', episode, torrent_file)
 #             if (datetime.today() - episode_date).days > 4*7: # Too old!
@@ -148,16 +186,26 @@ def download_shows(feed_list, accept_fail, download):
             if episode in cache: # Already downloaded
                 logging.debug(' Already downloaded')
                 continue
+            episode_info = episode_parser.parse(episode)
+            # PROPER and REPACK releases replace what's in the library
+            if episode_info and not episode_info.is_proper and episode_info.key in in_library:
+                logging.debug(' Already in the library')
+                continue
             # print 'Downloading?', download
+            if download and torrent_file.startswith("magnet:"):
+                # Magnets are sent to deluge all together
+                magnets.append((episode, episode_date, torrent_file))
+                continue
             if download:
                 logging.debug( ' Downloading!')
                 sc = download_torrent(torrent_file)
             else:
                 sc = True
-            if not accept_fail and not sc:
-                logging.error("Problems downloading %s", episode)
-            else:
-                cache.add(episode, episode_date)
+            register(episode, episode_date, sc)
+        if magnets:
+            results = add_magnets([magnet for _, _, magnet in magnets])
+            for (episode, episode_date, _), sc in zip(magnets, results):
+                register(episode, episode_date, sc)
     # print 'Cache before deleting expired'
     # for key in cache:
     #    print ' -', key
@@ -179,11 +227,11 @@ if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO,
                         format='%(asctime)s : %(message)s',
                         datefmt='%Y-%m-%d %H:%M:%S')
-    if not is_deluge_running():
-        logging.warning("Deluge is OFF! Starting and waiting 30s")
+    if deluge_status() == DEAD:
+        logging.warning("Deluge is OFF! Starting and waiting for it")
         start_deluge()
-        import time
-        time.sleep(30)
+    if not wait_for_deluge():
+        logging.error("Deluge is not accepting connections")
     if args.debug:
         logging.getLogger().setLevel(logging.DEBUG)
     download_shows("http://showrss.info/user/15673.rss?magnets=true&namespaces=true&name=clean&quality=null&re=null",
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# =============================================================================
+# @file   test_delugerpc.py
+# @author Albert Puig (albert.puig@cern.ch)
+# @date   19.10.2026
+# =============================================================================
+"""Check the RPC client and the tools using it against the fake daemon.
+
+    $ python test_delugerpc.py
+
+"""
+
+from __future__ import with_statement
+import time
+import zlib
+import socket
+import unittest
+
+import delugerpc
+from delugerpc import DelugeRPCClient, DelugeRPCError, DEFAULT_PORT
+from fake_deluged import FakeDeluged, FakeCore
+import delugectl
+
+MAGNET = 'magnet:?xt=urn:btih:%s&dn=Show.S01E0%s.720p'
+TORRENT_IDS = ['%040x' % number for number in range(1, 4)]
+
+
+class SlowCore(FakeCore):
+    """Core whose first removal takes longer than the client waits."""
+    delay = 1.0
+
+    def __init__(self):
+        FakeCore.__init__(self)
+        self.removals = 0
+
+    def core_remove_torrent(self, torrent_id, remove_data):
+        self.removals += 1
+        if self.removals == 1:
+            time.sleep(self.delay)
+        return FakeCore.core_remove_torrent(self, torrent_id, remove_data)
+
+
+class DelugeRPCTest(unittest.TestCase):
+    core_class = FakeCore
+    timeout = 5
+
+    def setUp(self):
+        self.server = FakeDeluged(0, self.core_class())
+        self.server.start()
+        self.client = DelugeRPCClient(port=self.server.port, username='localclient',
+                                      password='secret', timeout=self.timeout, use_ssl=False)
+
+    def tearDown(self):
+        self.client.disconnect()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def add_magnets(self):
+        return self.client.add_magnets([MAGNET % (torrent_id, position)
+                                        for position, torrent_id in enumerate(TORRENT_IDS)])
+
+
+class BatchTest(DelugeRPCTest):
+
+    def test_batch_keeps_order(self):
+        self.add_magnets()
+        results = self.client.batch([('core.get_config_value', ('max_active_limit',), {}),
+                                     ('daemon.info', (), {}),
+                                     ('core.get_torrents_status', ({'id': TORRENT_IDS[:1]}, ['name']), {})])
+        self.assertEqual(results[0], 8)
+        self.assertEqual(results[1], '1.3.15')
+        self.assertEqual(list(results[2]), TORRENT_IDS[:1])
+
+    def test_batch_errors(self):
+        calls = [('core.remove_torrent', ('missing', False), {}), ('daemon.info', (), {})]
+        self.assertRaises(DelugeRPCError, self.client.batch, calls)
+        results = self.client.batch(calls, raise_on_error=False)
+        self.assertTrue(isinstance(results[0], DelugeRPCError))
+        self.assertEqual(results[1], '1.3.15')
+
+    def test_add_magnets(self):
+        self.assertEqual(self.add_magnets(), TORRENT_IDS)
+        results = self.client.add_magnets(['magnet:?dn=no_hash', MAGNET % (TORRENT_IDS[0], 0)])
+        self.assertTrue(isinstance(results[0], DelugeRPCError))
+        self.assertEqual(results[1], None)  # Already there
+        self.assertEqual(sorted(self.server.core.torrents), TORRENT_IDS)
+
+    def test_remove_finished_torrents(self):
+        self.add_magnets()
+        self.server.core.finish(TORRENT_IDS[1])
+        delugerpc._shared_client[('127.0.0.1', DEFAULT_PORT)] = self.client
+        try:
+            self.assertEqual(delugectl.remove_finished_torrents(), 1)
+        finally:
+            del delugerpc._shared_client[('127.0.0.1', DEFAULT_PORT)]
+        self.assertEqual(sorted(self.server.core.torrents), [TORRENT_IDS[0], TORRENT_IDS[2]])
+
+    def test_reconnect_after_daemon_closes(self):
+        self.add_magnets()
+        first_socket = self.client._socket
+        # The daemon drops the connection once the client stops talking
+        first_socket.shutdown(socket.SHUT_WR)
+        time.sleep(0.2)
+        self.assertEqual(self.client.remove(TORRENT_IDS[:1]), [True])
+        self.assertNotEqual(self.client._socket, first_socket)
+        self.assertEqual(sorted(self.server.core.torrents), TORRENT_IDS[1:])
+
+
+class TimeoutTest(DelugeRPCTest):
+    core_class = SlowCore
+    timeout = 0.6
+
+    def test_no_resend_after_timeout(self):
+        self.add_magnets()
+        self.assertRaises(IOError, self.client.remove, TORRENT_IDS[:1])
+        self.assertFalse(self.client.connected)
+        # The daemon still removes it, and only gets the call once
+        time.sleep(SlowCore.delay)
+        self.assertEqual(self.server.core.removals, 1)
+        self.assertEqual(sorted(self.server.core.torrents), TORRENT_IDS[1:])
+        self.assertEqual(self.client.call('daemon.info'), '1.3.15')
+
+
+class ChunkedSocket(object):
+    """Socket that returns the given chunks, then end of file."""
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def recv(self, size):
+        return self.chunks.pop(0) if self.chunks else b''
+
+    def close(self):
+        pass
+
+
+class ReceiveTest(unittest.TestCase):
+
+    def receive(self, chunks, number_of_messages):
+        client = DelugeRPCClient(username='localclient', password='secret', use_ssl=False)
+        client._socket = ChunkedSocket(chunks)
+        return [client._receive() for _ in range(number_of_messages)]
+
+    def test_split_messages(self):
+        messages = [[delugerpc.RPC_RESPONSE, request_id, 'x' * 100000 + str(request_id)]
+                    for request_id in range(3)]
+        data = b''.join(zlib.compress(delugerpc.rencode.dumps(message)) for message in messages)
+        # Small chunks that split every message, and chunks that end with a message
+        for size in (7, 1000, len(zlib.compress(delugerpc.rencode.dumps(messages[0])))):
+            chunks = [data[start:start + size] for start in range(0, len(data), size)]
+            self.assertEqual([list(message) for message in self.receive(chunks, 3)], messages)
+
+    def test_lost_connection(self):
+        data = zlib.compress(delugerpc.rencode.dumps([delugerpc.RPC_RESPONSE, 1, None]))
+        self.assertRaises(IOError, self.receive, [data[:-3]], 1)
+
+
+class WaitForDelugeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.deluge_status = delugectl.deluge_status
+        self.started = delugectl._status_cache['started']
+
+    def tearDown(self):
+        delugectl.deluge_status = self.deluge_status
+        delugectl._status_cache['started'] = self.started
+
+    def fake_status(self, statuses):
+        """Make deluge_status go through statuses, staying at the last one."""
+        statuses = list(statuses)
+
+        def deluge_status(max_age=0):
+            return statuses.pop(0) if len(statuses) > 1 else statuses[0]
+        delugectl.deluge_status = deluge_status
+
+    def test_dead_right_after_start(self):
+        self.fake_status([delugectl.DEAD, delugectl.DEAD, delugectl.STARTING, delugectl.RUNNING])
+        delugectl._status_cache['started'] = time.time()
+        self.assertTrue(delugectl.wait_for_deluge(timeout=5, poll_interval=0.01))
+
+    def test_dead_without_start(self):
+        self.fake_status([delugectl.DEAD, delugectl.RUNNING])
+        delugectl._status_cache['started'] = time.time() - delugectl.STARTUP_GRACE - 1
+        self.assertFalse(delugectl.wait_for_deluge(timeout=5, poll_interval=0.01))
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# EOF
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# =============================================================================
+# @file   test_get_show.py
+# @author Albert Puig (albert.puig@cern.ch)
+# @date   19.10.2026
+# =============================================================================
+"""Check that the magnets found in show pages can be sent to deluge.
+
+    $ python3 test_get_show.py
+
+"""
+
+import unittest
+
+from delugerpc import rencode, _loads
+from get_show import parse_magnets
+
+MAGNETS = ['magnet:?xt=urn:btih:%040x&dn=Show.S01E0%s.720p' % (number, number)
+           for number in range(1, 3)]
+PAGE = ('<html><body>' +
+        ''.join('<a class="magnet sd" href="%s">SD</a>'
+                '<a class="magnet hd" href="%s.hd">HD</a>' % (magnet, magnet)
+                for magnet in MAGNETS) +
+        '</body></html>').replace('&', '&amp;').encode('utf-8')
+
+
+class ParseMagnetsTest(unittest.TestCase):
+
+    def test_sd_magnets(self):
+        self.assertEqual(parse_magnets(PAGE), MAGNETS)
+
+    def test_magnets_can_be_encoded(self):
+        requests = [(request_id, 'core.add_torrent_magnet', (magnet, {}), {})
+                    for request_id, magnet in enumerate(parse_magnets(PAGE))]
+        self.assertEqual(_loads(rencode.dumps(requests))[0][2][0], MAGNETS[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# EOF
@@ -3,15 +3,179 @@
 # @author Albert Puig (albert.puig@epfl.ch)
 # @date   17.03.2013
 
-from fabric.api import settings, run
+import difflib
+import hashlib
+from StringIO import StringIO
+
+from fabric.api import settings, env
+from fabric.context_managers import hide
+
+from profiler import run, sudo, put, timed
+
+def _host_facts():
+    """Facts cached for the current host."""
+    facts = env.setdefault('facts', {})
+    return facts.setdefault(env.host_string, {'paths': {},
+                                              'packages': {},
+                                              'services': {},
+                                              'checksums': {}})
+
+@timed
+def gather_facts(paths=(), packages=(), services=(), checksums=()):
+    """Collect facts about the current host in a single remote command.
+
+    Only what is not cached yet is asked for, and results are cached for the
+    rest of the run.
+
+    @arg  paths: paths to check, stored as 'd' (folder), 'f' (file),
+        'o' (something else) or None (missing)
+    @arg  packages: packages whose installed version is needed, stored as
+        None if not installed
+    @arg  services: services whose systemd state is needed
+    @arg  checksums: files whose md5 is needed, stored as None if missing
+
+    @return: dict with the cached 'paths', 'packages', 'services' and 'checksums'
+
+    """
+    facts = _host_facts()
+    paths = [path for path in paths if path not in facts['paths']]
+    packages = [package for package in packages if package not in facts['packages']]
+    services = [service for service in services if service not in facts['services']]
+    checksums = [path for path in checksums if path not in facts['checksums']]
+    if not (paths or packages or services or checksums):
+        return facts
+    # Paths are not quoted so ~ and $HOME expand
+    script = []
+    for index, path in enumerate(paths):
+        script.append('if [ -d {1} ]; then echo "path {0} d"; '
+                      'elif [ -f {1} ]; then echo "path {0} f"; '
+                      'elif [ -e {1} ]; then echo "path {0} o"; fi'.format(index, path))
+    if packages:
+        script.append("dpkg-query -W -f='package ${{Package}} ${{Version}} ${{Status}}\\n' {0} "
+                      "2>/dev/null".format(' '.join(packages)))
+    for index, service in enumerate(services):
+        script.append('echo "service {0} $(systemctl is-active {1} 2>/dev/null)"'.format(index, service))
+    for index, path in enumerate(checksums):
+        script.append("md5sum {1} 2>/dev/null | sed 's/^/md5 {0} /'".format(index, path))
+    with settings(hide('running', 'stdout'), warn_only=True):
+        output = run('; '.join(script))
+    for path in paths:
+        facts['paths'][path] = None
+    for package in packages:
+        facts['packages'][package] = None
+    for path in checksums:
+        facts['checksums'][path] = None
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) < 2:
+            continue
+        if fields[0] == 'path':
+            facts['paths'][paths[int(fields[1])]] = fields[2]
+        elif fields[0] == 'package':
+            # package <name> <version> install ok installed
+            if fields[-1] == 'installed':
+                facts['packages'][fields[1].split(':')[0]] = fields[2]
+        elif fields[0] == 'service':
+            facts['services'][services[int(fields[1])]] = fields[2] if len(fields) > 2 else 'unknown'
+        elif fields[0] == 'md5':
+            facts['checksums'][checksums[int(fields[1])]] = fields[2]
+    return facts
+
+def forget_facts(paths=(), packages=(), services=(), checksums=()):
+    """Remove facts from the cache, for example after changing them."""
+    facts = _host_facts()
+    for kind, keys in (('paths', paths), ('packages', packages),
+                       ('services', services), ('checksums', checksums)):
+        for key in keys:
+            facts[kind].pop(key, None)
 
 def dir_exists(dir_name):
-    with settings(warn_only=True):
-        return not run('test -d {0}'.format(dir_name)).failed
+    return gather_facts(paths=[dir_name])['paths'][dir_name] == 'd'
 
 def file_exists(file_name):
-    with settings(warn_only=True):
-        return not run('test -f {0}'.format(file_name)).failed
+    return gather_facts(paths=[file_name])['paths'][file_name] == 'f'
+
+def package_version(package):
+    return gather_facts(packages=[package])['packages'][package]
+
+def service_state(service):
+    return gather_facts(services=[service])['services'][service]
+
+def file_checksum(file_name):
+    return gather_facts(checksums=[file_name])['checksums'][file_name]
+
+def _local_checksum(file_name):
+    with open(file_name, 'rb') as file_:
+        return hashlib.md5(file_.read()).hexdigest()
+
+def _needs_sudo(remote_path):
+    return not (remote_path.startswith('~') or remote_path.startswith('$HOME'))
+
+@timed
+def sync_files(files, handlers, plan=False):
+    """Bring remote files up to date and run the handlers of those that changed.
+
+    Local and remote checksums are compared in one batch, and only files
+    that differ are transferred.
+
+    @arg  files: list of (source, destination, handler names). Sources are
+        local paths, or remote paths if they start with 'remote:'
+    @type files: list
+    @arg  handlers: list of (name, command, use sudo?), in the order they
+        must run
+    @type handlers: list
+    @arg  plan: only show what would change, with diffs
+
+    @return: list of destinations that changed (or would change)
+
+    """
+    remote_sources = [source[len('remote:'):] for source, _, _ in files
+                      if source.startswith('remote:')]
+    checksums = gather_facts(checksums=[destination for _, destination, _ in files] +
+                                       remote_sources)['checksums']
+    changed = []
+    to_run = set()
+    for source, destination, file_handlers in files:
+        if source.startswith('remote:'):
+            source = source[len('remote:'):]
+            source_checksum = checksums[source]
+            if source_checksum is None:
+                print "Missing %s on the host, skipping it" % source
+                continue
+        else:
+            source_checksum = _local_checksum(source)
+        if source_checksum == checksums[destination]:
+            continue
+        changed.append(destination)
+        to_run.update(file_handlers)
+        use_sudo = _needs_sudo(destination)
+        if plan:
+            print "Would update %s" % destination
+            with settings(hide('running', 'stdout'), warn_only=True):
+                if source in remote_sources:
+                    print run('diff -u {0} {1}'.format(destination, source))
+                else:
+                    # Fabric strips the last newline
+                    remote = run('cat {0}'.format(destination)) + '\n' if checksums[destination] else ''
+                    with open(source) as local_file:
+                        print ''.join(difflib.unified_diff(StringIO(remote).readlines(),
+                                                           local_file.readlines(),
+                                                           destination, source))
+            continue
+        print "Updating %s" % destination
+        if source in remote_sources:
+            (sudo if use_sudo else run)('cp {0} {1}'.format(source, destination))
+        else:
+            put(source, destination, use_sudo=use_sudo, mirror_local_mode=True)
+        forget_facts(checksums=[destination])
+    for name, command, use_sudo in handlers:
+        if name not in to_run:
+            continue
+        if plan:
+            print "Would run %s" % name
+        else:
+            (sudo if use_sudo else run)(command)
+    return changed
 
 def to_boolean(arg):
     ret = bool(arg)
@@ -21,4 +185,3 @@ def to_boolean(arg):
     return ret
 
 # EOF
-